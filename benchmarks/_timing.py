@@ -0,0 +1,11 @@
+"""
+Timing helpers shared by the microbenchmarks
+"""
+import timeit
+
+
+def per_call_us(func, number):
+    """
+    :return: the best per-call time of func over 5 repetitions, in microseconds
+    """
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
@@ -0,0 +1,78 @@
+"""
+Microbenchmark of a cache hit of StudentCollection, on both the memory and the filesystem tier.
+Compares the previous cache entries (the whole pickled Response object returned by the view)
+    with the compact CachedResponse entries, measuring the time needed to read the entry and
+    build the response, for clients accepting gzip or not, and the size of the cache file.
+Run from the project's root folder with `python -m benchmarks.cache_entry_bench`
+"""
+import os
+import pickle
+import shutil
+import tempfile
+
+from flask_caching.backends import FileSystemCache
+
+from benchmarks._timing import per_call_us
+from studentmanager import create_app, db
+from studentmanager.caching import CachedResponse, TwoTierCache
+from studentmanager.models import generate_synthetic_data
+
+
+def main(number=2000, students=1000):
+    """
+    Prints the cost of a cache hit of the first page of the students collection, before and
+        after the introduction of the compact entries
+    :param number: number of cache reads for each measurement
+    :param students: number of students in the database
+    """
+    work_dir = tempfile.mkdtemp()
+    try:
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + os.path.join(work_dir, "bench.db"),
+            "CACHE_DIR": os.path.join(work_dir, "cache")
+        })
+        with app.app_context():
+            db.create_all()
+            generate_synthetic_data(students, 0, 0, 0)
+
+        with app.test_request_context("/api/students/"):
+            view = app.view_functions["api.studentcollection"]
+            # calls the view without the cache, i.e. the Resource's undecorated get
+            response = view.view_class().get.__wrapped__(view.view_class())
+            response.set_etag("0" * 32)
+            entry = CachedResponse.from_response(response, "0" * 32)
+
+        file_cache = FileSystemCache(os.path.join(work_dir, "entries"))
+        file_cache.set("before", response, timeout=0)
+        # the filesystem tier alone, which reads its files at once
+        two_tier = TwoTierCache(os.path.join(work_dir, "entries"), memory_bytes=0)
+        two_tier.set("after", entry, timeout=0)
+
+        def _size(key):
+            # pylint: disable=protected-access
+            return os.path.getsize(file_cache._get_filename(key))
+
+        pickled_response = pickle.dumps(response)
+        hits = {
+            "file": (lambda: file_cache.get("before"),
+                     lambda: two_tier.get("after").to_response(),
+                     lambda: two_tier.get("after").to_response(accept_gzip=True)),
+            # the memory tier used to keep pickled copies of the responses
+            "memory": (lambda: pickle.loads(pickled_response),
+                       entry.to_response,
+                       lambda: entry.to_response(accept_gzip=True)),
+        }
+
+        print(f"body {len(response.get_data())} bytes, cache file "
+              f"{_size('before')} bytes before, {_size('after')} bytes after")
+        print(f"{'tier':<8}{'before (us)':>14}{'after (us)':>14}{'after, gzip (us)':>20}")
+        with app.test_request_context("/api/students/"):
+            for tier, funcs in hits.items():
+                before, after, after_gzip = [per_call_us(func, number) for func in funcs]
+                print(f"{tier:<8}{before:>14.1f}{after:>14.1f}{after_gzip:>20.1f}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""
+Latency and throughput benchmark of the API endpoints.
+For every dataset size (number of assessments) a new database is populated with the synthetic
+    data generator, and every route registered in api.py is requested with the Flask test
+    client, both with an empty cache (cold) and after a first request has filled it (warm).
+The p50 and p99 latencies and the requests per second of each route are written to a JSON file,
+    which can later be used as the baseline of another run: routes whose latency grew more than
+    the given tolerance are reported, and the script exits with status 1.
+Run from the project's root folder with `python -m benchmarks.endpoint_bench`, e.g.
+    python -m benchmarks.endpoint_bench --sizes 1000 100000 --output bench.json
+    python -m benchmarks.endpoint_bench --sizes 1000 100000 --baseline bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+from studentmanager import create_app, db, cache
+from studentmanager.models import ApiKey, Assessment, generate_synthetic_data
+
+DEFAULT_SIZES = [1000, 100000, 1000000]
+# students * BENCH_COURSES * BENCH_DENSITY = assessments
+BENCH_COURSES = 100
+BENCH_DENSITY = 0.1
+BENCH_KEY = "benchmarkkey"
+MODES = ("cold", "warm")
+
+
+def build_app(size, seed, work_dir):
+    """
+    Creates an app with its own database and cache folder in work_dir, populated with about size
+        synthetic assessments and an admin API key
+    :return: the Flask app
+    """
+    db_path = os.path.join(work_dir, f"bench-{size}.db")
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_path,
+        "CACHE_DIR": os.path.join(work_dir, f"cache-{size}")
+    })
+    with app.app_context():
+        db.create_all()
+        db.session.add(ApiKey(key=ApiKey.key_hash(BENCH_KEY), admin=True))
+        db.session.commit()
+        generate_synthetic_data(max(size // int(BENCH_COURSES * BENCH_DENSITY), 1),
+                                BENCH_COURSES, BENCH_DENSITY, seed)
+    return app
+
+
+def route_requests(app):
+    """
+    Builds one request for every route of the api blueprint. The URL parameters refer to an
+        existing assessment in the middle of the dataset.
+    Only GET is measured for the resources (the other methods modify the data), except for the
+        batch endpoint, whose POST re-sends existing assessments and is therefore idempotent.
+    :return: a list of (name, method, url, kwargs) tuples
+    """
+    with app.app_context():
+        count = Assessment.query.count()
+        assessment = Assessment.query \
+            .order_by(Assessment.course_id, Assessment.student_id) \
+            .offset(count // 2).first()
+        batch = "\n".join(json.dumps(a.serialize()) for a in Assessment.query.limit(100))
+
+    values = {"course": assessment.course_id, "student": assessment.student_id}
+    requests = []
+    for rule in sorted(app.url_map.iter_rules(), key=lambda r: r.rule):
+        if not rule.endpoint.startswith("api."):
+            continue
+        url = rule.rule
+        for name, value in values.items():
+            url = url.replace(f"<{name}:{name}>", str(value))
+        if "GET" in rule.methods:
+            requests.append((f"GET {rule.rule}", "GET", url, {}))
+        elif "POST" in rule.methods:
+            requests.append((f"POST {rule.rule}", "POST", url, {
+                "data": batch,
+                "content_type": "application/x-ndjson",
+                "headers": {"Studentmanager-Api-Key": BENCH_KEY}
+            }))
+    return requests
+
+
+def measure(client, method, url, kwargs, mode, number):
+    """
+    Sends number requests and measures them
+    :param mode: 'cold' to empty the cache before every request, 'warm' to fill it beforehand
+    :return: a dictionary with the status code, the p50 and p99 latencies in milliseconds and
+        the requests per second
+    """
+    if mode == "warm":
+        client.open(url, method=method, **kwargs)
+    latencies = []
+    status = None
+    for _ in range(number):
+        if mode == "cold":
+            cache.clear()
+        start = time.perf_counter()
+        status = client.open(url, method=method, **kwargs).status_code
+        latencies.append(time.perf_counter() - start)
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "status": status,
+        "p50_ms": round(percentiles[49] * 1000, 3),
+        "p99_ms": round(percentiles[98] * 1000, 3),
+        "rps": round(len(latencies) / sum(latencies), 1)
+    }
+
+
+def run(sizes, number, seed):
+    """
+    Runs the benchmark on all the dataset sizes
+    :return: the list of results, one for each dataset size, route and mode, and the counters
+        of the cache tiers for each dataset size
+    """
+    results = []
+    cache_stats = {}
+    work_dir = tempfile.mkdtemp()
+    try:
+        for size in sizes:
+            start = time.perf_counter()
+            app = build_app(size, seed, work_dir)
+            print(f"dataset {size}: populated in {time.perf_counter() - start:.1f}s",
+                  file=sys.stderr)
+            client = app.test_client()
+            with app.app_context():
+                for name, method, url, kwargs in route_requests(app):
+                    for mode in MODES:
+                        result = measure(client, method, url, kwargs, mode, number)
+                        result.update(dataset=size, route=name, mode=mode)
+                        results.append(result)
+                        print(f"{size:>9} {mode:<5} {name:<66}{result['p50_ms']:>10.2f}ms"
+                              f"{result['p99_ms']:>10.2f}ms{result['rps']:>10.1f}/s",
+                              file=sys.stderr)
+                cache_stats[size] = cache.cache.stats()
+                print(f"dataset {size}: cache {cache_stats[size]}", file=sys.stderr)
+                db.session.remove()
+                db.engine.dispose()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results, cache_stats
+
+
+def find_regressions(results, baseline, tolerance, metric="p50_ms"):
+    """
+    Compares the results with the ones of a baseline run. Routes missing in the baseline are
+        ignored.
+    :param tolerance: the allowed relative slowdown, e.g. 0.2 for 20%
+    :param metric: the latency measure to compare, 'p50_ms' or 'p99_ms'
+    :return: a list of strings describing the routes that are slower than allowed
+    """
+    previous = {(r["dataset"], r["route"], r["mode"]): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = previous.get((result["dataset"], result["route"], result["mode"]))
+        if old is not None and result[metric] > old[metric] * (1 + tolerance):
+            regressions.append(
+                f"{result['dataset']} {result['mode']} {result['route']}: "
+                f"{metric} {old[metric]} -> {result[metric]}"
+            )
+    return regressions
+
+
+def main(argv=None):
+    """
+    Parses the command line arguments, runs the benchmark and compares it with the baseline
+    :return: the exit status, 1 if a regression was found
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n", maxsplit=1)[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+                        help="numbers of assessments of the datasets")
+    parser.add_argument("--requests", type=int, default=200,
+                        help="requests measured for each route and mode")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the synthetic data generator")
+    parser.add_argument("--output", default="bench_output.json",
+                        help="file the results are written to")
+    parser.add_argument("--baseline",
+                        help="results of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed relative slowdown with respect to the baseline")
+    parser.add_argument("--metric", choices=["p50_ms", "p99_ms"], default="p50_ms",
+                        help="latency measure compared with the baseline")
+    args = parser.parse_args(argv)
+
+    results, cache_stats = run(args.sizes, args.requests, args.seed)
+    with open(args.output, "w", encoding="utf-8") as output:
+        json.dump({
+            "environment": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "sqlite": sqlite3.sqlite_version
+            },
+            "requests": args.requests,
+            "seed": args.seed,
+            "results": results,
+            "cache": cache_stats
+        }, output, indent=2)
+
+    if args.baseline is None:
+        return 0
+    with open(args.baseline, encoding="utf-8") as baseline_file:
+        regressions = find_regressions(results, json.load(baseline_file),
+                                       args.tolerance, args.metric)
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
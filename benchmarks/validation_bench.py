@@ -0,0 +1,51 @@
+"""
+Microbenchmark of the JSON schema validation done by the POST and PUT endpoints.
+Compares the previous per-request behaviour (building the schema and a new validator with
+    jsonschema.validate) with the validators precompiled by the models.
+Run from the project's root folder with `python -m benchmarks.validation_bench`
+"""
+from jsonschema import validate
+from jsonschema.validators import Draft7Validator
+
+from benchmarks._timing import per_call_us
+from studentmanager.models import Student, Course, Assessment
+
+DOCUMENTS = {
+    Student: {
+        "first_name": "Draco",
+        "last_name": "Malfoy",
+        "date_of_birth": "1980-06-05",
+        "ssn": "050680-6367"
+    },
+    Course: {
+        "title": "Transfiguration",
+        "teacher": "Minerva Mcgonagall",
+        "code": "004723",
+        "ects": 5
+    },
+    Assessment: {
+        "course_id": 1,
+        "student_id": 1,
+        "grade": 5,
+        "date": "1993-02-08"
+    },
+}
+
+
+def main(number=2000):
+    """
+    Prints the per-request validation cost of every model, before and after precompilation
+    :param number: number of validations for each measurement
+    """
+    print(f"{'model':<12}{'before (us)':>14}{'after (us)':>14}{'speedup':>10}")
+    for model, doc in DOCUMENTS.items():
+        before = per_call_us(
+            lambda m=model, d=doc: validate(d, m.json_schema(),
+                                            format_checker=Draft7Validator.FORMAT_CHECKER),
+            number)
+        after = per_call_us(lambda m=model, d=doc: m.json_validator().validate(d), number)
+        print(f"{model.__name__:<12}{before:>14.1f}{after:>14.1f}{before / after:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,14 +3,18 @@ This module is used to retrieve a working Flask application complete with all th
 """
 import json
 import os
+import threading
 
+import click
 from flasgger import Swagger, swag_from
 from flask import Flask, send_from_directory, Response
 from flask_caching import Cache
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import OperationalError
 
-from studentmanager.constants import LINK_RELATIONS_URL, MASON, NAMESPACE, DOC_FOLDER
-from studentmanager.utils import request_path_cache_key
+from studentmanager.constants import \
+    LINK_RELATIONS_URL, MASON, NAMESPACE, DOC_FOLDER, DEFAULT_CACHE_MEMORY_BYTES, \
+    DEFAULT_CACHE_LIMITS
 
 # SOURCE: Project Layout on Lovelace
 
@@ -59,17 +63,21 @@ def create_app(test_config=None):
     # MODELS and CLICK functions
     # import not at the top of the file to avoid circular imports
     from studentmanager.models import \
-        generate_test_data, run_tests, init_db_command, generate_master_key
+        generate_test_data, run_tests, init_db_command, generate_master_key, migrate_db_command, \
+        generate_synthetic_data_command, cache_warm_command
 
     app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_db_command)
     app.cli.add_command(generate_test_data)
+    app.cli.add_command(generate_synthetic_data_command)
+    app.cli.add_command(cache_warm_command)
     app.cli.add_command(run_tests)
     app.cli.add_command(generate_master_key)
 
     # API and BLUEPRINT
     # import not at the top of the file to avoid circular imports
 
-    from studentmanager.api import api_bp
+    from studentmanager.api import api_bp, admin_bp
     from studentmanager.resources.course import CourseConverter
     from studentmanager.resources.student import StudentConverter
 
@@ -77,9 +85,15 @@ def create_app(test_config=None):
     app.url_map.converters["student"] = StudentConverter
 
     app.register_blueprint(api_bp)
+    app.register_blueprint(admin_bp)
 
     # CACHE initialization
-    app.config["CACHE_TYPE"] = "FileSystemCache"
+    app.config["CACHE_TYPE"] = "studentmanager.caching.TwoTierCache"
+    app.config.setdefault("CACHE_MEMORY_BYTES", DEFAULT_CACHE_MEMORY_BYTES)
+    app.config.setdefault("CACHE_MAX_STALENESS", {})
+    app.config.setdefault("CACHE_LIMITS", DEFAULT_CACHE_LIMITS)
+    # the families of CACHE_LIMITS replace the threshold of the filesystem cache
+    app.config.setdefault("CACHE_THRESHOLD", 0)
     if test_config is None or "CACHE_DIR" not in test_config:
         app.config["CACHE_DIR"] = os.path.join(app.instance_path, "cache")
     else:
@@ -87,6 +101,15 @@ def create_app(test_config=None):
 
     cache.init_app(app)
 
+    # API KEYS are loaded at startup, if the database has already been initialized
+    from studentmanager.models import ApiKeyIndex
+
+    with app.app_context():
+        try:
+            ApiKeyIndex.current()
+        except OperationalError:
+            pass
+
     # Static routes related to profiles and link relations
     # from sensorhub project example and Exercise 3 material on Lovelace
     @app.route("/profiles/<resource>/")
@@ -101,9 +124,10 @@ def create_app(test_config=None):
 
     # avoids circular imports
     from studentmanager.builder import StudentManagerBuilder
+    from studentmanager.caching import cached_resource
 
-    @cache.cached(timeout=None, make_cache_key=request_path_cache_key)
     @app.route('/api/')
+    @cached_resource()
     @swag_from(os.getcwd() + f"{DOC_FOLDER}entrypoint/get.yml")
     def api_entrypoint():
         """
@@ -116,4 +140,18 @@ def create_app(test_config=None):
         body.add_control_all_assessments()
         return Response(json.dumps(body), 200, mimetype=MASON)
 
+    # CACHE WARM-UP in the background, if enabled in the configuration, when the application
+    # is created to serve requests: not for the CLI commands (e.g. init-db), apart from run
+    cli_context = click.get_current_context(silent=True)
+    if app.config.get("CACHE_WARM_ON_STARTUP") \
+            and (cli_context is None or cli_context.command.name == "run"):
+        from studentmanager.caching import warm_cache
+
+        threading.Thread(
+            target=warm_cache,
+            args=(app, app.config.get("CACHE_WARM_ITEMS", 100)),
+            kwargs={"echo": app.logger.info},
+            daemon=True
+        ).start()
+
     return app
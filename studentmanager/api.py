@@ -1,5 +1,7 @@
 """
-This module instantiates the Api object and adds to it all the endpoints for the resources
+This module instantiates the Api object and adds to it all the endpoints for the resources.
+The administration endpoints have their own blueprint, so that they are not part of the
+    resources warmed in the cache nor measured by the benchmarks.
 """
 
 from flask import Blueprint
@@ -7,7 +9,8 @@ from flask_restful import Api
 
 from studentmanager.resources.assessment import \
     CourseAssessmentCollection, StudentAssessmentCollection, \
-    CourseAssessmentItem, StudentAssessmentItem, AssessmentCollection
+    CourseAssessmentItem, StudentAssessmentItem, AssessmentCollection, AssessmentBatch
+from studentmanager.resources.cache_stats import CacheStats
 from studentmanager.resources.course import CourseCollection, CourseItem
 from studentmanager.resources.profile_pictures import ProfilePictureItem
 from studentmanager.resources.student import StudentCollection, StudentItem
@@ -24,6 +27,7 @@ api.add_resource(StudentItem, "/students/<student:student>/")
 api.add_resource(ProfilePictureItem, "/students/<student:student>/profilePicture/")
 
 api.add_resource(AssessmentCollection, "/assessments/")
+api.add_resource(AssessmentBatch, "/assessments/batch/")
 api.add_resource(StudentAssessmentCollection,
                  "/students/<student:student>/assessments/")
 api.add_resource(StudentAssessmentItem,
@@ -32,3 +36,8 @@ api.add_resource(CourseAssessmentCollection,
                  "/courses/<course:course>/assessments/")
 api.add_resource(CourseAssessmentItem,
                  "/courses/<course:course>/assessments/<student:student>/")
+
+admin_bp = Blueprint("admin", __name__, url_prefix="/api/admin")
+admin_api = Api(admin_bp)
+
+admin_api.add_resource(CacheStats, "/cache/")
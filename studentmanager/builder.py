@@ -2,13 +2,17 @@
 This modules contains the MasonBuilder and StudentManagerBuilder extending it.
 These classes are used to create Response bodies with all the hypermedia controls
     necessary.
+The collections can be returned in a compact representation as well, with plain data items and
+    links instead of controls (see wants_compact and compact_document).
 """
 
 import json
+from urllib.parse import unquote
 
 from flask import url_for, request, Response
 
-from studentmanager.constants import ERROR_PROFILE, MASON, NAMESPACE
+from studentmanager.constants import \
+    ERROR_PROFILE, MASON, NAMESPACE, JSON, COMPACT_VIEW, MASON_VIEW
 from studentmanager.models import Student, Course, Assessment
 
 
@@ -224,6 +228,50 @@ class StudentManagerBuilder(MasonBuilder):
             Assessment.json_schema()
         )
 
+    def add_control_pagination(self, endpoint, page, **kwargs):
+        """
+        Adds the controls that point to the next and previous pages of a paginated collection
+            with GET method. Controls are only added if the corresponding page exists.
+            The page size, the ordering, the fieldset and the view of the current request are
+            kept.
+        :param endpoint: the endpoint name of the collection (e.g. 'api.studentcollection')
+        :param page: Page object returned by studentmanager.pagination.paginate
+        :param kwargs: additional values needed to build the URL of the endpoint
+        """
+        limit = request.args.get("limit")
+        kwargs.setdefault("sort", request.args.get("sort"))
+        kwargs.setdefault("fields", request.args.get("fields"))
+        kwargs.setdefault("view", request.args.get("view"))
+        if page.next_cursor is not None:
+            self.add_control(
+                "next",
+                url_for(endpoint, after=page.next_cursor, limit=limit, **kwargs),
+                method="GET",
+                title="The next page of the collection"
+            )
+        if page.prev_cursor is not None:
+            self.add_control(
+                "prev",
+                url_for(endpoint, before=page.prev_cursor, limit=limit, **kwargs),
+                method="GET",
+                title="The previous page of the collection"
+            )
+
+    def add_control_filter_assessments(self, href):
+        """
+        Adds a control to filter a collection of assessments with GET method. The control is an
+            URI template (RFC 6570) with the filters of Assessment.filter_schema as variables.
+        :param href: the URL of the collection
+        """
+        self.add_control(
+            f"{NAMESPACE}:filter-assessments",
+            href + "{?" + ",".join(Assessment.FILTERS) + "}",
+            method="GET",
+            isHrefTemplate=True,
+            title="Filter the assessments of the collection",
+            schema=Assessment.filter_schema()
+        )
+
     def add_control_get_student(self, student):
         """
         Adds a control to retrieve one student with GET method.
@@ -287,3 +335,55 @@ def create_error_response(status_code, title, message=None):
     body.add_error(title, message)
     body.add_control("profile", href=ERROR_PROFILE)
     return Response(json.dumps(body), status_code, mimetype=MASON)
+
+
+def wants_compact():
+    """
+    Negotiates the representation of a collection: the compact one is returned to the clients
+        preferring application/json to Mason in their Accept header, or asking for it with
+        view=compact. Mason is the default, and view=mason overrides the Accept header.
+    The routes using it must be cached with vary={'Accept': negotiated_view}.
+    :return: whether the compact representation has been requested
+    """
+    view = request.args.get("view")
+    if view is not None:
+        return view == COMPACT_VIEW
+    return request.accept_mimetypes.best_match([MASON, JSON]) == JSON
+
+
+def negotiated_view():
+    """
+    The part of the cache key depending on the Accept header, for the routes using
+        wants_compact: the representation it negotiates, rather than the header itself, so that
+        all the clients receiving the same representation share the same entry, whatever they
+        send (e.g. '*/*' or no Accept header at all)
+    :return: 'compact' or 'mason'
+    """
+    return COMPACT_VIEW if wants_compact() else MASON_VIEW
+
+
+def uri_template(endpoint, **variables):
+    """
+    Builds the URI template (RFC 6570) of the URLs of an endpoint
+    :param endpoint: the endpoint name, e.g. 'api.studentitem'
+    :param variables: the names of the template variables replacing the URL arguments of the
+        endpoint, e.g. student='student_id'
+    :return: the URI template, e.g. '/api/students/{student_id}/'
+    """
+    return unquote(url_for(endpoint, **{arg: f"{{{name}}}" for arg, name in variables.items()}))
+
+
+def compact_document(body, item_link):
+    """
+    Converts a collection into its compact representation: the items, which must be plain data
+        without controls, and the GET controls of the collection as links, e.g. 'next', plus the
+        'item' link, the URI template of the items replacing their 'self' controls
+    :param body: the collection built with StudentManagerBuilder
+    :param item_link: the URI template of the items (see uri_template)
+    :return: the compact document, to be encoded with fragments.encode_document(compact=True)
+    """
+    links = {"item": item_link}
+    for name, control in body.get("@controls", {}).items():
+        if control.get("method", "GET") == "GET":
+            links[name] = control["href"]
+    return {"items": body["items"], "links": links}
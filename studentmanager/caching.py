@@ -0,0 +1,1152 @@
+"""
+This module contains the decorator used to cache the responses of the GET methods of Resources,
+    and the functions used to invalidate them.
+Every cached response is tagged with the entities it depends on:
+ - 'students', 'courses' and 'assessments:all' for the collections of all the items
+ - 'student:<student_id>' and 'course:<course_id>' for everything derived from a single student
+    or course, including their assessments
+Each tag has a generation (see studentmanager.utils), which is part of the cache key of all the
+    responses carrying the tag: a write invalidates everything that depends on the modified
+    entities at once, by renewing the generations of their tags with invalidate_tags.
+The generations are the version of a response, so its ETag is derived from its key, without
+    hashing the body. Conditional requests (If-None-Match) are answered with 304 Not Modified
+    before the view is called, so they never serialize the resource nor query the database,
+    except 'If-None-Match: *', which only matches once the resource is known to exist.
+Responses are cached in a compact form (CachedResponse), with their body already encoded and,
+    for large bodies, compressed with gzip for the clients accepting it.
+TwoTierCache is the cache backend of the application: a bounded in-memory LRU tier in front of
+    the filesystem tier shared by all the workers.
+warm_cache fills the cache with the collections and the most accessed items, which are counted
+    by AccessCounter.
+Routes can be configured to serve stale responses while they are rebuilt in the background
+    (stale-while-revalidate), see cached_resource.
+Writes to the students and courses record their changes with record_changes, so that the
+    cached pages of the collections are patched instead of rebuilt.
+"""
+import contextlib
+import copy
+import functools
+import gzip
+import hashlib
+import json
+import logging
+import os
+import pickle
+import struct
+import tempfile
+import threading
+import time
+from collections import Counter, OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import quote, urlencode
+
+from flask import current_app, request, Response
+from flask_caching.backends import FileSystemCache
+from werkzeug.datastructures import Headers
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, where requests are only coalesced within a process
+    fcntl = None
+
+from studentmanager import cache
+from studentmanager.constants import \
+    CACHE_EVICTION_TARGET, CACHE_SWEEP_INTERVAL, CACHE_TOUCH_INTERVAL, CHANGELOG_SIZE, \
+    DEFAULT_CACHE_LIMITS, DEFAULT_CACHE_MEMORY_BYTES, GZIP_MIN_SIZE, MAX_CACHE_KEY_VARIANT_LENGTH, \
+    SINGLE_FLIGHT_TIMEOUT
+from studentmanager.pagination import get_page_size
+from studentmanager.utils import \
+    canonical_query_string, get_cache_generations, renew_cache_generations, \
+    replace_cache_generation
+
+ACCESS_COUNTS_KEY = "stats:access-counts"
+EVICTIONS_KEY = "stats:evictions"
+# set in the environ of the requests sent by the application itself to fill the cache
+CACHE_WARM_ENVIRON_KEY = "studentmanager.cache_warm"
+STALE_WARNING = '110 - "Response is Stale"'
+
+STUDENTS_TAG = "students"
+COURSES_TAG = "courses"
+ASSESSMENTS_TAG = "assessments:all"
+
+
+def student_tag(student_id):
+    """
+    :return: the tag of the responses depending on the student with the given id
+    """
+    return f"student:{student_id}"
+
+
+def course_tag(course_id):
+    """
+    :return: the tag of the responses depending on the course with the given id
+    """
+    return f"course:{course_id}"
+
+
+def assessment_tags(*assessments):
+    """
+    Returns the tags to invalidate when the given assessments are added, modified or deleted
+    :param assessments: assessment objects, or dictionaries with course_id and student_id
+    :return: a list of tags
+    """
+    tags = {ASSESSMENTS_TAG}
+    for assessment in assessments:
+        if isinstance(assessment, dict):
+            tags.add(student_tag(assessment["student_id"]))
+            tags.add(course_tag(assessment["course_id"]))
+        else:
+            tags.add(student_tag(assessment.student_id))
+            tags.add(course_tag(assessment.course_id))
+    return sorted(tags)
+
+
+def invalidate_tags(*tags):
+    """
+    Invalidates all the cached responses carrying any of the given tags, with a single cache
+        operation. The entries are not deleted, but they will not be reachable anymore since
+        their keys contain the previous generations.
+    :param tags: the tags to invalidate
+    """
+    renew_cache_generations(*tags)
+
+
+class CollectionChange(namedtuple("CollectionChange",
+                                  ["operation", "id_name", "item_id", "item"])):
+    """
+    A write to an item of a paginated collection, which can be applied to its cached pages
+    :param operation: 'create', 'update' or 'delete'
+    :param id_name: the name of the attribute identifying the items, e.g. 'student_id'
+    :param item_id: the identifier of the item
+    :param item: the representation of the item in the collection, None for 'delete'
+    """
+
+    __slots__ = ()
+
+    def apply(self, document):
+        """
+        Applies the change to a page of the collection, ordered by identifier. Created items have
+            the largest identifier, so they can only be added to the last page. Changes are
+            idempotent, since the page may have been built after the write.
+        :param document: the decoded page, modified in place
+        :return: False if the page cannot be patched, e.g. because items would move from the
+            next page, or if it is not a collection
+        """
+        items = document.get("items")
+        if items is None:
+            return False
+        controls = document.get("@controls", {})
+        index = next((i for i, item in enumerate(items)
+                      if item.get(self.id_name) == self.item_id), None)
+
+        if self.operation == "delete":
+            if index is None:
+                return True
+            # the cursors of the adjacent pages are built from the first and the last item
+            if "next" in controls or len(items) == 1 or (index == 0 and "prev" in controls):
+                return False
+            del items[index]
+            return True
+
+        if index is not None:
+            items[index] = self.item
+            return True
+        if self.operation == "update" or "next" in controls:
+            return True
+        if not items or len(items) >= get_page_size():
+            return False
+        items.append(self.item)
+        return True
+
+
+def _changelog_key(tag):
+    return f"changes:{tag}"
+
+
+def record_changes(tag, *changes):
+    """
+    Invalidates the responses carrying tag like invalidate_tags, recording the changes that
+        caused it in the changelog of the tag, which is shared by all the workers and keeps the
+        last CHANGELOG_SIZE generations. Routes decorated with cached_resource(patchable=True)
+        apply the changes to their latest entry instead of calling the view again.
+    Concurrent writers are serialized with the lock of TwoTierCache.single_flight, so that
+        every new generation is linked to the previous one.
+    :param tag: the tag to invalidate
+    :param changes: the CollectionChange objects applied by the write
+    """
+    with cache.cache.single_flight(_changelog_key(tag), timeout=None):
+        previous, generation = replace_cache_generation(tag)
+        changelog = (cache.get(_changelog_key(tag)) or [])[1 - CHANGELOG_SIZE:]
+        changelog.append((previous, generation, changes))
+        cache.set(_changelog_key(tag), changelog, timeout=0)
+
+
+def _recorded_changes(tag, previous, generation):
+    """
+    :return: the list of the changes recorded for tag from the previous to the current
+        generation, or None if some of them are not in the changelog
+    """
+    if previous == generation:
+        return []
+    links = {link[0]: link for link in cache.get(_changelog_key(tag)) or []}
+    changes = []
+    while previous != generation:
+        if previous not in links:
+            return None
+        _, previous, link_changes = links.pop(previous)
+        changes.extend(link_changes)
+    return changes
+
+
+def _patched_entry(cache_key, tags, etag):
+    """
+    Builds the entry of cache_key by applying the recorded changes to the latest entry built for
+        the same path and query string (see stale_key)
+    :param tags: the formatted tags of the response
+    :param etag: the ETag of the new entry
+    :return: the new entry, or None if the latest entry is missing or cannot be patched
+    """
+    pointer = cache.get(stale_key(cache_key))
+    if pointer is None:
+        return None
+    latest_key = pointer[0]
+    changes = []
+    for tag, previous, generation in zip(tags, latest_key.rsplit("#", 1)[1].split("."),
+                                         cache_key.rsplit("#", 1)[1].split(".")):
+        tag_changes = _recorded_changes(tag, previous, generation)
+        if tag_changes is None:
+            return None
+        changes.extend(tag_changes)
+
+    latest = cache.get(latest_key)
+    if latest is None:
+        return None
+    document = json.loads(latest.body)
+    if not all(change.apply(document) for change in changes):
+        return None
+    return CachedResponse.from_body(json.dumps(document).encode(), latest.mimetype, etag)
+
+
+def normalize_header(value):
+    """
+    Normalizes a header made of a comma separated list, such as Accept, whose order does not
+        matter: the elements are stripped, lowercased and sorted
+    :param value: the value of the header
+    :return: the normalized value
+    """
+    return ",".join(sorted(part.strip().lower() for part in value.split(",") if part.strip()))
+
+
+def request_cache_key(tags, vary=()):
+    """
+    Builds the cache key of the current request: the path, the variant and the current
+        generations of the tags, i.e. '<path>?<variant>#<generations>'.
+    The variant is the canonical query string (see canonical_query_string), so that every page
+        of a collection is cached separately, followed by the values of the request headers in
+        vary: the normalized headers, or what the response negotiates from them. Variants longer
+        than MAX_CACHE_KEY_VARIANT_LENGTH are replaced by their digest. All the variants of a
+        response carry the same generations, so they are all invalidated together.
+    :param tags: the tags of the response
+    :param vary: the names of the request headers the response depends on, e.g. ['Accept'], or
+        a dictionary mapping them to a function returning the value of the current request,
+        e.g. {'Accept': negotiated_view}
+    :return: a string which is the desired cache key
+    """
+    generations = get_cache_generations(tags)
+    variant = canonical_query_string(request.args)
+    if vary:
+        negotiators = vary if isinstance(vary, dict) else dict.fromkeys(vary)
+        headers = [(name.lower(), negotiate() if negotiate is not None
+                    else normalize_header(request.headers.get(name, "")))
+                   for name, negotiate in negotiators.items()]
+        variant += "|" + urlencode(headers, quote_via=quote)
+    if len(variant) > MAX_CACHE_KEY_VARIANT_LENGTH:
+        variant = "~" + hashlib.blake2b(variant.encode(), digest_size=16).hexdigest()
+    return f"{request.path}?{variant}#{'.'.join(generations)}"
+
+
+def stale_key(cache_key):
+    """
+    :param cache_key: the key returned by request_cache_key
+    :return: the key of the pointer to the latest entry built for the same path and variant,
+        whatever the generations
+    """
+    return "stale:" + cache_key.split("#", maxsplit=1)[0]
+
+
+def make_etag(cache_key):
+    """
+    Derives the strong ETag of a response from its cache key. The key changes whenever the
+        resource is invalidated, so two responses with the same ETag have the same body.
+    :param cache_key: the key returned by request_cache_key
+    :return: the (unquoted) ETag
+    """
+    return hashlib.blake2b(cache_key.encode(), digest_size=16).hexdigest()
+
+
+_RESPONSE_TEMPLATE = Response()
+
+
+def _response(body, headers):
+    """
+    Builds a 200 response. The constructor of Response sets and validates the headers one at a
+        time, which costs more than the rest of a cache hit, so the response is copied from a
+        template instead and gets its complete headers at once, as unpickling a Response does.
+    :param body: the encoded body
+    :param headers: list of (name, value) tuples, including Content-Type and Content-Length,
+        built by CachedResponse from values that do not need to be validated
+    :return: a Response object
+    """
+    # pylint: disable=protected-access
+    response = copy.copy(_RESPONSE_TEMPLATE)
+    response.headers = Headers()
+    response.headers._list = headers
+    response.response = [body]
+    # the callbacks registered with call_on_close must not be shared with the template
+    response._on_close = []
+    return response
+
+
+class CachedResponse(namedtuple("CachedResponse", ["body", "mimetype", "etag", "gzipped"])):
+    """
+    The compact form in which responses are cached: the encoded body, its gzip compressed
+        version (only for bodies of at least GZIP_MIN_SIZE bytes), the mimetype and the ETag.
+    Reading it from the cache is cheaper than unpickling a whole Response object, and it can
+        be shared by all the requests since it is immutable.
+    Both bodies are stored on the filesystem as well, so that no hit has to decompress the
+        body.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_response(cls, response, etag):
+        """
+        :param response: a successful Response returned by a view
+        :param etag: the ETag of the response
+        :return: the CachedResponse representing response
+        """
+        return cls.from_body(response.get_data(), response.mimetype, etag)
+
+    @classmethod
+    def from_body(cls, body, mimetype, etag):
+        """
+        :param body: the encoded body
+        :param mimetype: the mimetype of the body
+        :param etag: the ETag of the response
+        :return: the CachedResponse with the given body, compressing it if needed
+        """
+        gzipped = None
+        if len(body) >= GZIP_MIN_SIZE:
+            gzipped = gzip.compress(body, mtime=0)
+        return cls(body, mimetype, etag, gzipped)
+
+    def to_response(self, accept_gzip=False, vary=()):
+        """
+        Builds the response sent to the client, with all its headers at once (see _response)
+        :param accept_gzip: whether the client accepts gzip encoded responses
+        :param vary: the other request headers the response depends on
+        :return: a Response object
+        """
+        vary_header = ("Vary", ", ".join(["Accept-Encoding", *vary]))
+        if accept_gzip and self.gzipped is not None:
+            # a different encoding is a different representation, with a different ETag
+            return _response(self.gzipped, [
+                ("Content-Type", self.mimetype), ("Content-Length", str(len(self.gzipped))),
+                ("Content-Encoding", "gzip"), ("ETag", f'"{self.etag}-gzip"'), vary_header])
+        return _response(self.body, [
+            ("Content-Type", self.mimetype), ("Content-Length", str(len(self.body))),
+            ("ETag", f'"{self.etag}"'), vary_header])
+
+    @property
+    def size(self):
+        """
+        :return: the approximate number of bytes used by the entry
+        """
+        return len(self.body or b"") + len(self.gzipped or b"") \
+            + len(self.mimetype) + len(self.etag)
+
+
+class AccessCounter:
+    """
+    Counts the requests for the items (the resources with URL parameters) served by
+        cached_resource, to find the most accessed ones when warming the cache.
+    Counts are collected in memory and merged every flush_interval requests into the
+        ACCESS_COUNTS_KEY entry of the cache, shared by all the workers, which only keeps the
+        max_paths most accessed paths. Concurrent merges can lose a few counts, which is fine for
+        ranking the items.
+    """
+
+    def __init__(self, flush_interval=100, max_paths=1000):
+        self.flush_interval = flush_interval
+        self.max_paths = max_paths
+        self._counts = Counter()
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def record(self, path):
+        """
+        Counts a request for path, flushing the counts if needed
+        """
+        with self._lock:
+            self._counts[path] += 1
+            self._pending += 1
+            if self._pending < self.flush_interval:
+                return
+            counts, self._counts, self._pending = self._counts, Counter(), 0
+        self._merge(counts)
+
+    def flush(self):
+        """
+        Merges the counts collected by this worker into the cache
+        """
+        with self._lock:
+            counts, self._counts, self._pending = self._counts, Counter(), 0
+        if counts:
+            self._merge(counts)
+
+    def _merge(self, counts):
+        counts.update(cache.get(ACCESS_COUNTS_KEY) or {})
+        cache.set(ACCESS_COUNTS_KEY, dict(counts.most_common(self.max_paths)), timeout=0)
+
+    @staticmethod
+    def hot_paths(limit):
+        """
+        :param limit: the maximum number of paths to return
+        :return: the most accessed paths of all the workers, most accessed first
+        """
+        return [path for path, _ in Counter(cache.get(ACCESS_COUNTS_KEY) or {}).most_common(limit)]
+
+
+access_counter = AccessCounter()
+
+_revalidations = {}
+_revalidations_lock = threading.Lock()
+
+
+def _get_stale(cache_key, max_stale):
+    """
+    Finds the latest entry built for the same path and query string as cache_key. The time it
+        was first found stale is recorded in its pointer, which is shared by all the workers.
+    :param max_stale: the maximum number of seconds the entry can be served after it was
+        first found stale
+    :return: the stale entry and its age in seconds, or None and 0 if there is no stale entry
+        or it is too old
+    """
+    pointer = cache.get(stale_key(cache_key))
+    if pointer is None:
+        return None, 0
+    key, built_at, stale_since = pointer
+    now = time.time()
+    if stale_since is None:
+        stale_since = now
+        cache.set(stale_key(cache_key), (key, built_at, stale_since))
+    if now - stale_since > max_stale:
+        return None, 0
+    return cache.get(key), now - built_at
+
+
+def _revalidate(cache_key, vary):
+    """
+    Rebuilds the entry of the current request in a background thread, unless this worker is
+        already rebuilding it. The request is sent through the test client, as an internal
+        request which is never served stale, with the headers of the current request that are
+        part of the cache key, and at the same root URL (scheme, host and script root), so that
+        the rebuilt document has the same URLs.
+    :param cache_key: the key of the entry
+    :param vary: the names of the request headers the response depends on
+    """
+    app = current_app._get_current_object()  # pylint: disable=protected-access
+    path = request.full_path
+    base_url = request.url_root
+    headers = [(name, request.headers[name]) for name in vary if name in request.headers]
+
+    def _rebuild():
+        try:
+            app.test_client().get(path, base_url=base_url, headers=headers,
+                                  environ_base={CACHE_WARM_ENVIRON_KEY: True})
+        finally:
+            with _revalidations_lock:
+                del _revalidations[cache_key]
+
+    with _revalidations_lock:
+        if cache_key in _revalidations:
+            return
+        thread = _revalidations[cache_key] = threading.Thread(target=_rebuild, daemon=True)
+    thread.start()
+
+
+def _not_modified(etag, vary):
+    """
+    :param etag: the (unquoted) ETag of the current representation
+    :param vary: the other request headers the response depends on
+    :return: a 304 Not Modified response
+    """
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.vary.update(["Accept-Encoding", *vary])
+    return response
+
+
+def cached_resource(*tags, patchable=False, vary=()):
+    """
+    Decorator for the get methods of Resources, replacing cache.cached.
+    Successful responses are cached as CachedResponse objects, and carry an ETag. Requests whose
+        If-None-Match header matches the current ETag receive a 304 response.
+    On a miss, the response is built by a single request at a time (see
+        TwoTierCache.single_flight): concurrent requests for the same key wait for it and are
+        served from the cache.
+    Routes listed in the CACHE_MAX_STALENESS setting, which maps endpoint names to a number of
+        seconds, are served in stale-while-revalidate mode: when their entry has been
+        invalidated, the latest one is served, with the Age and Warning headers, while it is
+        rebuilt in the background, for at most that number of seconds after it was first found
+        stale. Requests with 'Cache-Control: no-cache' are never served stale.
+    :param tags: the tags of the responses. They can refer to the arguments of the view, which
+        are formatted into them, e.g. 'student:{student.student_id}'
+    :param patchable: True for paginated collections, whose invalidated pages are patched with
+        the changes recorded by record_changes, if possible, instead of calling the view. It can
+        also be a function telling whether the current request can be patched, e.g. only when
+        the collection is ordered by identifier and has whole items, as CollectionChange expects
+    :param vary: the names of the request headers the responses depend on, which are part of
+        the cache key (see request_cache_key) and of the Vary header. Accept-Encoding is not
+        needed, since every entry contains both the encoded and the compressed body. Routes
+        negotiating their representation map the header to the negotiated value instead, so
+        that the clients receiving the same representation share the same entry
+    Streamed responses, e.g. of whole collections, are returned as they are, with their ETag,
+        without being cached.
+    """
+
+    def decorator(func):
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if kwargs and not request.environ.get(CACHE_WARM_ENVIRON_KEY):
+                access_counter.record(request.path)
+
+            patched = patchable() if callable(patchable) else patchable
+            formatted_tags = [tag.format(**kwargs) for tag in tags]
+            cache_key = request_cache_key(formatted_tags, vary)
+            etag = make_etag(cache_key)
+
+            # 'If-None-Match: *' only matches existing resources, it is answered once the
+            # response has been found or built
+            if not request.if_none_match.star_tag:
+                for current_etag in (etag, f"{etag}-gzip"):
+                    if request.if_none_match.contains_weak(current_etag):
+                        return _not_modified(current_etag, vary)
+
+            entry = cache.get(cache_key)
+            accept_gzip = request.accept_encodings.quality("gzip") > 0
+            max_stale = current_app.config["CACHE_MAX_STALENESS"].get(request.endpoint, 0)
+            if entry is None and max_stale and not request.environ.get(CACHE_WARM_ENVIRON_KEY) \
+                    and not request.cache_control.no_cache:
+                stale, age = _get_stale(cache_key, max_stale)
+                if stale is not None:
+                    _revalidate(cache_key, vary)
+                    response = stale.to_response(accept_gzip=accept_gzip, vary=vary)
+                    response.headers.add("Age", str(int(age)))
+                    response.headers.add("Warning", STALE_WARNING)
+                    return response
+
+            if entry is None:
+                with cache.cache.single_flight(cache_key) as waited:
+                    # the entry may have been built by the request that was waited for
+                    entry = cache.get(cache_key) if waited else None
+                    if entry is None:
+                        if patched:
+                            entry = _patched_entry(cache_key, formatted_tags, etag)
+                        if entry is None:
+                            response = func(*args, **kwargs)
+                            if response.status_code != 200:
+                                return response
+                            if response.is_streamed:
+                                # too large to be cached, but valid as long as the
+                                # generations of the tags are unchanged
+                                response.set_etag(etag)
+                                response.vary.update(vary)
+                                return response
+                            entry = CachedResponse.from_response(response, etag)
+                        cache.set(cache_key, entry)
+                        if max_stale or patched:
+                            cache.set(stale_key(cache_key), (cache_key, time.time(), None))
+            if request.if_none_match.star_tag:
+                gzipped = accept_gzip and entry.gzipped is not None
+                return _not_modified(f"{entry.etag}-gzip" if gzipped else entry.etag, vary)
+            return entry.to_response(accept_gzip=accept_gzip, vary=vary)
+
+        return wrapper
+
+    return decorator
+
+
+class CacheFamily:
+    """
+    The limits of the cached responses of a family of routes, i.e. of the paths starting with
+        prefix, and the counters of this worker for them, which are guarded by the lock of the
+        TwoTierCache, like the decision to sweep the family.
+    The entries of a family are stored in files whose name starts with slug, so that they can
+        be found without reading them.
+    """
+
+    POLICIES = ("lru", "lfu")
+
+    def __init__(self, prefix, max_entries=None, max_bytes=None, ttl=None, policy="lru"):
+        """
+        :param prefix: the prefix of the paths of the family, e.g. '/api/assessments/'
+        :param max_entries: the maximum number of entries in the filesystem tier, or None
+        :param max_bytes: the maximum size of the entries in the filesystem tier, or None
+        :param ttl: the timeout of the entries in seconds, None for the default of the cache
+        :param policy: 'lru' to evict the least recently used entries first, 'lfu' for the
+            least frequently used ones
+        :raise ValueError: if the policy is not known
+        """
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown eviction policy '{policy}'")
+        self.prefix = prefix
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.policy = policy
+        self.slug = hashlib.blake2b(prefix.encode(), digest_size=4).hexdigest()
+        # occupancy at the last sweep, plus the entries set since then by this worker
+        self.entries = 0
+        self.bytes = 0
+        self.pending = 0
+        self.sweeping = False
+        self.hits = 0
+        self.misses = 0
+
+    def over_limits(self, margin=1.0):
+        """
+        :param margin: the fraction of the limits to compare with
+        :return: whether the estimated occupancy exceeds the limits
+        """
+        return (self.max_entries is not None and self.entries > self.max_entries * margin) \
+            or (self.max_bytes is not None and self.bytes > self.max_bytes * margin)
+
+
+class TwoTierCache(FileSystemCache):
+    """
+    Cache backend keeping the most recently used entries in memory, in front of the filesystem
+        cache. The memory tier is bounded by the size of the entries (CACHE_MEMORY_BYTES, 0
+        disables it) and is private to each worker. CachedResponse entries are immutable and
+        are kept as they are, any other value is pickled so that every hit gets its own copy.
+    Entries are kept in memory only if their key is versioned, i.e. it contains the generations
+        it was built with: such an entry is never modified, only replaced by an entry with a new
+        key, so the memory tier is coherent with the other workers as long as the generations
+        are always read from the filesystem tier. Generations themselves, and the other shared
+        mutable values such as the access counts, the pointers to the stale entries and the
+        changelogs, bypass the memory tier.
+    Hits and misses of both tiers are counted, see stats.
+    Concurrent misses of the same key are coalesced by single_flight.
+    The memory tier also keeps the fragments of the documents, see get_fragments.
+    The responses in the filesystem tier are grouped in families of routes (CACHE_LIMITS, see
+        CacheFamily), each with its own timeout, maximum number of entries and bytes, and
+        eviction policy. Every worker counts the entries it stores, and scans the files of a
+        family every CACHE_SWEEP_INTERVAL new entries or when its estimate exceeds the limits,
+        evicting expired entries and then, according to the policy, the least recently (the
+        modification time of the files, updated on hits) or frequently (counted by each worker)
+        used ones. The threshold of the filesystem cache, which evicts arbitrary entries
+        including the generations, is meant to be disabled.
+    """
+
+    UNVERSIONED_PREFIXES = ("generation:", "stats:", "stale:", "changes:")
+
+    def __init__(self, cache_dir, memory_bytes=DEFAULT_CACHE_MEMORY_BYTES, limits=None,
+                 **kwargs):
+        # longest prefixes first; needed by _get_filename, which is used by the parent
+        self.families = sorted(
+            (CacheFamily(prefix, **family) for prefix, family in (limits or {}).items()),
+            key=lambda family: len(family.prefix), reverse=True)
+        self._usage = {}
+        super().__init__(cache_dir, **kwargs)
+        self.memory_bytes = memory_bytes
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        self._lock = threading.Lock()
+        # the locks of the keys being built by this worker, with their number of users
+        self._key_locks = {}
+        self._counters = dict.fromkeys(
+            ["memory_hits", "memory_misses", "file_hits", "file_misses", "fragment_hits",
+             "fragment_misses", "single_flight_waits"], 0)
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        kwargs["memory_bytes"] = config.get("CACHE_MEMORY_BYTES", DEFAULT_CACHE_MEMORY_BYTES)
+        kwargs["limits"] = config.get("CACHE_LIMITS", DEFAULT_CACHE_LIMITS)
+        return super().factory(app, config, args, kwargs)
+
+    def family(self, key):
+        """
+        :param key: a cache key, possibly the pointer to a stale entry
+        :return: the CacheFamily of the key, or None if it does not belong to any
+        """
+        path = key[len("stale:"):] if key.startswith("stale:") else key
+        for family in self.families:
+            if path.startswith(family.prefix):
+                return family
+        return None
+
+    def _get_filename(self, key):
+        family = self.family(key)
+        filename = super()._get_filename(key)
+        if family is None:
+            return filename
+        directory, name = os.path.split(filename)
+        return os.path.join(directory, f"{family.slug}-{name}")
+
+    def _record_use(self, family, key, hit):
+        """
+        Counts a hit or a miss of family. Hits update the usage of the entry: its frequency,
+            and the modification time of its file, at most every CACHE_TOUCH_INTERVAL seconds
+        """
+        if not hit:
+            with self._lock:
+                family.misses += 1
+            return
+        filename = self._get_filename(key)
+        now = time.time()
+        with self._lock:
+            family.hits += 1
+            usage = self._usage.setdefault(filename, [0, now])
+            usage[0] += 1
+            touch = now - usage[1] > CACHE_TOUCH_INTERVAL
+            if touch:
+                usage[1] = now
+        if touch:
+            with contextlib.suppress(OSError):
+                os.utime(filename)
+
+    def _scan(self, family):
+        """
+        :return: a list of (filename, size, modification time) tuples, with the files of family
+        """
+        files = []
+        with os.scandir(self._path) as entries:
+            for entry in entries:
+                if entry.name.startswith(family.slug + "-"):
+                    with contextlib.suppress(FileNotFoundError):
+                        stat = entry.stat()
+                        files.append((entry.path, stat.st_size, stat.st_mtime))
+        return files
+
+    def _expired(self, filename, now):
+        with contextlib.suppress(OSError, struct.error):
+            with open(filename, "rb") as file:
+                expires = struct.unpack("I", file.read(4))[0]
+            return expires != 0 and expires < now
+        return False
+
+    def _sweep(self, family, keep=None):
+        """
+        Updates the occupancy of family, evicting entries if it exceeds the limits, until it
+            is below CACHE_EVICTION_TARGET times the limits
+        :param keep: the file of the entry being stored, which is never evicted
+        """
+        with self._lock:
+            # the entries stored during the scan are added to it, possibly counted twice
+            family.entries = family.bytes = family.pending = 0
+        files = self._scan(family)
+        present = {f[0] for f in files}
+        prefix = os.path.join(self._path, family.slug + "-")
+        with self._lock:
+            family.entries += len(files)
+            family.bytes += sum(f[1] for f in files)
+            # forgets the entries removed in the meantime, e.g. by other workers
+            for filename in [f for f in self._usage if f.startswith(prefix) and f not in present]:
+                del self._usage[filename]
+            over_limits = family.over_limits()
+        if not over_limits:
+            return
+
+        now = time.time()
+        with self._lock:
+            frequencies = {filename: usage[0] for filename, usage in self._usage.items()}
+        if family.policy == "lfu":
+            files.sort(key=lambda f: (not self._expired(f[0], now),
+                                      frequencies.get(f[0], 0), f[2]))
+        else:
+            files.sort(key=lambda f: (not self._expired(f[0], now), f[2]))
+
+        evicted = 0
+        for filename, size, _ in files:
+            with self._lock:
+                if not family.over_limits(CACHE_EVICTION_TARGET):
+                    break
+            if filename == keep:
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(filename)
+                evicted += 1
+            with self._lock:
+                family.entries -= 1
+                family.bytes -= size
+                self._usage.pop(filename, None)
+
+        if evicted:
+            # shared by all the workers, concurrent sweeps can lose a few counts
+            evictions = super().get(EVICTIONS_KEY) or {}
+            evictions[family.prefix] = evictions.get(family.prefix, 0) + evicted
+            super().set(EVICTIONS_KEY, evictions, timeout=0)
+
+    def _stored(self, family, key, size):
+        """
+        Counts a new entry of family, which is also its first use, sweeping the family if needed
+        :param size: the approximate size of the entry
+        """
+        filename = self._get_filename(key)
+        with self._lock:
+            self._usage.setdefault(filename, [0, time.time()])[0] += 1
+            family.entries += 1
+            family.bytes += size
+            family.pending += 1
+            sweep = not family.sweeping and (family.over_limits()
+                                             or family.pending >= CACHE_SWEEP_INTERVAL)
+            family.sweeping = family.sweeping or sweep
+        if sweep:
+            try:
+                self._sweep(family, keep=filename)
+            finally:
+                with self._lock:
+                    family.sweeping = False
+
+    def family_stats(self):
+        """
+        Returns the occupancy of every family, scanning the filesystem tier, with the evictions
+            of all the workers, and the hits and misses of this worker
+        :return: a list of dictionaries, one for each family
+        """
+        evictions = super().get(EVICTIONS_KEY) or {}
+        result = []
+        for family in self.families:
+            files = self._scan(family)
+            with self._lock:
+                hits, misses = family.hits, family.misses
+            result.append({
+                "prefix": family.prefix,
+                "policy": family.policy,
+                "max_entries": family.max_entries,
+                "max_bytes": family.max_bytes,
+                "ttl": family.ttl,
+                "entries": len(files),
+                "bytes": sum(f[1] for f in files),
+                "evictions": evictions.get(family.prefix, 0),
+                "hits": hits,
+                "misses": misses,
+                "hit_ratio": round(hits / (hits + misses), 4) if hits + misses else None
+            })
+        return result
+
+    def _versioned(self, key):
+        # the file counter of the filesystem tier is a management element, not an entry
+        return self.memory_bytes > 0 and key != self._fs_count_file \
+            and not key.startswith(self.UNVERSIONED_PREFIXES)
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def _memory_get(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            expires, stored, _ = entry
+            if expires and expires < time.time():
+                self._memory_pop(key)
+                return None
+            self._memory.move_to_end(key)
+        return stored
+
+    def _memory_set(self, key, value, timeout):
+        if isinstance(value, CachedResponse):
+            stored, size = value, value.size
+        elif isinstance(value, str):
+            # fragments, see get_fragments
+            stored, size = value, len(value)
+        else:
+            stored = pickle.dumps(value)
+            size = len(stored)
+        if size > self.memory_bytes:
+            return
+        # the filesystem cache normalizes the timeout into an absolute expiry time, 0 for never
+        expires = self._normalize_timeout(timeout)
+        with self._lock:
+            self._memory_pop(key)
+            self._memory[key] = (expires, stored, size)
+            self._memory_used += size
+            while self._memory_used > self.memory_bytes:
+                self._memory_pop(next(iter(self._memory)))
+
+    def _memory_pop(self, key):
+        # must be called holding the lock
+        entry = self._memory.pop(key, None)
+        if entry is not None:
+            self._memory_used -= entry[2]
+
+    def get(self, key):
+        # only the responses are counted, not the other values of their family
+        family = None if key.startswith(self.UNVERSIONED_PREFIXES) else self.family(key)
+        if not self._versioned(key):
+            value = self._file_get(key)
+            if family is not None:
+                self._record_use(family, key, value is not None)
+            return value
+
+        stored = self._memory_get(key)
+        if stored is not None:
+            self._count("memory_hits")
+            if family is not None:
+                self._record_use(family, key, True)
+            return pickle.loads(stored) if isinstance(stored, bytes) else stored
+        self._count("memory_misses")
+
+        value = self._file_get(key)
+        if family is not None:
+            self._record_use(family, key, value is not None)
+        if value is None:
+            self._count("file_misses")
+            return None
+        self._count("file_hits")
+        # the remaining lifetime in the filesystem tier is not known, the entry is immutable
+        # anyway so it is kept for a full timeout
+        self._memory_set(key, value, None if family is None else family.ttl)
+        return value
+
+    def _file_get(self, key):
+        """
+        Reads an entry of the filesystem tier like FileSystemCache.get, but reads the whole file
+            at once instead of unpickling it from the stream, which is about twice as fast for
+            the size of the responses
+        :return: the entry, or None if it is missing or expired
+        """
+        filename = self._get_filename(key)
+        try:
+            with self._safe_stream_open(filename, "rb") as file:
+                data = file.read()
+            expires, = struct.unpack_from("I", data)
+            if expires == 0 or expires >= time.time():
+                return self.serializer.loads(memoryview(data)[4:])
+        except FileNotFoundError:
+            pass
+        except (OSError, EOFError, struct.error):
+            logging.warning("Exception raised while handling cache file '%s'", filename,
+                            exc_info=True)
+        return None
+
+    def set(self, key, value, timeout=None, mgmt_element=False):
+        family = None if mgmt_element else self.family(key)
+        if timeout is None and family is not None:
+            timeout = family.ttl
+        result = super().set(key, value, timeout, mgmt_element)
+        if result and not mgmt_element and self._versioned(key):
+            self._memory_set(key, value, timeout)
+        if result and family is not None:
+            self._stored(family, key, value.size if isinstance(value, CachedResponse) else 0)
+        return result
+
+    def add(self, key, value, timeout=None):
+        """
+        Stores value only if key is not in the cache. Unlike in the filesystem cache, where the
+            check and the write are separate, this is atomic across the workers: the file is
+            written aside and then linked to its name, which fails if the name exists, so that
+            concurrent callers all see the value stored by the first one.
+        :return: whether value has been stored
+        """
+        family = self.family(key)
+        if timeout is None and family is not None:
+            timeout = family.ttl
+        fd, tmp = tempfile.mkstemp(suffix=self._fs_transaction_suffix, dir=self._path)
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(struct.pack("I", self._normalize_timeout(timeout)))
+                self.serializer.dump(value, file)
+            os.link(tmp, self._get_filename(key))
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp)
+        self._update_count(delta=1)
+        if self._versioned(key):
+            self._memory_set(key, value, timeout)
+        if family is not None:
+            self._stored(family, key, value.size if isinstance(value, CachedResponse) else 0)
+        return True
+
+    def delete(self, key, mgmt_element=False):
+        with self._lock:
+            self._memory_pop(key)
+        return super().delete(key, mgmt_element)
+
+    def has(self, key):
+        return self._memory_get(key) is not None or super().has(key)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_used = 0
+        return super().clear()
+
+    def get_fragments(self, keys):
+        """
+        Reads fragments (see studentmanager.fragments) from the memory tier. Fragments are never
+            stored on the filesystem: they are cheap to rebuild, and a page has too many of them
+            to read one file each.
+        :param keys: list of the keys of the fragments
+        :return: a list with the fragments, None for the missing ones
+        """
+        fragments = [self._memory_get(key) for key in keys]
+        misses = fragments.count(None)
+        with self._lock:
+            self._counters["fragment_hits"] += len(fragments) - misses
+            self._counters["fragment_misses"] += misses
+        return fragments
+
+    def set_fragments(self, mapping):
+        """
+        Stores fragments in the memory tier, if enabled
+        :param mapping: dictionary from the keys to the fragments, which are strings
+        """
+        if self.memory_bytes > 0:
+            for key, fragment in mapping.items():
+                self._memory_set(key, fragment, None)
+
+    @contextlib.contextmanager
+    def single_flight(self, key, timeout=SINGLE_FLIGHT_TIMEOUT):
+        """
+        Context manager held while building the entry of key, so that only one request at a time
+            builds it: other threads wait on a lock of the key, and other processes on a file
+            lock in the cache directory, named after the digest of the key, so that misses of
+            different keys never wait for each other. The lock files are named as management
+            files, which are ignored by the filesystem cache, and are deleted when released.
+        After timeout seconds of waiting the entry is built anyway, so that a slow request cannot
+            block the others indefinitely. With a timeout of None the lock is always acquired.
+        :param key: the cache key of the entry
+        :param timeout: maximum number of seconds to wait, or None
+        :return: a context manager whose value is True if another request held the lock, i.e. if
+            the cache should be read again before building the entry
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            thread_lock, users = self._key_locks.get(key, (None, 0))
+            if thread_lock is None:
+                thread_lock = threading.Lock()
+            self._key_locks[key] = (thread_lock, users + 1)
+        acquired = thread_lock.acquire(blocking=False)
+        waited = not acquired
+        if waited:
+            acquired = thread_lock.acquire(timeout=-1 if timeout is None else timeout)
+
+        lock_file = None
+        try:
+            if acquired and fcntl is not None:
+                digest = hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+                lock_file, file_waited = self._lock_file(
+                    os.path.join(self._path, f"lock-{digest}{self._fs_transaction_suffix}"),
+                    deadline)
+                waited = waited or file_waited
+            if waited:
+                self._count("single_flight_waits")
+            yield waited
+        finally:
+            if lock_file is not None:
+                # deleted while locked: the processes waiting for it will lock a new file
+                os.remove(lock_file.name)
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+            if acquired:
+                thread_lock.release()
+            with self._lock:
+                thread_lock, users = self._key_locks[key]
+                if users == 1:
+                    del self._key_locks[key]
+                else:
+                    self._key_locks[key] = (thread_lock, users - 1)
+
+    @staticmethod
+    def _lock_file(path, deadline):
+        """
+        Locks the file at path, creating it if needed, polling until deadline (forever if None).
+        The file may be deleted by the process holding the lock when it releases it, in which
+            case the lock is taken again on the new file.
+        :return: the locked file, or None if it could not be locked in time, and whether the lock
+            was held by another process
+        """
+        waited = False
+        while True:
+            lock_file = open(path, "ab")  # pylint: disable=consider-using-with
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    waited = True
+                    if deadline is not None and time.monotonic() >= deadline:
+                        lock_file.close()
+                        return None, waited
+                    time.sleep(0.005)
+            try:
+                if os.path.samestat(os.fstat(lock_file.fileno()), os.stat(path)):
+                    return lock_file, waited
+            except FileNotFoundError:
+                pass
+            # the file was deleted while waiting
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+    def stats(self):
+        """
+        Returns the counters of the cache, collected since the worker started
+        :return: a dictionary with the hits and misses of both tiers, and the number of entries
+            and bytes in the memory tier
+        """
+        with self._lock:
+            return dict(self._counters,
+                        memory_entries=len(self._memory),
+                        memory_bytes=self._memory_used,
+                        memory_budget=self.memory_bytes)
+
+
+def warm_cache(app, hot_items=100, workers=4, echo=print, base_url=None):
+    """
+    Fills the cache of app by requesting, through the test client, first the collections
+        registered in the api blueprint and then the most accessed items (see AccessCounter).
+    Requests are sent by a pool of workers threads. These requests are not counted as accesses.
+    They have no Accept header, so the default representation of the collections is warmed,
+        which is the one shared by all the clients not asking for another one (see
+        builder.negotiated_view).
+    :param app: the Flask app
+    :param hot_items: the maximum number of items to request
+    :param workers: the number of threads sending the requests
+    :param echo: function called with a progress message after every request
+    :param base_url: the root URL the application is served at, e.g.
+        'https://example.com/studentmanager/', so that the documents contain the same URLs as
+        for the clients. Defaults to the CACHE_WARM_BASE_URL setting, and then to the one built
+        by the test client from SERVER_NAME and APPLICATION_ROOT
+    :return: a list of (path, status code, elapsed seconds) tuples, in completion order
+    """
+    base_url = base_url or app.config.get("CACHE_WARM_BASE_URL")
+    collections = sorted(rule.rule for rule in app.url_map.iter_rules()
+                         if rule.endpoint.startswith("api.") and "GET" in rule.methods
+                         and not rule.arguments)
+    with app.app_context():
+        items = AccessCounter.hot_paths(hot_items) if hot_items > 0 else []
+
+    total = len(collections) + len(items)
+    results = []
+
+    def _warm(path):
+        start = time.perf_counter()
+        response = app.test_client().get(path, base_url=base_url,
+                                         environ_base={CACHE_WARM_ENVIRON_KEY: True})
+        return path, response.status_code, time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # the collections are the most expensive documents, so they are warmed first
+        for paths in (collections, items):
+            for future in as_completed([executor.submit(_warm, path) for path in paths]):
+                path, status, elapsed = future.result()
+                results.append((path, status, elapsed))
+                echo(f"[{len(results)}/{total}] {path} {status} {elapsed * 1000:.1f} ms")
+    return results
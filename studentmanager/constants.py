@@ -3,6 +3,10 @@ This module contains constants used by our API
 """
 
 MASON = "application/vnd.mason+json"
+# the compact representation of the collections, without hypermedia controls
+JSON = "application/json"
+COMPACT_VIEW = "compact"
+MASON_VIEW = "mason"
 
 STUDENT_PROFILE = "/profiles/student/"
 COURSE_PROFILE = "/profiles/course/"
@@ -17,3 +21,27 @@ DOC_FOLDER = "/studentmanager/doc/"
 
 PICTURE_FOLDER = "/studentmanager/static/pictures/"
 PROFILE_PICTURE_MIMETYPE = "application/vnd.mason+jpeg"
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# limit of the requests for whole collections, which are streamed
+UNPAGINATED_LIMIT = "all"
+STREAM_BATCH_SIZE = 500
+
+NDJSON = "application/x-ndjson"
+BATCH_CHUNK_SIZE = 500
+
+DEFAULT_CACHE_MEMORY_BYTES = 64 * 1024 * 1024
+GZIP_MIN_SIZE = 1024
+SINGLE_FLIGHT_TIMEOUT = 10
+MAX_CACHE_KEY_VARIANT_LENGTH = 200
+CHANGELOG_SIZE = 100
+
+# limits of the cached responses of each family of routes, see studentmanager.caching.CacheFamily
+DEFAULT_CACHE_LIMITS = {
+    prefix: {"max_entries": 10000, "max_bytes": 256 * 1024 * 1024, "ttl": None, "policy": "lru"}
+    for prefix in ["/api/students/", "/api/courses/", "/api/assessments/"]
+}
+CACHE_SWEEP_INTERVAL = 100
+CACHE_EVICTION_TARGET = 0.9
+CACHE_TOUCH_INTERVAL = 60
@@ -0,0 +1,73 @@
+"""
+This module contains the helpers used to serve sparse fieldsets: with the 'fields' query
+    parameter, clients select the attributes of the representations they need, e.g.
+    '?fields=last_name,first_name'. The identifier of the entities is always included.
+Only the selected columns are loaded from the database (see load_options) and serialized, and
+    the controls of the entities are only included if '@controls' is selected as well. The
+    controls of the collections, e.g. the pagination ones, are always included.
+"""
+from flask import request
+from sqlalchemy.orm import load_only
+
+CONTROLS_FIELD = "@controls"
+
+
+def get_fieldset(model, extra=()):
+    """
+    Reads the 'fields' query parameter of the current request, a comma separated list of names
+    :param model: the Model class of the representation, whose FIELDS can be selected
+    :param extra: the names of the other parts of the representation that can be selected,
+        e.g. 'assessments'
+    :return: the set of the selected names, including the primary key, or None if the parameter
+        is missing
+    :raise ValueError: if any of the names is not known
+    """
+    value = request.args.get("fields")
+    if value is None:
+        return None
+    fields = set(value.split(","))
+    if not fields <= set(model.FIELDS) | set(extra) | {CONTROLS_FIELD}:
+        raise ValueError("Invalid fields")
+    return fields | {column.key for column in model.__mapper__.primary_key}
+
+
+def has_all_fields():
+    """
+    :return: whether the current request asks for the whole representations, without 'fields'
+    """
+    return "fields" not in request.args
+
+
+def has_controls(fields):
+    """
+    :param fields: the fieldset returned by get_fieldset
+    :return: whether the controls of the entities must be included
+    """
+    return fields is None or CONTROLS_FIELD in fields
+
+
+def load_options(model, fields, columns=()):
+    """
+    :param model: the Model class of the query
+    :param fields: the fieldset returned by get_fieldset
+    :param columns: the other columns the view reads, e.g. the ones the collection is ordered on
+    :return: the loader options of a query of model loading only the columns needed for fields,
+        to be passed to Query.options
+    """
+    if fields is None:
+        return []
+    names = {name for name in model.FIELDS if name in fields}
+    names.update(column.key for column in columns)
+    return [load_only(*[getattr(model, name) for name in sorted(names)])]
+
+
+def fieldset_kind(kind, fields):
+    """
+    :param kind: the name of a representation, e.g. 'student-item'
+    :param fields: the fieldset returned by get_fieldset
+    :return: the name of the representation restricted to fields, e.g. to be used as the kind of
+        its fragments (see fragments.get_fragments)
+    """
+    if fields is None:
+        return kind
+    return f"{kind}[{','.join(sorted(fields))}]"
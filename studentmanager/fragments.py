@@ -0,0 +1,122 @@
+"""
+This module contains the fragment cache: the encoded JSON representations of single entities,
+    e.g. the items of a collection with their controls, which are joined to build the documents
+    containing them instead of serializing every entity again.
+Fragments are keyed by the kind of representation and by the values of all the columns of the
+    entity, i.e. its identity and version: a modified entity gets a new fragment, so fragments
+    never need to be invalidated, and only the modified entities are serialized again.
+Documents are encoded with encode_document, which joins the fragments of their lists, or
+    streamed with stream_document, when their list is too long to be kept in memory. Both can
+    encode compact documents, without whitespace, from compact fragments.
+Fragments are kept in the memory tier of TwoTierCache (see TwoTierCache.get_fragments), where
+    the least recently used ones are evicted.
+"""
+import hashlib
+import json
+import secrets
+
+from flask import request
+from sqlalchemy import inspect
+
+from studentmanager import cache
+from studentmanager.constants import STREAM_BATCH_SIZE
+
+
+# separators of json.dumps, by default and in compact documents
+SEPARATORS = (", ", ": ")
+COMPACT_SEPARATORS = (",", ":")
+
+
+class FragmentList(list):
+    """
+    A list of encoded JSON fragments, inserted as they are in the document by encode_document
+    """
+
+
+def fragment_key(kind, row):
+    """
+    :param kind: the name of the representation, e.g. 'student-item'
+    :param row: the database instance
+    :return: the key of the fragment of row. The script root is part of it since the
+        representations contain URLs. Only the columns that have been loaded are read, e.g.
+        for sparse fieldsets, whose kind must tell them apart from the full representation
+    """
+    unloaded = inspect(row).unloaded
+    values = tuple(getattr(row, column.key) for column in row.__table__.columns
+                   if column.key not in unloaded)
+    digest = hashlib.blake2b(repr(values).encode(), digest_size=16).hexdigest()
+    return f"fragment:{request.script_root}:{kind}:{digest}"
+
+
+def get_fragments(kind, rows, build, compact=False):
+    """
+    Returns the fragments of rows, building and caching the missing ones
+    :param kind: the name of the representation built by build, e.g. 'student-item'
+    :param rows: the database instances
+    :param build: function returning the JSON serializable representation of a row
+    :param compact: True to encode the fragments without whitespace, which are cached apart
+    :return: a FragmentList, in the same order as rows
+    """
+    if compact:
+        kind += ":compact"
+    separators = COMPACT_SEPARATORS if compact else SEPARATORS
+    keys = [fragment_key(kind, row) for row in rows]
+    encoded = cache.cache.get_fragments(keys)
+    missing = {}
+    for index, row in enumerate(rows):
+        if encoded[index] is None:
+            encoded[index] = missing[keys[index]] = \
+                json.dumps(build(row), separators=separators)
+    if missing:
+        cache.cache.set_fragments(missing)
+    return FragmentList(encoded)
+
+
+def encode_document(document, compact=False):
+    """
+    Encodes document like json.dumps, joining the FragmentList values of its top level keys.
+        The result is the same as encoding the decoded fragments.
+    :param document: a dictionary, e.g. a StudentManagerBuilder
+    :param compact: True to encode the document without whitespace, as its fragments
+    :return: the encoded document
+    """
+    separators = COMPACT_SEPARATORS if compact else SEPARATORS
+    shallow = dict(document)
+    joined = {}
+    for key, value in document.items():
+        if isinstance(value, FragmentList):
+            # random, so that it cannot be found in the data
+            placeholder = f"\x00{secrets.token_hex(8)}"
+            shallow[key] = placeholder
+            joined[json.dumps(placeholder)] = "[" + separators[0].join(value) + "]"
+    encoded = json.dumps(shallow, separators=separators)
+    for placeholder, value in joined.items():
+        encoded = encoded.replace(placeholder, value, 1)
+    return encoded
+
+
+def stream_document(document, key, fragments, compact=False):
+    """
+    Encodes document like encode_document, but incrementally, with the list of key replaced by
+        the given fragments, which are consumed as they are produced.
+    The envelope of the document is returned first, before any fragment is consumed, and then
+        the fragments are returned in chunks of STREAM_BATCH_SIZE.
+    :param document: a dictionary, e.g. a StudentManagerBuilder
+    :param key: the top level key of the list
+    :param fragments: an iterable of encoded JSON fragments, e.g. a generator
+    :param compact: True to encode the document without whitespace, as its fragments
+    :return: a generator of the encoded parts of the document
+    """
+    separators = COMPACT_SEPARATORS if compact else SEPARATORS
+    shallow = dict(document)
+    placeholder = f"\x00{secrets.token_hex(8)}"
+    shallow[key] = placeholder
+    head, tail = json.dumps(shallow, separators=separators).split(json.dumps(placeholder), 1)
+    yield head + "["
+    chunk = []
+    for index, fragment in enumerate(fragments):
+        chunk.append(fragment if index == 0 else separators[0] + fragment)
+        if len(chunk) == STREAM_BATCH_SIZE:
+            yield "".join(chunk)
+            chunk = []
+    yield "".join(chunk) + "]" + tail
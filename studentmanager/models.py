@@ -6,25 +6,35 @@ The classes are:
  - Student
  - Course
  - ApiKey
-The functions are responsible for initiliazing and populating the database, generating the
-    admin key, and running the tests
+ - ApiKeyIndex, the in-memory copy of the API keys used to authenticate requests
+The functions are responsible for initiliazing and populating the database (with a few test rows,
+    or with large synthetic datasets for load testing), warming the cache, generating the admin
+    key, and running the tests
 """
 import datetime
+import functools
 import hashlib
+import itertools
+import math
+import random
 import secrets
 
 import click
 import pytest
 import yaml
-from flask import request
+from flask import current_app, request
 from flask.cli import with_appcontext
-from sqlalchemy import event, CheckConstraint
+from jsonschema.validators import Draft7Validator
+from sqlalchemy import event, insert, inspect, CheckConstraint
 from sqlalchemy.future import Engine
-from sqlalchemy.orm import validates
+from sqlalchemy.orm import Session, validates
 from werkzeug.exceptions import Forbidden
 
 from studentmanager import db
-from studentmanager.utils import is_valid_ssn
+from studentmanager.caching import \
+    invalidate_tags, warm_cache, STUDENTS_TAG, COURSES_TAG, ASSESSMENTS_TAG
+from studentmanager.utils import \
+    is_valid_ssn, generate_ssn, get_cache_generation, renew_cache_generations
 
 
 # from the Exercise 1 webpage
@@ -93,6 +103,25 @@ class Assessment(db.Model):
 
     __tablename__ = 'assessments'
 
+    # INDEXES
+    #   the primary key (course_id, student_id) only covers lookups by course, so the other
+    #   access patterns need their own indexes:
+    #    - student_id: assessments of a student, and the Student.courses secondary join
+    #    - date: range queries on the date of the assessment
+    #    - (course_id, grade): grade filters on the assessments of a course
+    #    - (grade, course_id, student_id): grade filters on all the assessments, in the order of
+    #      the collection
+
+    __table_args__ = (
+        db.Index("ix_assessments_student_id", "student_id"),
+        db.Index("ix_assessments_date", "date"),
+        db.Index("ix_assessments_course_id_grade", "course_id", "grade"),
+        db.Index("ix_assessments_grade", "grade", "course_id", "student_id"),
+    )
+
+    # query parameters filtering the assessment collections (see filter_predicates)
+    FILTERS = ("grade", "grade_min", "date_from", "date_to", "failed")
+
     # SERIALIZER
     def serialize(self):
         """
@@ -150,6 +179,86 @@ class Assessment(db.Model):
         }
         return schema
 
+    # FILTERS
+    @staticmethod
+    def filter_schema():
+        """
+        :return: the JSON schema of the query parameters filtering the assessment collections
+        """
+        schema = {"type": "object"}
+        props = schema["properties"] = {}
+        props["grade"] = {
+            "description": "Only the assessments with this grade",
+            "type": "integer",
+            "minimum": 0,
+            "maximum": 5
+        }
+        props["grade_min"] = {
+            "description": "Only the assessments with at least this grade",
+            "type": "integer",
+            "minimum": 0,
+            "maximum": 5
+        }
+        props["date_from"] = {
+            "description": "Only the assessments marked on this date or later, in format "
+                           "yyyy-mm-dd",
+            "type": "string",
+            "format": "date"
+        }
+        props["date_to"] = {
+            "description": "Only the assessments marked on this date or earlier, in format "
+                           "yyyy-mm-dd",
+            "type": "string",
+            "format": "date"
+        }
+        props["failed"] = {
+            "description": "true for the failed assessments only (grade 0), false for the "
+                           "passed ones only",
+            "type": "boolean"
+        }
+        return schema
+
+    @staticmethod
+    def filter_predicates(args):
+        """
+        Translates the filters in the query parameters into conditions on the indexed columns
+        :param args: the query parameters, e.g. request.args
+        :return: a list of SQLAlchemy expressions, to be used with Query.filter
+        :raise ValueError: if the value of a filter is not valid
+        """
+
+        def _grade(value):
+            grade = int(value)
+            if not 0 <= grade <= 5:
+                raise ValueError("Invalid grade")
+            return grade
+
+        predicates = []
+        if "grade" in args:
+            predicates.append(Assessment.grade == _grade(args["grade"]))
+        if "grade_min" in args:
+            predicates.append(Assessment.grade >= _grade(args["grade_min"]))
+        if "date_from" in args:
+            predicates.append(Assessment.date >= datetime.date.fromisoformat(args["date_from"]))
+        if "date_to" in args:
+            predicates.append(Assessment.date <= datetime.date.fromisoformat(args["date_to"]))
+        if "failed" in args:
+            if args["failed"] not in ("true", "false"):
+                raise ValueError("Invalid boolean")
+            predicates.append(Assessment.grade == 0 if args["failed"] == "true"
+                              else Assessment.grade > 0)
+        return predicates
+
+    @staticmethod
+    @functools.cache
+    def json_validator():
+        """
+        :return: a validator for the JSON schema of the Assessment class, including the format
+            checker. It is compiled only once per process and reused by every request
+        """
+        return Draft7Validator(Assessment.json_schema(),
+                               format_checker=Draft7Validator.FORMAT_CHECKER)
+
 
 class Student(db.Model):
     """
@@ -219,18 +328,39 @@ class Student(db.Model):
         back_populates="students",
         viewonly=True)
 
+    # INDEXES
+    #    - (last_name, first_name): the students sorted by name
+
+    __table_args__ = (
+        db.Index("ix_students_last_name_first_name", "last_name", "first_name"),
+    )
+
+    # orderings allowed by the 'sort' parameter of the collection (see pagination.get_sort).
+    #   Each one is backed by an index, followed by the primary key (the rowid) as every SQLite
+    #   index, so that no sorted page needs a temporary B-tree
+    SORTS = (("student_id",), ("last_name", "first_name"))
+
     # SERIALIZER
-    def serialize(self, short_form=False):
+    #   the attributes of the representation, in order, with the functions reading their values.
+    #   Every one of them is a column, which can be loaded alone (see fieldsets.load_options)
+    FIELDS = {
+        'student_id': lambda student: student.student_id,
+        'first_name': lambda student: student.first_name,
+        'last_name': lambda student: student.last_name,
+        'date_of_birth': lambda student: student.date_of_birth.strftime('%Y-%m-%d'),
+        'ssn': lambda student: student.ssn
+    }
+
+    def serialize(self, short_form=False, fields=None):
         """
         Transforms a student object in a json file
         :param short_form: bool parameter that determines if json file has to contain assessments
+        :param fields: the names of the attributes to include, None for all of them. The other
+            attributes are not read, so they can be left unloaded
         :return doc: return a json file containing the information about the student
         """
-        doc = {'student_id': self.student_id,
-               'first_name': self.first_name,
-               'last_name': self.last_name,
-               'date_of_birth': self.date_of_birth.strftime('%Y-%m-%d'),
-               'ssn': self.ssn}
+        doc = {name: value(self) for name, value in self.FIELDS.items()
+               if fields is None or name in fields}
         if not short_form:
             doc["assessments"] = [a.serialize() for a in self.assessments]
 
@@ -278,6 +408,16 @@ class Student(db.Model):
         }
         return schema
 
+    @staticmethod
+    @functools.cache
+    def json_validator():
+        """
+        :return: a validator for the JSON schema of the Student class, including the format
+            checker. It is compiled only once per process and reused by every request
+        """
+        return Draft7Validator(Student.json_schema(),
+                               format_checker=Draft7Validator.FORMAT_CHECKER)
+
 
 class Course(db.Model):
     """A class that represents a course. Stores the course name, code, teacher and ects.
@@ -314,21 +454,38 @@ class Course(db.Model):
         back_populates="courses",
         viewonly=True)
 
-    # SERIALIZATION METHODS
+    # INDEXES
+    #    - title, ects: the courses sorted by title or by credits
+    #   the unique constraint on code creates an index as well
 
-    def serialize(self, short_form=False):
+    __table_args__ = (
+        db.Index("ix_courses_title", "title"),
+        db.Index("ix_courses_ects", "ects"),
+    )
+
+    # orderings allowed by the 'sort' parameter of the collection, as for Student.SORTS
+    SORTS = (("course_id",), ("code",), ("title",), ("ects",))
+
+    # SERIALIZATION METHODS
+    #   the attributes of the representation, in order, as for Student.FIELDS
+    FIELDS = {
+        "course_id": lambda course: course.course_id,
+        "title": lambda course: course.title,
+        "teacher": lambda course: course.teacher,
+        "code": lambda course: course.code,
+        "ects": lambda course: course.ects
+    }
+
+    def serialize(self, short_form=False, fields=None):
         """
         Transforms a course object in a json file
         :param short_form: bool parameter that determines if json file has to contain assessments
+        :param fields: the names of the attributes to include, None for all of them. The other
+            attributes are not read, so they can be left unloaded
         :return doc: return a json file containing the information about the course
         """
-        doc = {
-            "course_id": self.course_id,
-            "title": self.title,
-            "teacher": self.teacher,
-            "code": self.code,
-            "ects": self.ects
-        }
+        doc = {name: value(self) for name, value in self.FIELDS.items()
+               if fields is None or name in fields}
         if not short_form:
             doc["assessments"] = [a.serialize() for a in self.assessments]
 
@@ -375,6 +532,16 @@ class Course(db.Model):
 
         return schema
 
+    @staticmethod
+    @functools.cache
+    def json_validator():
+        """
+        :return: a validator for the JSON schema of the Course class, including the format
+            checker. It is compiled only once per process and reused by every request
+        """
+        return Draft7Validator(Course.json_schema(),
+                               format_checker=Draft7Validator.FORMAT_CHECKER)
+
 
 class ApiKey(db.Model):
     """
@@ -398,6 +565,94 @@ class ApiKey(db.Model):
         return hashlib.sha256(key.encode()).digest()
 
 
+API_KEYS_GENERATION = "api-keys"
+
+
+class ApiKeyIndex:
+    """
+    In-memory copy of the API keys, indexed by key hash, so that authenticating a request
+        doesn't need any database access.
+    The index is built for a generation of the keys (see utils.get_cache_generation): it is
+        reloaded from the database when the keys change, in this or in any other process.
+    """
+
+    def __init__(self, generation, api_keys):
+        """
+        :param generation: the generation of the API keys the index is built for
+        :param api_keys: iterable of all the ApiKey objects in the database
+        """
+        self.generation = generation
+        self.keys = {api_key.key: api_key.admin for api_key in api_keys}
+        self.has_admin = any(self.keys.values())
+
+    def find(self, key_hash):
+        """
+        Looks up the key with the given hash.
+        The lookup is done on the sha256 digest of the received token, which a client cannot
+            steer byte by byte, so the dictionary lookup is enough: no constant-time comparison
+            is needed.
+        :param key_hash: the digest of the token received in the request
+        :return: the admin flag of the key, or None if no such key exists
+        """
+        return self.keys.get(key_hash)
+
+    @staticmethod
+    def current():
+        """
+        Returns the index of the current application, loading it from the database if it has
+            never been loaded or if the API keys have changed since
+        :return: an ApiKeyIndex object
+        """
+        generation = get_cache_generation(API_KEYS_GENERATION)
+        index = current_app.extensions.get("studentmanager_api_keys")
+        if index is None or index.generation != generation:
+            index = ApiKeyIndex(generation, ApiKey.query.all())
+            current_app.extensions["studentmanager_api_keys"] = index
+        return index
+
+
+@event.listens_for(Session, "after_flush")
+def detect_api_key_changes(session, flush_context):
+    """
+    Called after each flush. Records in the session whether any API key has been added,
+        modified or deleted, so that the key indexes can be invalidated on commit.
+    """
+    if any(isinstance(obj, ApiKey)
+           for obj in itertools.chain(session.new, session.dirty, session.deleted)):
+        session.info["api_keys_changed"] = True
+
+
+@event.listens_for(Session, "do_orm_execute")
+def detect_api_key_bulk_changes(orm_execute_state):
+    """
+    Called for each ORM statement. Bulk inserts, updates and deletes (e.g.
+        ApiKey.query.delete()) do not go through the flush, so the API key changes they make are
+        recorded here.
+    """
+    if (orm_execute_state.is_insert or orm_execute_state.is_update
+            or orm_execute_state.is_delete) \
+            and any(mapper.class_ is ApiKey for mapper in orm_execute_state.all_mappers):
+        orm_execute_state.session.info["api_keys_changed"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def invalidate_api_key_indexes(session):
+    """
+    Called after each commit. If the API keys have changed, renews their generation, so that
+        every process reloads its ApiKeyIndex on the next request.
+    """
+    if session.info.pop("api_keys_changed", False):
+        renew_cache_generations(API_KEYS_GENERATION)
+
+
+@event.listens_for(Session, "after_rollback")
+def discard_api_key_changes(session):
+    """
+    Called after each rollback. Discards the API key changes recorded in the session.
+    """
+    session.info.pop("api_keys_changed", None)
+
+
 # From the Sensorhub example project
 def require_admin_key(func):
     """
@@ -409,8 +664,8 @@ def require_admin_key(func):
     def wrapper(*args, **kwargs):
         key_hash = ApiKey.key_hash(request.headers.get(
             "Studentmanager-Api-Key", "").strip())
-        db_key = ApiKey.query.filter_by(admin=True).first()
-        if db_key is None or secrets.compare_digest(key_hash, db_key.key):
+        index = ApiKeyIndex.current()
+        if not index.has_admin or index.find(key_hash):
             return func(*args, **kwargs)
         raise Forbidden
 
@@ -428,10 +683,8 @@ def require_assessments_key(func):
     def wrapper(*args, **kwargs):
         key_hash = ApiKey.key_hash(request.headers.get(
             "Studentmanager-Api-Key", "").strip())
-        db_keys = ApiKey.query.all()
-        for k in db_keys:
-            if secrets.compare_digest(key_hash, k.key):
-                return func(*args, **kwargs)
+        if ApiKeyIndex.current().find(key_hash) is not None:
+            return func(*args, **kwargs)
         raise Forbidden
 
     return wrapper
@@ -446,6 +699,21 @@ def init_db_command():
     db.create_all()
 
 
+@click.command("migrate-db")
+@with_appcontext
+def migrate_db_command():
+    """
+    Click function callable from the command line, updates an existing database in place by
+        creating the indexes declared in the models that are missing from it
+    """
+    for table in db.metadata.sorted_tables:
+        existing = {index["name"] for index in inspect(db.engine).get_indexes(table.name)}
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            if index.name not in existing:
+                index.create(db.engine)
+                print(f"created index {index.name}")
+
+
 @click.command("testgen")
 @with_appcontext
 def generate_test_data():
@@ -555,6 +823,177 @@ def generate_test_data():
     db.session.commit()
 
 
+SYNTHETIC_FIRST_NAMES = [
+    "Aino", "Eino", "Emma", "Juho", "Lauri", "Leo", "Lotta", "Mikael", "Olivia", "Onni",
+    "Sofia", "Venla", "Daniel", "Lorenzo", "Pranav", "Alessandro", "Maria", "Anna", "Elias",
+    "Ilona", "Kaisa", "Matti", "Niklas", "Saara"
+]
+SYNTHETIC_LAST_NAMES = [
+    "Korhonen", "Virtanen", "Mäkinen", "Nieminen", "Mäkelä", "Hämäläinen", "Laine", "Heikkinen",
+    "Koskinen", "Järvinen", "Lehtonen", "Lehtinen", "Saarinen", "Salminen", "Rossi", "Bianchi",
+    "Szabó", "Nagy", "Kumar", "Sharma", "Smith", "Jones"
+]
+SYNTHETIC_SUBJECTS = [
+    "Programming", "Databases", "Algorithms", "Web Development", "Networks", "Statistics",
+    "Linear Algebra", "Calculus", "Operating Systems", "Machine Learning", "Software Testing",
+    "Computer Graphics"
+]
+SYNTHETIC_LEVELS = ["Introduction to", "Fundamentals of", "Advanced", "Applied", "Seminar on"]
+# relative frequencies of the grades 0 (Fail) to 5
+SYNTHETIC_GRADE_WEIGHTS = [8, 10, 16, 26, 24, 16]
+SYNTHETIC_ECTS = [1, 2, 3, 5, 5, 5, 5, 8, 10]
+SYNTHETIC_CHUNK_SIZE = 50000
+# fixed, rather than today, so that the data only depends on the seed
+SYNTHETIC_LAST_DATE = datetime.date(2025, 12, 31)
+
+
+def _sample_indices(rng, size, density):
+    """
+    Yields the indices in range(size) picking each of them with probability density.
+    Gaps between picked indices are drawn from a geometric distribution, so the cost is
+        proportional to the number of picked indices rather than to size.
+    :param rng: a random.Random instance
+    :param size: the number of indices to pick from
+    :param density: the probability of picking each index
+    """
+    if density <= 0:
+        return
+    if density >= 1:
+        yield from range(size)
+        return
+    log_q = math.log(1.0 - density)
+    index = -1
+    while True:
+        index += int(math.log(1.0 - rng.random()) / log_q) + 1
+        if index >= size:
+            return
+        yield index
+
+
+def _insert_chunks(model, rows):
+    """
+    Inserts rows into the table of model with executemany, committing every
+        SYNTHETIC_CHUNK_SIZE rows
+    :param model: the Model class of the rows
+    :param rows: iterable of dictionaries representing the rows
+    :return: the number of inserted rows
+    """
+    count = 0
+    rows = iter(rows)
+    while chunk := list(itertools.islice(rows, SYNTHETIC_CHUNK_SIZE)):
+        db.session.execute(insert(model.__table__), chunk)
+        db.session.commit()
+        count += len(chunk)
+    return count
+
+
+def generate_synthetic_data(students, courses, density, seed):
+    """
+    Populates the database with synthetic data: students with unique and valid ssns, courses
+        with unique codes and, for each pair of new student and new course, an assessment with
+        probability density. Grades and dates follow realistic distributions.
+    The data only depends on the parameters and on the current maximum ids, so runs on the same
+        database with the same seed are identical.
+    :param students: number of students to generate
+    :param courses: number of courses to generate
+    :param density: probability that a student has an assessment for a course
+    :param seed: seed of the random number generator
+    :return: a tuple with the number of generated students, courses and assessments
+    """
+    rng = random.Random(seed)
+    first_student_id = (db.session.query(db.func.max(Student.student_id)).scalar() or 0) + 1
+    first_course_id = (db.session.query(db.func.max(Course.course_id)).scalar() or 0) + 1
+    used_ssns = {ssn for (ssn,) in db.session.query(Student.ssn)}
+
+    # dates of birth between 1950 and 2005, assessments from the age of 18 onwards, until
+    # SYNTHETIC_LAST_DATE
+    min_birth = datetime.date(1950, 1, 1).toordinal()
+    max_birth = datetime.date(2005, 12, 31).toordinal()
+    students_rows = []
+    for student_id in range(first_student_id, first_student_id + students):
+        ssn = None
+        while ssn is None or ssn in used_ssns:
+            date_of_birth = datetime.date.fromordinal(rng.randint(min_birth, max_birth))
+            ssn = generate_ssn(date_of_birth, rng)
+        used_ssns.add(ssn)
+        students_rows.append({
+            "student_id": student_id,
+            "first_name": rng.choice(SYNTHETIC_FIRST_NAMES),
+            "last_name": rng.choice(SYNTHETIC_LAST_NAMES),
+            "date_of_birth": date_of_birth,
+            "ssn": ssn
+        })
+
+    courses_rows = [{
+        "course_id": course_id,
+        "title": f"{rng.choice(SYNTHETIC_LEVELS)} {rng.choice(SYNTHETIC_SUBJECTS)}",
+        "teacher": f"{rng.choice(SYNTHETIC_FIRST_NAMES)} {rng.choice(SYNTHETIC_LAST_NAMES)}",
+        "code": f"SYN{course_id:07d}",
+        "ects": rng.choice(SYNTHETIC_ECTS)
+    } for course_id in range(first_course_id, first_course_id + courses)]
+
+    def _assessments_rows():
+        for student in students_rows:
+            first_date = max(student["date_of_birth"].toordinal() + 18 * 365,
+                             datetime.date(2000, 1, 1).toordinal())
+            for course_index in _sample_indices(rng, courses, density):
+                yield {
+                    "course_id": first_course_id + course_index,
+                    "student_id": student["student_id"],
+                    "grade": rng.choices(range(6), weights=SYNTHETIC_GRADE_WEIGHTS)[0],
+                    "date": datetime.date.fromordinal(
+                        rng.randint(first_date, SYNTHETIC_LAST_DATE.toordinal()))
+                }
+
+    students_count = _insert_chunks(Student, students_rows)
+    courses_count = _insert_chunks(Course, courses_rows)
+    assessments_count = _insert_chunks(Assessment, _assessments_rows())
+
+    # only new items have been added, so only the collections have to be invalidated
+    invalidate_tags(STUDENTS_TAG, COURSES_TAG, ASSESSMENTS_TAG)
+
+    return students_count, courses_count, assessments_count
+
+
+@click.command("synthgen")
+@click.option("--students", default=1000, show_default=True,
+              help="Number of students to generate")
+@click.option("--courses", default=50, show_default=True,
+              help="Number of courses to generate")
+@click.option("--density", default=0.1, show_default=True, type=click.FloatRange(0, 1),
+              help="Probability that a student has an assessment for a course")
+@click.option("--seed", default=0, show_default=True,
+              help="Seed of the random number generator")
+@with_appcontext
+def generate_synthetic_data_command(students, courses, density, seed):
+    """
+    Click function callable from the command line, populates the already initialized database
+        with large amounts of synthetic data, for load testing
+    """
+    counts = generate_synthetic_data(students, courses, density, seed)
+    students, courses, assessments = counts
+    print(f"added {students} students, {courses} courses and {assessments} assessments")
+
+
+@click.command("cache-warm")
+@click.option("--items", default=100, show_default=True,
+              help="Number of most accessed items to warm, after the collections")
+@click.option("--workers", default=4, show_default=True, type=click.IntRange(1, 32),
+              help="Number of threads sending the requests")
+@click.option("--base-url", default=None,
+              help="Root URL the application is served at, e.g. https://example.com/prefix/")
+@with_appcontext
+def cache_warm_command(items, workers, base_url):
+    """
+    Click function callable from the command line, fills the cache with the collections and the
+        most accessed items, e.g. after a deploy or after the cache has been purged
+    """
+    app = current_app._get_current_object()  # pylint: disable=protected-access
+    results = warm_cache(app, items, workers, echo=click.echo, base_url=base_url)
+    failed = sum(1 for _, status, _ in results if status != 200)
+    print(f"warmed {len(results) - failed} resources, {failed} failed")
+
+
 @click.command("testrun")
 def run_tests():
     """
@@ -0,0 +1,198 @@
+"""
+This module contains the helpers used to paginate collection resources.
+Pagination is keyset (cursor) based: every page is selected with a range condition on the
+    ordering columns, starting right after (or right before) the cursor, so the cost of
+    retrieving a page does not depend on how deep in the collection it is.
+Cursors are opaque url-safe strings encoding the ordering values of the boundary row.
+The collections of models with SORTS can be ordered with the 'sort' parameter (see get_sort),
+    which the cursors follow.
+Collections supporting it can be requested whole with limit=all: their rows are then read in
+    batches with iterate_all, so that they can be streamed.
+"""
+import base64
+import json
+import operator
+
+from flask import request
+from sqlalchemy import tuple_
+
+from studentmanager.constants import \
+    DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, UNPAGINATED_LIMIT, STREAM_BATCH_SIZE
+
+
+class Page:
+    """
+    A page of a collection, with the cursors needed to reach the adjacent pages.
+    next_cursor and prev_cursor are None when there is no page in that direction.
+    """
+
+    def __init__(self, items, limit, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.limit = limit
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+
+def encode_cursor(values):
+    """
+    Encodes the ordering values of a row into an opaque cursor
+    :param values: list or tuple of JSON serializable values
+    :return: a url-safe string representing the cursor
+    """
+    raw = json.dumps(list(values), separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor, length):
+    """
+    Decodes a cursor generated by encode_cursor
+    :param cursor: the string received in the query parameters
+    :param length: the number of ordering values the cursor must contain
+    :return: a tuple with the ordering values
+    :raise ValueError: if the cursor is malformed
+    """
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(cursor + padding))
+    except (TypeError, ValueError) as exc:
+        raise ValueError("Invalid cursor") from exc
+    if not isinstance(values, list) or len(values) != length:
+        raise ValueError("Invalid cursor")
+    return tuple(values)
+
+
+def get_page_size():
+    """
+    Reads the 'limit' query parameter of the current request
+    :return: the requested page size, or the default one if not specified
+    :raise ValueError: if the limit is not an integer between 1 and MAX_PAGE_SIZE
+    """
+    limit = int(request.args.get("limit", DEFAULT_PAGE_SIZE))
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError("Invalid limit")
+    return limit
+
+
+def get_sort(model):
+    """
+    Reads the 'sort' query parameter of the current request: a comma separated list of column
+        names, e.g. 'last_name,first_name', all prefixed by '-' for descending order. Only the
+        orderings in the SORTS attribute of model, which are backed by indexes, are allowed.
+    The primary key is appended to the columns, so that they uniquely identify a row.
+    :param model: the Model class of the collection
+    :return: a (columns, descending) tuple, to be passed to paginate. The collection is ordered
+        on the primary key if the parameter is missing
+    :raise ValueError: if the ordering is not allowed
+    """
+    names = []
+    descending = False
+    sort = request.args.get("sort")
+    if sort is not None:
+        names = sort.split(",")
+        descending = names[0].startswith("-")
+        if any(name.startswith("-") != descending for name in names):
+            raise ValueError("All the columns must be sorted in the same direction")
+        if descending:
+            names = [name[1:] for name in names]
+        if tuple(names) not in model.SORTS:
+            raise ValueError("Invalid sort")
+    names += [column.key for column in model.__mapper__.primary_key if column.key not in names]
+    return [getattr(model, name) for name in names], descending
+
+
+def has_default_order():
+    """
+    :return: whether the current request leaves the collection in its default order, i.e. by
+        primary key, without the 'sort' parameter
+    """
+    return "sort" not in request.args
+
+
+def paginate(query, columns, key=None, descending=False):
+    """
+    Retrieves the page of query selected by the 'after', 'before' and 'limit' query parameters
+        of the current request. The rows are ordered on columns, which must uniquely identify a
+        row (e.g. the primary key).
+    :param query: the SQLAlchemy query to paginate
+    :param columns: list of the columns the collection is ordered on
+    :param key: function returning the values of columns for a row, used to build the cursors.
+        By default the attributes of the row with the names of the columns are read
+    :param descending: True to order the collection in descending order on all the columns
+    :return: a Page object
+    :raise ValueError: if any of the pagination parameters is not valid
+    """
+    limit = get_page_size()
+    after = request.args.get("after")
+    before = request.args.get("before")
+    if after is not None and before is not None:
+        raise ValueError("Only one of 'after' and 'before' can be specified")
+    if key is None:
+        def key(row):
+            return tuple(getattr(row, column.key) for column in columns)
+
+    ordering = columns[0] if len(columns) == 1 else tuple_(*columns)
+    # the comparisons selecting the rows following and preceding a cursor
+    following, preceding = (operator.lt, operator.gt) if descending else (operator.gt, operator.lt)
+
+    def _bound(cursor):
+        values = decode_cursor(cursor, len(columns))
+        return values[0] if len(columns) == 1 else values
+
+    def _order(reverse):
+        return [column.desc() if descending != reverse else column for column in columns]
+
+    if before is None:
+        if after is not None:
+            query = query.filter(following(ordering, _bound(after)))
+        rows = query.order_by(*_order(False)).limit(limit + 1).all()
+    else:
+        query = query.filter(preceding(ordering, _bound(before)))
+        rows = query.order_by(*_order(True)).limit(limit + 1).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    if before is not None:
+        rows.reverse()
+
+    page = Page(rows, limit)
+    if rows:
+        first_cursor = encode_cursor(key(rows[0]))
+        last_cursor = encode_cursor(key(rows[-1]))
+        if before is None:
+            page.next_cursor = last_cursor if has_more else None
+            page.prev_cursor = first_cursor if after is not None else None
+        else:
+            page.next_cursor = last_cursor
+            page.prev_cursor = first_cursor if has_more else None
+
+    return page
+
+
+def is_unpaginated():
+    """
+    :return: whether the current request asks for the whole collection, with limit=all
+    """
+    return request.args.get("limit") == UNPAGINATED_LIMIT
+
+
+def iterate_all(query, columns):
+    """
+    Retrieves all the rows of query following the 'after' cursor of the current request, if
+        any, ordered on columns. The rows are loaded STREAM_BATCH_SIZE at a time while they are
+        iterated, so that the memory used does not depend on the size of the collection.
+    :param query: the SQLAlchemy query to iterate
+    :param columns: list of the columns the collection is ordered on, as in paginate
+    :return: an iterable of the rows
+    :raise ValueError: if the cursor is not valid, or 'before' is specified
+    """
+    if request.args.get("before") is not None:
+        raise ValueError("'before' cannot be used with the whole collection")
+    after = request.args.get("after")
+    if after is not None:
+        values = decode_cursor(after, len(columns))
+        if len(columns) == 1:
+            query = query.filter(columns[0] > values[0])
+        else:
+            query = query.filter(tuple_(*columns) > values)
+    return query.order_by(*columns).yield_per(STREAM_BATCH_SIZE)
@@ -3,50 +3,32 @@ This module contains all the classes related to the Assessment resource:
  - the collection of all assessments for both a student and a course
  - a singular assessment for either a student or a course
  - the endpoint for adding new assessments
+ - the endpoint for adding batches of assessments
 """
+import itertools
 import json
 import os
 
 from flasgger import swag_from
-from flask import request, url_for, Response
+from flask import request, url_for, Response, stream_with_context
 from flask_restful import Resource
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
+from sqlalchemy import insert, tuple_
 from sqlalchemy.exc import IntegrityError
 
-from studentmanager import db, cache
-from studentmanager.builder import StudentManagerBuilder, create_error_response
+from studentmanager import db
+from studentmanager.builder import \
+    StudentManagerBuilder, create_error_response, wants_compact, negotiated_view, uri_template, \
+    compact_document
+from studentmanager.caching import \
+    cached_resource, invalidate_tags, assessment_tags, ASSESSMENTS_TAG
 from studentmanager.constants \
-    import ASSESSMENT_PROFILE, MASON, LINK_RELATIONS_URL, NAMESPACE, DOC_FOLDER
+    import ASSESSMENT_PROFILE, MASON, JSON, LINK_RELATIONS_URL, NAMESPACE, DOC_FOLDER, NDJSON, \
+    BATCH_CHUNK_SIZE
+from studentmanager.fragments import \
+    get_fragments, encode_document, stream_document, COMPACT_SEPARATORS
 from studentmanager.models import Assessment, require_assessments_key
-from studentmanager.utils import request_path_cache_key
-
-
-def clear_cache(assessment):
-    """
-    Clears all cache entries related to an assessment:
-     - the assessment's view
-     - its course's assessments view
-     - its student's assessments view
-     - its course's and student's view (since assessments are included in serialize())
-    :param assessment: an existing assessment database object
-    """
-    all_assessments_url = url_for('api.assessmentcollection')
-    course_assessments_url = url_for(
-        'api.courseassessmentcollection',
-        course=assessment.course)
-    course_url = url_for('api.courseitem', course=assessment.course)
-    student_assessments_url = url_for(
-        'api.studentassessmentcollection',
-        student=assessment.student)
-    student_url = url_for('api.studentitem', student=assessment.student)
-    cache.delete_many(
-        request.path,
-        all_assessments_url,
-        course_assessments_url,
-        student_assessments_url,
-        course_url,
-        student_url
-    )
+from studentmanager.pagination import paginate, is_unpaginated, iterate_all
 
 
 class CourseAssessmentCollection(Resource):
@@ -58,28 +40,46 @@ class CourseAssessmentCollection(Resource):
     # must explicitly specify current working directory because otherwise
     # it will look in in cache dir
     @swag_from(os.getcwd() + f"{DOC_FOLDER}course_assessment_collection/get.yml")
-    @cache.cached(timeout=None, make_cache_key=request_path_cache_key)
+    @cached_resource("course:{course.course_id}", vary={"Accept": negotiated_view})
     def get(self, course):
         """
         The collection of all assessments of a specific course,
             reachable at '/api/courses/<course_id>/assessments/''
+        Returns 400 if the filter parameters are not valid
         """
-        body = StudentManagerBuilder(items=[])
+        # raises NotFound if the course does not exist
+        course.load()
 
-        for assessment in Assessment.query.filter_by(course_id=course.course_id).all():
-            item = StudentManagerBuilder(assessment.serialize())
-            item.add_control("self", url_for('api.courseassessmentitem',
-                                             student=assessment.student,
-                                             course=assessment.course))
-            item.add_control("profile", ASSESSMENT_PROFILE)
-            body["items"].append(item)
+        try:
+            query = _filtered(Assessment.query.filter_by(course_id=course.course_id))
+        except ValueError:
+            return create_error_response(400, 'Bad Request', "Invalid filter parameters")
 
+        body = StudentManagerBuilder(items=_collection_items(
+            "course-assessment-item", query.all(), self.collection_item))
+
+        self_url = url_for('api.courseassessmentcollection', course=course)
         body.add_namespace(NAMESPACE, LINK_RELATIONS_URL)
-        body.add_control("self", url_for('api.courseassessmentcollection', course=course))
+        body.add_control("self", self_url)
+        body.add_control_filter_assessments(self_url)
         body.add_control_all_assessments()
         body.add_control_get_course(course)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return _collection_response(body, 'api.courseassessmentitem')
+
+    @staticmethod
+    def collection_item(assessment):
+        """
+        :param assessment: the assessment object
+        :return: the representation of assessment in the collections, linking to the assessment
+            of the course
+        """
+        item = StudentManagerBuilder(assessment.serialize())
+        item.add_control("self", url_for('api.courseassessmentitem',
+                                         student=assessment.student_id,
+                                         course=assessment.course_id))
+        item.add_control("profile", ASSESSMENT_PROFILE)
+        return item
 
 
 class StudentAssessmentCollection(Resource):
@@ -91,26 +91,46 @@ class StudentAssessmentCollection(Resource):
     # must explicitly specify current working directory because otherwise
     # it will look in in cache dir
     @swag_from(os.getcwd() + f"{DOC_FOLDER}student_assessment_collection/get.yml")
-    @cache.cached(timeout=None, make_cache_key=request_path_cache_key)
+    @cached_resource("student:{student.student_id}", vary={"Accept": negotiated_view})
     def get(self, student):
-        """Get the list of assessments from the database"""
+        """
+        Get the list of assessments from the database.
+        Returns 400 if the filter parameters are not valid
+        """
 
-        body = StudentManagerBuilder(items=[])
+        # raises NotFound if the student does not exist
+        student.load()
 
-        for assessment in Assessment.query.filter_by(student_id=student.student_id).all():
-            item = StudentManagerBuilder(assessment.serialize())
-            item.add_control("self", url_for('api.studentassessmentitem',
-                                             student=assessment.student,
-                                             course=assessment.course))
-            item.add_control("profile", ASSESSMENT_PROFILE)
-            body["items"].append(item)
+        try:
+            query = _filtered(Assessment.query.filter_by(student_id=student.student_id))
+        except ValueError:
+            return create_error_response(400, 'Bad Request', "Invalid filter parameters")
+
+        body = StudentManagerBuilder(items=_collection_items(
+            "student-assessment-item", query.all(), self.collection_item))
 
+        self_url = url_for('api.studentassessmentcollection', student=student)
         body.add_namespace(NAMESPACE, LINK_RELATIONS_URL)
-        body.add_control("self", url_for('api.studentassessmentcollection', student=student))
+        body.add_control("self", self_url)
+        body.add_control_filter_assessments(self_url)
         body.add_control_all_assessments()
         body.add_control_get_student(student)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return _collection_response(body, 'api.studentassessmentitem')
+
+    @staticmethod
+    def collection_item(assessment):
+        """
+        :param assessment: the assessment object
+        :return: the representation of assessment in the collection, linking to the assessment
+            of the student
+        """
+        item = StudentManagerBuilder(assessment.serialize())
+        item.add_control("self", url_for('api.studentassessmentitem',
+                                         student=assessment.student_id,
+                                         course=assessment.course_id))
+        item.add_control("profile", ASSESSMENT_PROFILE)
+        return item
 
 
 class AssessmentCollection(Resource):
@@ -121,27 +141,74 @@ class AssessmentCollection(Resource):
     # must explicitly specify current working directory because otherwise
     # it will look in in cache dir
     @swag_from(os.getcwd() + f"{DOC_FOLDER}assessment_collection/get.yml")
-    @cache.cached(timeout=None, make_cache_key=request_path_cache_key)
+    @cached_resource(ASSESSMENTS_TAG, vary={"Accept": negotiated_view})
     def get(self):
-        """Get the list of assessments from the database"""
+        """
+        Get a page of the list of assessments from the database, ordered by
+            (course_id, student_id).
+        With limit=all the whole collection (following the 'after' cursor, if given) is
+            returned, streamed while it is read from the database, and is not cached.
+        Returns 400 if the pagination or filter parameters are not valid
+        """
+        try:
+            query = _filtered(Assessment.query)
+        except ValueError:
+            return create_error_response(400, 'Bad Request', "Invalid filter parameters")
 
-        body = StudentManagerBuilder(items=[])
+        if is_unpaginated():
+            return self._stream_all(query)
 
-        for assessment in Assessment.query.all():
-            item = StudentManagerBuilder(assessment.serialize())
-            item.add_control("self", url_for('api.courseassessmentitem',
-                                             student=assessment.student,
-                                             course=assessment.course))
-            item.add_control("profile", ASSESSMENT_PROFILE)
-            body["items"].append(item)
+        try:
+            page = paginate(query,
+                            [Assessment.course_id, Assessment.student_id],
+                            lambda a: (a.course_id, a.student_id))
+        except ValueError:
+            return create_error_response(400, 'Bad Request', "Invalid pagination parameters")
+
+        # same items as the collections of the courses, sharing their fragments
+        body = StudentManagerBuilder(items=_collection_items(
+            "course-assessment-item", page.items, CourseAssessmentCollection.collection_item))
 
         body.add_namespace(NAMESPACE, LINK_RELATIONS_URL)
         body.add_control("self", url_for('api.assessmentcollection'))
+        body.add_control_pagination('api.assessmentcollection', page, **_filter_args())
+        body.add_control_filter_assessments(url_for('api.assessmentcollection'))
         body.add_control_add_assessment()
         body.add_control_all_students()
         body.add_control_all_courses()
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return _collection_response(body, 'api.courseassessmentitem')
+
+    @staticmethod
+    def _stream_all(query):
+        """
+        :param query: the query of the assessments, with the filters of the request
+        :return: a streamed response with all the assessments. The items are serialized as they
+            are read, without using the fragment cache, which they would flush
+        """
+        try:
+            rows = iterate_all(query, [Assessment.course_id, Assessment.student_id])
+        except ValueError:
+            return create_error_response(400, 'Bad Request', "Invalid pagination parameters")
+
+        body = StudentManagerBuilder(items=[])
+        body.add_namespace(NAMESPACE, LINK_RELATIONS_URL)
+        body.add_control("self", url_for('api.assessmentcollection'))
+        body.add_control_add_assessment()
+        body.add_control_all_students()
+        body.add_control_all_courses()
+
+        compact = wants_compact()
+        if compact:
+            body = compact_document(body, _item_template('api.courseassessmentitem'))
+            fragments = (json.dumps(assessment.serialize(), separators=COMPACT_SEPARATORS)
+                         for assessment in rows)
+        else:
+            fragments = (json.dumps(CourseAssessmentCollection.collection_item(assessment))
+                         for assessment in rows)
+        # the request context (and the database session) is needed until the end of the stream
+        return Response(stream_with_context(stream_document(body, "items", fragments, compact)),
+                        200, mimetype=JSON if compact else MASON)
 
     @swag_from(f"{DOC_FOLDER}assessment_collection/post.yml")
     @require_assessments_key
@@ -154,7 +221,7 @@ class AssessmentCollection(Resource):
             already present)"""
 
         try:
-            validate(request.json, Assessment.json_schema())
+            Assessment.json_validator().validate(request.json)
 
             assessment = Assessment()
 
@@ -179,15 +246,237 @@ class AssessmentCollection(Resource):
                 f"student_id '{assessment.student_id}'"
             )
 
-        clear_cache(assessment)
+        invalidate_tags(*assessment_tags(assessment))
 
         return Response(
             status=201,
             headers={
                 'Location': url_for(
                     'api.courseassessmentitem',
-                    course=assessment.course,
-                    student=assessment.student)})
+                    course=assessment.course_id,
+                    student=assessment.student_id)})
+
+
+def _filter_args():
+    """
+    :return: the filters of the current request, which the pagination controls must keep
+    """
+    return {name: request.args[name] for name in Assessment.FILTERS if name in request.args}
+
+
+def _filtered(query):
+    """
+    Restricts a query of assessments with the filters of the current request
+    :param query: the SQLAlchemy query of the assessments
+    :return: the filtered query
+    :raise ValueError: if the value of a filter is not valid
+    """
+    return query.filter(*Assessment.filter_predicates(request.args))
+
+
+def _collection_items(kind, rows, build):
+    """
+    :param kind: the name of the Mason items built by build
+    :param rows: the assessments of the collection
+    :param build: function returning the Mason item of an assessment
+    :return: the fragments of the items of the collection, the plain assessments in the compact
+        representation (see wants_compact), shared by all the collections
+    """
+    if wants_compact():
+        return get_fragments("assessment", rows, Assessment.serialize, compact=True)
+    return get_fragments(kind, rows, build)
+
+
+def _item_template(endpoint):
+    """
+    :param endpoint: the endpoint name of the assessment items, of a course or of a student
+    :return: the URI template of the items
+    """
+    return uri_template(endpoint, course="course_id", student="student_id")
+
+
+def _collection_response(body, item_endpoint):
+    """
+    :param body: the collection, whose items are returned by _collection_items
+    :param item_endpoint: the endpoint name of the items, for their URI template
+    :return: the response with the Mason or the compact representation of the collection
+    """
+    if wants_compact():
+        body = compact_document(body, _item_template(item_endpoint))
+        return Response(encode_document(body, compact=True), 200, mimetype=JSON)
+    return Response(encode_document(body), 200, mimetype=MASON)
+
+
+def _read_ndjson(stream):
+    """
+    Reads newline delimited JSON documents from a stream, one line at a time
+    :param stream: a binary file-like object, e.g. request.stream
+    :return: a generator of the parsed documents. Lines that are not valid JSON are
+        returned as None, so that they will be reported as invalid
+    """
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None
+
+
+def _batch_result(index, status, doc=None, message=None):
+    """
+    Builds the report of a single item of a batch
+    :param index: the position of the item in the batch
+    :param status: one of 'created', 'conflict' or 'invalid'
+    :param doc: the row of the assessment, if it could be deserialized
+    :param message: human-readable explanation of the status
+    :return: a StudentManagerBuilder object
+    """
+    result = StudentManagerBuilder(index=index, status=status)
+    if doc is not None:
+        result["course_id"] = doc["course_id"]
+        result["student_id"] = doc["student_id"]
+    if message is not None:
+        result["message"] = message
+    if status == "created":
+        result.add_control("self", url_for('api.courseassessmentitem',
+                                           course=doc["course_id"],
+                                           student=doc["student_id"]))
+    return result
+
+
+def _integrity_error_result(index, row, exc):
+    """
+    Builds the report of an item that could not be inserted
+    :param index: the position of the item in the batch
+    :param row: the row of the assessment
+    :param exc: the IntegrityError raised by the insert
+    :return: a StudentManagerBuilder object
+    """
+    if "UNIQUE" in str(exc.orig):
+        return _batch_result(index, "conflict", row, "Assessment already exists")
+    if "FOREIGN KEY" in str(exc.orig):
+        return _batch_result(index, "invalid", row, "Student or course does not exist")
+    return _batch_result(index, "invalid", row, "Grade must be between 0 and 5")
+
+
+def _insert_batch_chunk(chunk, seen):
+    """
+    Validates and inserts a chunk of a batch of assessments in a single transaction. If the
+        transaction fails, the rows are inserted one by one to find the ones causing the error.
+    :param chunk: list of (index, document) tuples
+    :param seen: set of the (course_id, student_id) keys already found in the batch, updated
+        with the keys of this chunk
+    :return: a list with the report of every item of the chunk, and the list of created rows
+    """
+    results = {}
+    rows = {}
+    for index, doc in chunk:
+        try:
+            Assessment.json_validator().validate(doc)
+            assessment = Assessment()
+            assessment.deserialize(doc)
+        except ValidationError as exc:
+            results[index] = _batch_result(index, "invalid", message=exc.message)
+            continue
+        except (ValueError, AssertionError):
+            results[index] = _batch_result(index, "invalid",
+                                           message="Date not in iso format or in the future")
+            continue
+
+        row = {
+            "course_id": assessment.course_id,
+            "student_id": assessment.student_id,
+            "grade": assessment.grade,
+            "date": assessment.date
+        }
+        key = (row["course_id"], row["student_id"])
+        if key in seen:
+            results[index] = _batch_result(index, "conflict", row,
+                                           "Assessment appears more than once in the batch")
+            continue
+        seen.add(key)
+        rows[index] = row
+
+    if rows:
+        existing = set(db.session.query(Assessment.course_id, Assessment.student_id).filter(
+            tuple_(Assessment.course_id, Assessment.student_id).in_(
+                [(row["course_id"], row["student_id"]) for row in rows.values()])
+        ).all())
+        for index in [i for i, row in rows.items()
+                      if (row["course_id"], row["student_id"]) in existing]:
+            results[index] = _batch_result(index, "conflict", rows.pop(index),
+                                           "Assessment already exists")
+
+    created = []
+    if rows:
+        try:
+            db.session.execute(insert(Assessment), list(rows.values()))
+            db.session.commit()
+            created = list(rows.items())
+        except IntegrityError:
+            db.session.rollback()
+            for index, row in rows.items():
+                try:
+                    db.session.execute(insert(Assessment), [row])
+                    db.session.commit()
+                    created.append((index, row))
+                except IntegrityError as exc:
+                    db.session.rollback()
+                    results[index] = _integrity_error_result(index, row, exc)
+
+    for index, row in created:
+        results[index] = _batch_result(index, "created", row)
+
+    return [results[index] for index in sorted(results)], [row for _, row in created]
+
+
+class AssessmentBatch(Resource):
+    """
+    The endpoint for adding many assessments with a single request,
+        reachable at '/api/assessments/batch/'
+    """
+
+    @swag_from(f"{DOC_FOLDER}assessment_batch/post.yml")
+    @require_assessments_key
+    def post(self):
+        """
+        Adds a batch of assessments, sent either as a JSON array or as newline delimited JSON
+            (application/x-ndjson), which is read one line at a time.
+        Items are validated and inserted in chunks of BATCH_CHUNK_SIZE, each in its own
+            transaction, and the cache is invalidated once for the whole batch.
+        Returns 200 and the report of every item (created, conflict or invalid), in the same
+            order as the request.
+        Returns 400 if the body is neither a JSON array nor NDJSON
+        """
+        if request.mimetype == NDJSON:
+            docs = _read_ndjson(request.stream)
+        else:
+            docs = request.get_json(silent=True)
+            if not isinstance(docs, list):
+                return create_error_response(400, 'Bad Request',
+                                             'The body must be a JSON array or NDJSON')
+
+        results = []
+        created = []
+        seen = set()
+        items = enumerate(docs)
+        while chunk := list(itertools.islice(items, BATCH_CHUNK_SIZE)):
+            chunk_results, chunk_created = _insert_batch_chunk(chunk, seen)
+            results.extend(chunk_results)
+            created.extend(chunk_created)
+
+        if created:
+            invalidate_tags(*assessment_tags(*created))
+
+        body = StudentManagerBuilder(items=results)
+        for status in ("created", "conflict", "invalid"):
+            body[status] = sum(1 for result in results if result["status"] == status)
+        body.add_namespace(NAMESPACE, LINK_RELATIONS_URL)
+        body.add_control("self", url_for('api.assessmentbatch'))
+        body.add_control_all_assessments()
+
+        return Response(json.dumps(body), 200, mimetype=MASON)
 
 
 class StudentAssessmentItem(Resource):
@@ -200,7 +489,7 @@ class StudentAssessmentItem(Resource):
     # must explicitly specify current working directory because otherwise
     # it will look in in cache dir
     @swag_from(os.getcwd() + f"{DOC_FOLDER}student_assessment_item/get.yml")
-    @cache.cached(timeout=None, make_cache_key=request_path_cache_key)
+    @cached_resource("student:{student.student_id}", "course:{course.course_id}")
     def get(self, student, course):
         """
         Returns the representation of the assessment
@@ -211,7 +500,7 @@ class StudentAssessmentItem(Resource):
         body = StudentManagerBuilder(Assessment.query
                                      .filter_by(student_id=student.student_id)
                                      .filter_by(course_id=course.course_id)
-                                     .first().serialize())
+                                     .first_or_404().serialize())
 
         self_url = url_for('api.studentassessmentitem', student=student, course=course)
 
@@ -241,10 +530,12 @@ class StudentAssessmentItem(Resource):
         assessment = Assessment.query \
             .filter_by(student_id=student.student_id) \
             .filter_by(course_id=course.course_id) \
-            .first()
+            .first_or_404()
+        # the assessment can be moved to another student or course, both need to be invalidated
+        previous = {"course_id": assessment.course_id, "student_id": assessment.student_id}
 
         try:
-            validate(request.json, Assessment.json_schema())
+            Assessment.json_validator().validate(request.json)
 
             assessment.deserialize(request.json)
 
@@ -266,7 +557,7 @@ class StudentAssessmentItem(Resource):
                 f"student_id '{assessment.student_id}'"
             )
 
-        clear_cache(assessment)
+        invalidate_tags(*assessment_tags(previous, assessment))
 
         return Response(status=204)
 
@@ -282,12 +573,12 @@ class StudentAssessmentItem(Resource):
         assessment = Assessment.query \
             .filter_by(student_id=student.student_id) \
             .filter_by(course_id=course.course_id) \
-            .first()
+            .first_or_404()
 
         db.session.delete(assessment)
         db.session.commit()
 
-        clear_cache(assessment)
+        invalidate_tags(*assessment_tags(assessment))
 
         return Response(status=204)
 
@@ -302,7 +593,7 @@ class CourseAssessmentItem(Resource):
     # must explicitly specify current working directory because otherwise
     # it will look in in cache dir
     @swag_from(os.getcwd() + f"{DOC_FOLDER}course_assessment_item/get.yml")
-    @cache.cached(timeout=None, make_cache_key=request_path_cache_key)
+    @cached_resource("student:{student.student_id}", "course:{course.course_id}")
     def get(self, student, course):
         """
         Returns the representation of the assessment
@@ -314,7 +605,7 @@ class CourseAssessmentItem(Resource):
         body = StudentManagerBuilder(Assessment.query
                                      .filter_by(course_id=course.course_id)
                                      .filter_by(student_id=student.student_id)
-                                     .first().serialize())
+                                     .first_or_404().serialize())
 
         self_url = url_for('api.courseassessmentitem', student=student, course=course)
 
@@ -344,10 +635,12 @@ class CourseAssessmentItem(Resource):
         assessment = Assessment.query \
             .filter_by(student_id=student.student_id) \
             .filter_by(course_id=course.course_id) \
-            .first()
+            .first_or_404()
+        # the assessment can be moved to another student or course, both need to be invalidated
+        previous = {"course_id": assessment.course_id, "student_id": assessment.student_id}
 
         try:
-            validate(request.json, Assessment.json_schema())
+            Assessment.json_validator().validate(request.json)
 
             assessment.deserialize(request.json)
 
@@ -365,7 +658,7 @@ class CourseAssessmentItem(Resource):
             return f"Assessment already exists with course_id '{assessment.course_id}' and " \
                    f"student_id '{assessment.student_id}'", 409
 
-        clear_cache(assessment)
+        invalidate_tags(*assessment_tags(previous, assessment))
 
         return Response(status=204)
 
@@ -381,11 +674,11 @@ class CourseAssessmentItem(Resource):
         assessment = Assessment.query \
             .filter_by(student_id=student.student_id) \
             .filter_by(course_id=course.course_id) \
-            .first()
+            .first_or_404()
 
         db.session.delete(assessment)
         db.session.commit()
 
-        clear_cache(assessment)
+        invalidate_tags(*assessment_tags(assessment))
 
         return Response(status=204)
@@ -0,0 +1,35 @@
+"""
+This module contains the resource exposing the statistics of the response cache, reserved to
+    the administrators
+"""
+import json
+
+from flasgger import swag_from
+from flask import url_for, Response
+from flask_restful import Resource
+
+from studentmanager import cache
+from studentmanager.builder import StudentManagerBuilder
+from studentmanager.constants import MASON, LINK_RELATIONS_URL, NAMESPACE, DOC_FOLDER
+from studentmanager.models import require_admin_key
+
+
+class CacheStats(Resource):
+    """
+    The statistics of the response cache, reachable at '/api/admin/cache/'
+    """
+
+    @swag_from(f"{DOC_FOLDER}cache_stats/get.yml")
+    @require_admin_key
+    def get(self):
+        """
+        Returns the occupancy, limits, evictions and hit ratio of every family of routes (see
+            studentmanager.caching.CacheFamily), and the counters of the worker
+        """
+        body = StudentManagerBuilder(families=cache.cache.family_stats(),
+                                     worker=cache.cache.stats())
+        body.add_namespace(NAMESPACE, LINK_RELATIONS_URL)
+        body.add_control("self", url_for('admin.cachestats'))
+
+        return Response(json.dumps(body), 200, mimetype=MASON,
+                        headers={"Cache-Control": "no-store"})
@@ -4,24 +4,31 @@ This module contains all the classes related to the Course resource:
  - a singular course
  - the related URL converter
 """
-import json
 import os
 
 from flasgger import swag_from
 from flask import request, url_for, Response
 from flask_restful import Resource
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import NotFound
 from werkzeug.routing import BaseConverter
 
-from studentmanager import cache
 from studentmanager import db
-from studentmanager.builder import StudentManagerBuilder, create_error_response
+from studentmanager.builder import \
+    StudentManagerBuilder, create_error_response, wants_compact, negotiated_view, uri_template, \
+    compact_document
+from studentmanager.caching import \
+    cached_resource, invalidate_tags, record_changes, CollectionChange, course_tag, student_tag, \
+    COURSES_TAG, ASSESSMENTS_TAG
 from studentmanager.constants \
-    import COURSE_PROFILE, LINK_RELATIONS_URL, MASON, NAMESPACE, DOC_FOLDER
-from studentmanager.models import Course, require_admin_key
-from studentmanager.utils import request_path_cache_key
+    import COURSE_PROFILE, LINK_RELATIONS_URL, MASON, JSON, NAMESPACE, DOC_FOLDER
+from studentmanager.fieldsets import \
+    get_fieldset, has_all_fields, has_controls, load_options, fieldset_kind
+from studentmanager.fragments import get_fragments, encode_document
+from studentmanager.models import Course, Assessment, require_admin_key
+from studentmanager.pagination import paginate, get_sort, has_default_order
+from studentmanager.utils import LazyInstance
 
 
 class CourseCollection(Resource):
@@ -32,25 +39,48 @@ class CourseCollection(Resource):
     # must explicitly specify current working directory because otherwise
     # it will look in in cache dir
     @swag_from(os.getcwd() + f"{DOC_FOLDER}course_collection/get.yml")
-    @cache.cached(timeout=None, make_cache_key=request_path_cache_key)
+    # the changes recorded for the collection are full Mason items, in the default order
+    @cached_resource(COURSES_TAG, vary={"Accept": negotiated_view},
+                     patchable=lambda: has_default_order() and has_all_fields()
+                     and not wants_compact())
     def get(self):
-        """Get the list of courses from the database"""
-
-        body = StudentManagerBuilder(items=[])
+        """
+        Get a page of the list of courses from the database, ordered by course_id or as
+            requested with the sort parameter (see Course.SORTS).
+        The compact representation is returned if requested (see builder.wants_compact).
+        Returns 400 if the pagination, sort or fields parameters are not valid
+        """
 
-        for course in Course.query.all():
-            item = StudentManagerBuilder(course.serialize(short_form=True))
-            item.add_control("self", url_for('api.courseitem', course=course))
-            item.add_control("profile", COURSE_PROFILE)
-            body["items"].append(item)
+        try:
+            fields = get_fieldset(Course)
+            columns, descending = get_sort(Course)
+            page = paginate(Course.query.options(*load_options(Course, fields, columns)),
+                            columns, descending=descending)
+        except ValueError:
+            return create_error_response(400, 'Bad Request', "Invalid query parameters")
+
+        compact = wants_compact()
+        if compact:
+            items = get_fragments(
+                fieldset_kind("course", fields), page.items,
+                lambda course: course.serialize(short_form=True, fields=fields), compact=True)
+        else:
+            items = get_fragments(
+                fieldset_kind("course-item", fields), page.items,
+                lambda course: self.collection_item(course, fields))
+        body = StudentManagerBuilder(items=items)
 
         body.add_namespace(NAMESPACE, LINK_RELATIONS_URL)
         body.add_control("self", url_for('api.coursecollection'))
+        body.add_control_pagination('api.coursecollection', page)
         body.add_control_add_course()
         body.add_control_all_students()
         body.add_control_all_assessments()
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        if compact:
+            body = compact_document(body, uri_template('api.courseitem', course="course_id"))
+            return Response(encode_document(body, compact=True), 200, mimetype=JSON)
+        return Response(encode_document(body), 200, mimetype=MASON)
 
     @swag_from(f"{DOC_FOLDER}course_collection/post.yml")
     @require_admin_key
@@ -65,7 +95,7 @@ class CourseCollection(Resource):
         """
 
         try:
-            validate(request.json, Course.json_schema())
+            Course.json_validator().validate(request.json)
         except ValidationError:
             return create_error_response(400, 'Bad Request', "Invalid request format")
 
@@ -83,7 +113,7 @@ class CourseCollection(Resource):
                 f"Course with code '{course.code}' already exists."
             )
 
-        self._clear_cache()
+        self._clear_cache(course)
         return Response(
             status=201,
             headers={
@@ -91,10 +121,22 @@ class CourseCollection(Resource):
             }
         )
 
-    def _clear_cache(self):
-        cache.delete(
-            request.path
-        )
+    @staticmethod
+    def collection_item(course, fields=None):
+        """
+        :param course: the course object
+        :param fields: the fieldset of the request (see fieldsets.get_fieldset)
+        :return: the representation of course in the collection
+        """
+        item = StudentManagerBuilder(course.serialize(short_form=True, fields=fields))
+        if has_controls(fields):
+            item.add_control("self", url_for('api.courseitem', course=course))
+            item.add_control("profile", COURSE_PROFILE)
+        return item
+
+    def _clear_cache(self, course):
+        record_changes(COURSES_TAG, CollectionChange(
+            "create", "course_id", course.course_id, self.collection_item(course)))
 
 
 class CourseItem(Resource):
@@ -106,14 +148,27 @@ class CourseItem(Resource):
     # must explicitly specify current working directory because otherwise
     # it will look in in cache dir
     @swag_from(os.getcwd() + f"{DOC_FOLDER}course_item/get.yml")
-    @cache.cached(timeout=None, make_cache_key=request_path_cache_key)
+    @cached_resource("course:{course.course_id}")
     def get(self, course):
         """
-        Returns the representation of the course
+        Returns the representation of the course, with the fields parameter only the selected
+            attributes (and 'assessments'), without the controls unless '@controls' is selected.
+        Returns 400 if the fields are not valid
         :param course: takes a student object containing the information about the student
         """
 
-        body = StudentManagerBuilder(course.serialize())
+        try:
+            fields = get_fieldset(Course, extra=["assessments"])
+        except ValueError:
+            return create_error_response(400, 'Bad Request', "Invalid fields")
+        course.load(*load_options(Course, fields))
+
+        body = StudentManagerBuilder(course.serialize(short_form=True, fields=fields))
+        if fields is None or "assessments" in fields:
+            body["assessments"] = get_fragments("assessment", course.assessments,
+                                                Assessment.serialize)
+        if not has_controls(fields):
+            return Response(encode_document(body), 200, mimetype=MASON)
 
         self_url = url_for('api.courseitem', course=course)
 
@@ -126,7 +181,7 @@ class CourseItem(Resource):
         body.add_control_all_assessments()
         body.add_control_course_assessments(course)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return Response(encode_document(body), 200, mimetype=MASON)
 
     @swag_from(f"{DOC_FOLDER}course_item/put.yml")
     @require_admin_key
@@ -140,16 +195,18 @@ class CourseItem(Resource):
         Returns 409 if an IntegrityError happens (code is already present)
         Returns 204 if the course has correctly been updated
         """
+        # a missing course is reported before an invalid body
+        course.load()
 
         try:
-            validate(request.json, Course.json_schema())
+            Course.json_validator().validate(request.json)
         except ValidationError:
             return create_error_response(400, 'Bad Request', "Invalid request format")
 
         course.deserialize(request.json)
 
         try:
-            db.session.add(course)
+            db.session.add(course.load())
             db.session.commit()
         except IntegrityError:
             db.session.rollback()
@@ -158,7 +215,8 @@ class CourseItem(Resource):
                 'Conflict',
                 f"Course with code '{course.code}' already exists."
             )
-        self._clear_cache()
+        self._clear_cache(course, CollectionChange(
+            "update", "course_id", course.course_id, CourseCollection.collection_item(course)))
         return Response(status=204)
 
     @swag_from(f"{DOC_FOLDER}course_item/delete.yml")
@@ -170,48 +228,51 @@ class CourseItem(Resource):
             has to be modified
         Returns: 204 if the course is correctly deleted
         """
-        db.session.delete(course)
+        instance = course.load()
+        # the assessments are deleted as well, changing the representations of their students
+        student_ids = db.session.query(Assessment.student_id) \
+            .filter_by(course_id=course.course_id).all()
+        db.session.delete(instance)
         db.session.commit()
-        self._clear_cache()
+        self._clear_cache(course, CollectionChange("delete", "course_id", course.course_id, None),
+                          ASSESSMENTS_TAG,
+                          *[student_tag(student_id) for student_id, in student_ids])
         return Response(status=204)
 
-    def _clear_cache(self):
-        collection_path = url_for('api.coursecollection')
-        cache.delete_many(
-            collection_path,
-            request.path,
-        )
+    def _clear_cache(self, course, change, *tags):
+        record_changes(COURSES_TAG, change)
+        invalidate_tags(course_tag(course.course_id), *tags)
 
 
 class CourseConverter(BaseConverter):
     """
     URLConverter for course resource.
-    to_python takes a course_id and returns a Course object.
-    to_url takes a Course object and returns the corresponding course_id
+    to_python takes a course_id and returns a LazyInstance of Course, so that the database is
+        only queried when the view actually needs the course.
+    to_url takes a Course object (or a LazyInstance, or a course_id) and returns the
+        corresponding course_id
     """
 
     def to_python(self, value):
         """
-        Converts a course_id in a course object by retrieving the information from the database
+        Converts a course_id in a lazily loaded course object
         :param value: str representing the course id
-        raises a NotFound error if it is impossible to convert the string in an int or if the
-            course is not found
-        :return: a course object corresponding to the course_id
+        :raise: a NotFound error if it is impossible to convert the string in an int. If the
+            course does not exist, NotFound is raised when the object is first accessed
+        :return: a LazyInstance of Course corresponding to the course_id
         """
         try:
             int_id = int(value)
         except ValueError as exc:
             raise NotFound from exc
-
-        db_course = Course.query.filter_by(course_id=int_id).first()
-        if db_course is None:
-            raise NotFound
-        return db_course
+        return LazyInstance(Course, "course_id", int_id)
 
     def to_url(self, value):
         """
-        Transforms a course object in a value usable in the URI
-        :param value: course Object
+        Transforms a course object in a value usable in the URI.
+        A course_id can be used directly as well, so that URLs can be built from foreign keys
+            without loading the related object from the database
+        :param value: Course Object or course_id
         :return: the value
         """
-        return str(value.course_id)
+        return str(getattr(value, "course_id", value))
@@ -15,6 +15,7 @@ from flask_restful import Resource
 
 from studentmanager import DOC_FOLDER, NAMESPACE, LINK_RELATIONS_URL
 from studentmanager.builder import StudentManagerBuilder
+from studentmanager.caching import cached_resource
 from studentmanager.constants import STUDENT_PROFILE, PROFILE_PICTURE_MIMETYPE, PICTURE_FOLDER
 
 
@@ -32,12 +33,16 @@ class ProfilePictureItem(Resource):
     # must explicitly specify current working directory because otherwise
     # it will look in in cache dir
     @swag_from(os.getcwd() + f"{DOC_FOLDER}picture_item/get.yml")
+    @cached_resource("student:{student.student_id}")
     def get(self, student):
         """
         Returns the profile picture of the student
         :param student: takes a student object containing the information about the student
         """
 
+        # raises NotFound if the student does not exist
+        student.load()
+
         # To change with the student's id for full implementation
         picture_filename = 'sample.jpeg'
         with open(os.getcwd() + f"{PICTURE_FOLDER}{picture_filename}", "rb") as img_file:
@@ -4,25 +4,31 @@ This module contains all the classes related to the Student resource:
  - a singular student
  - the related URL converter
 """
-import json
 import os
 
 from flasgger import swag_from
 from flask import request, url_for, Response
 from flask_restful import Resource
-from jsonschema import validate, ValidationError
-from jsonschema.validators import Draft7Validator
+from jsonschema import ValidationError
 from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import NotFound
 from werkzeug.routing import BaseConverter
 
-from studentmanager import cache
 from studentmanager import db
-from studentmanager.builder import StudentManagerBuilder, create_error_response
+from studentmanager.builder import \
+    StudentManagerBuilder, create_error_response, wants_compact, negotiated_view, uri_template, \
+    compact_document
+from studentmanager.caching import \
+    cached_resource, invalidate_tags, record_changes, CollectionChange, student_tag, course_tag, \
+    STUDENTS_TAG, ASSESSMENTS_TAG
 from studentmanager.constants \
-    import STUDENT_PROFILE, MASON, LINK_RELATIONS_URL, NAMESPACE, DOC_FOLDER
-from studentmanager.models import Student, require_admin_key
-from studentmanager.utils import request_path_cache_key
+    import STUDENT_PROFILE, MASON, JSON, LINK_RELATIONS_URL, NAMESPACE, DOC_FOLDER
+from studentmanager.fieldsets import \
+    get_fieldset, has_all_fields, has_controls, load_options, fieldset_kind
+from studentmanager.fragments import get_fragments, encode_document
+from studentmanager.models import Student, Assessment, require_admin_key
+from studentmanager.pagination import paginate, get_sort, has_default_order
+from studentmanager.utils import LazyInstance
 
 
 class StudentCollection(Resource):
@@ -33,27 +39,48 @@ class StudentCollection(Resource):
     # must explicitly specify current working directory because otherwise
     # it will look in in cache dir
     @swag_from(os.getcwd() + f"{DOC_FOLDER}student_collection/get.yml")
-    @cache.cached(timeout=None, make_cache_key=request_path_cache_key)
+    # the changes recorded for the collection are full Mason items, in the default order
+    @cached_resource(STUDENTS_TAG, vary={"Accept": negotiated_view},
+                     patchable=lambda: has_default_order() and has_all_fields()
+                     and not wants_compact())
     def get(self):
         """
-        Get the list of al the students as a json response
+        Get a page of the list of all the students as a json response, ordered by student_id
+            or as requested with the sort parameter (see Student.SORTS).
+        The compact representation is returned if requested (see builder.wants_compact).
+        Returns 400 if the pagination, sort or fields parameters are not valid
         """
 
-        body = StudentManagerBuilder(items=[])
-
-        for student in Student.query.all():
-            item = StudentManagerBuilder(student.serialize(short_form=True))
-            item.add_control("self", url_for('api.studentitem', student=student))
-            item.add_control("profile", STUDENT_PROFILE)
-            body["items"].append(item)
+        try:
+            fields = get_fieldset(Student)
+            columns, descending = get_sort(Student)
+            page = paginate(Student.query.options(*load_options(Student, fields, columns)),
+                            columns, descending=descending)
+        except ValueError:
+            return create_error_response(400, 'Bad Request', "Invalid query parameters")
+
+        compact = wants_compact()
+        if compact:
+            items = get_fragments(
+                fieldset_kind("student", fields), page.items,
+                lambda student: student.serialize(short_form=True, fields=fields), compact=True)
+        else:
+            items = get_fragments(
+                fieldset_kind("student-item", fields), page.items,
+                lambda student: self.collection_item(student, fields))
+        body = StudentManagerBuilder(items=items)
 
         body.add_namespace(NAMESPACE, LINK_RELATIONS_URL)
         body.add_control("self", url_for('api.studentcollection'))
+        body.add_control_pagination('api.studentcollection', page)
         body.add_control_add_student()
         body.add_control_all_courses()
         body.add_control_all_assessments()
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        if compact:
+            body = compact_document(body, uri_template('api.studentitem', student="student_id"))
+            return Response(encode_document(body, compact=True), 200, mimetype=JSON)
+        return Response(encode_document(body), 200, mimetype=MASON)
 
     @swag_from(f"{DOC_FOLDER}student_collection/post.yml")
     @require_admin_key
@@ -71,8 +98,7 @@ class StudentCollection(Resource):
         student = Student()
 
         try:
-            validate(request.json, Student.json_schema(),
-                     format_checker=Draft7Validator.FORMAT_CHECKER)
+            Student.json_validator().validate(request.json)
 
             student.deserialize(request.json)
 
@@ -89,7 +115,7 @@ class StudentCollection(Resource):
                 f"Student with ssn '{student.ssn}' already exists."
             )
 
-        self._clear_cache()
+        self._clear_cache(student)
         return Response(
             status=201,
             headers={
@@ -97,10 +123,22 @@ class StudentCollection(Resource):
             }
         )
 
-    def _clear_cache(self):
-        cache.delete(
-            request.path
-        )
+    @staticmethod
+    def collection_item(student, fields=None):
+        """
+        :param student: the student object
+        :param fields: the fieldset of the request (see fieldsets.get_fieldset)
+        :return: the representation of student in the collection
+        """
+        item = StudentManagerBuilder(student.serialize(short_form=True, fields=fields))
+        if has_controls(fields):
+            item.add_control("self", url_for('api.studentitem', student=student))
+            item.add_control("profile", STUDENT_PROFILE)
+        return item
+
+    def _clear_cache(self, student):
+        record_changes(STUDENTS_TAG, CollectionChange(
+            "create", "student_id", student.student_id, self.collection_item(student)))
 
 
 class StudentItem(Resource):
@@ -112,14 +150,27 @@ class StudentItem(Resource):
     # must explicitly specify current working directory because otherwise
     # it will look in in cache dir
     @swag_from(os.getcwd() + f"{DOC_FOLDER}student_item/get.yml")
-    @cache.cached(timeout=None, make_cache_key=request_path_cache_key)
+    @cached_resource("student:{student.student_id}")
     def get(self, student):
         """
-        Returns the representation of the student
+        Returns the representation of the student, with the fields parameter only the selected
+            attributes (and 'assessments'), without the controls unless '@controls' is selected.
+        Returns 400 if the fields are not valid
         :param student: takes a student object containing the information about the student
         """
 
-        body = StudentManagerBuilder(student.serialize())
+        try:
+            fields = get_fieldset(Student, extra=["assessments"])
+        except ValueError:
+            return create_error_response(400, 'Bad Request', "Invalid fields")
+        student.load(*load_options(Student, fields))
+
+        body = StudentManagerBuilder(student.serialize(short_form=True, fields=fields))
+        if fields is None or "assessments" in fields:
+            body["assessments"] = get_fragments("assessment", student.assessments,
+                                                Assessment.serialize)
+        if not has_controls(fields):
+            return Response(encode_document(body), 200, mimetype=MASON)
 
         self_url = url_for('api.studentitem', student=student)
 
@@ -133,7 +184,7 @@ class StudentItem(Resource):
         body.add_control_student_assessments(student)
         body.add_control(f"{NAMESPACE}:propic", self_url + "profilePicture/")
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return Response(encode_document(body), 200, mimetype=MASON)
 
     @swag_from(f"{DOC_FOLDER}student_item/put.yml")
     @require_admin_key
@@ -148,14 +199,15 @@ class StudentItem(Resource):
             is not in the past)
         Returns 204 if the student has correctly been updated
         """
+        # a missing student is reported before an invalid body
+        student.load()
 
         try:
-            validate(request.json, Student.json_schema(),
-                     format_checker=Draft7Validator.FORMAT_CHECKER)
+            Student.json_validator().validate(request.json)
 
             student.deserialize(request.json)
 
-            db.session.add(student)
+            db.session.add(student.load())
             db.session.commit()
         except ValidationError:
             return create_error_response(400, 'Bad Request', "Invalid request format")
@@ -168,7 +220,8 @@ class StudentItem(Resource):
                 f"Student with ssn '{student.ssn}' already exists."
             )
 
-        self._clear_cache()
+        self._clear_cache(student, CollectionChange(
+            "update", "student_id", student.student_id, StudentCollection.collection_item(student)))
         return Response(status=204)
 
     @swag_from(f"{DOC_FOLDER}student_item/delete.yml")
@@ -180,47 +233,52 @@ class StudentItem(Resource):
             to be modified
         :return: 204 if the student is correctly deleted
         """
-        db.session.delete(student)
+        instance = student.load()
+        # the assessments are deleted as well, changing the representations of their courses
+        course_ids = db.session.query(Assessment.course_id) \
+            .filter_by(student_id=student.student_id).all()
+        db.session.delete(instance)
         db.session.commit()
-        self._clear_cache()
+        self._clear_cache(student,
+                          CollectionChange("delete", "student_id", student.student_id, None),
+                          ASSESSMENTS_TAG,
+                          *[course_tag(course_id) for course_id, in course_ids])
         return Response(status=204)
 
-    def _clear_cache(self):
-        collection_path = url_for('api.studentcollection')
-        cache.delete_many(
-            collection_path,
-            request.path,
-        )
+    def _clear_cache(self, student, change, *tags):
+        record_changes(STUDENTS_TAG, change)
+        invalidate_tags(student_tag(student.student_id), *tags)
 
 
 class StudentConverter(BaseConverter):
     """
     URLConverter for student resource.
-    to_python takes a student_id and returns a Student object.
-    to_url takes a Student object and returns the corresponding student_id
+    to_python takes a student_id and returns a LazyInstance of Student, so that the database is
+        only queried when the view actually needs the student.
+    to_url takes a Student object (or a LazyInstance, or a student_id) and returns the
+        corresponding student_id
     """
 
     def to_python(self, value):
         """
-        Converts a student_id in a student object by retrieving the information from the database
+        Converts a student_id in a lazily loaded student object
         :param value: str representing the student id
-        :raise: a NotFound error if it is impossible to convert the string in an int or if the
-            student is not found
-        :return: a student object corresponding to the student_id
+        :raise: a NotFound error if it is impossible to convert the string in an int. If the
+            student does not exist, NotFound is raised when the object is first accessed
+        :return: a LazyInstance of Student corresponding to the student_id
         """
         try:
             int_id = int(value)
         except ValueError as exc:
             raise NotFound from exc
-        db_student = Student.query.filter_by(student_id=int_id).first()
-        if db_student is None:
-            raise NotFound
-        return db_student
+        return LazyInstance(Student, "student_id", int_id)
 
     def to_url(self, value):
         """
-        Transforms a student object in a value usable in the URI
-        :param value: Student Object
+        Transforms a student object in a value usable in the URI.
+        A student_id can be used directly as well, so that URLs can be built from foreign keys
+            without loading the related object from the database
+        :param value: Student Object or student_id
         :return: the value
         """
-        return str(value.student_id)
+        return str(getattr(value, "student_id", value))
@@ -1,13 +1,16 @@
 """
 This module contains utility functions for the application, mainly related to SSN validation
     and generation.
-The function request_path_cache_key is used to correctly generate the cache keys for GET
-    functions of Resources
+The functions related to cache generations are used to invalidate any data derived from the
+    database, e.g. the responses cached by studentmanager.caching
+The class LazyInstance is returned by the URL converters to delay database queries
 """
 import random
 import re
+import secrets
+from urllib.parse import quote, urlencode
 
-from flask import request
+from werkzeug.exceptions import NotFound
 
 
 # information on how the ssn is generated and/or validate can be found at
@@ -56,27 +59,136 @@ def generate_century_character(date):
     return year_map[year_digits]
 
 
-def generate_ssn(date):
+def generate_ssn(date, rng=random):
     """
     Generate a valid ssn from the fiven date of birth. The sequential section (characters 8-10)
         are randomly generated with no regard for gender or sequentiality.
     :param date: datetime.date object indicating the date of birth for which to generate a
         valid ssn
+    :param rng: the random number generator to use, e.g. a seeded random.Random instance
     :return: return a string indicating a valid ssn
     """
     date_string = date.strftime("%d%m%y")
     century_character = generate_century_character(date)
-    serial_number = random.randrange(2, 900)
+    serial_number = rng.randrange(2, 900)
     partial_ssn = f'{date_string}{century_character}{serial_number:03d}'
     control_character = generate_control_character(partial_ssn)
     return f'{partial_ssn}{control_character}'
 
 
-def request_path_cache_key(*args, **kwargs):
+def get_cache_generation(name):
     """
-    Helper function for caching Resources. Fix for cache.cached not working with
-        request.path as default.
-    Used in all get functions in the application
-    :return: returns a string which is the desired cache key "request.path"
+    Returns the current generation of name. Generations are random tokens stored in the cache,
+        shared by all the processes using it, and are used to build cache keys (or in-memory
+        copies of data) that can all be invalidated at once by renewing the generation.
+    A missing generation (never created, or evicted from the cache) is replaced by a new one,
+        so that nothing built on a previous generation is ever used again. It is created with
+        cache.add and read back, so that concurrent callers all get the same one.
+    :param name: the name of the generation, e.g. the path of a resource
+    :return: a string representing the current generation
     """
-    return request.path
+    generation, = get_cache_generations([name])
+    return generation
+
+
+def get_cache_generations(names):
+    """
+    Returns the current generations of all the given names with a single cache read, creating
+        the missing ones as get_cache_generation does
+    :param names: list of the names of the generations
+    :return: a list with the generations, in the same order as names
+    """
+    # import not at the top of the file to avoid circular imports
+    from studentmanager import cache
+
+    generation_keys = [f"generation:{name}" for name in names]
+    generations = cache.get_many(*generation_keys)
+    missing = [index for index, generation in enumerate(generations) if generation is None]
+    for index in missing:
+        cache.add(generation_keys[index], secrets.token_hex(8), timeout=0)
+    if missing:
+        created = cache.get_many(*[generation_keys[index] for index in missing])
+        for index, generation in zip(missing, created):
+            generations[index] = generation
+    return generations
+
+
+def renew_cache_generations(*names):
+    """
+    Renews the generations of the given names, invalidating everything built on them.
+    The generations are replaced by new tokens rather than deleted, so that the requests
+        following a write all agree on the new ones.
+    :param names: the names of the generations to renew
+    """
+    # import not at the top of the file to avoid circular imports
+    from studentmanager import cache
+
+    cache.set_many({f"generation:{name}": secrets.token_hex(8) for name in names}, timeout=0)
+
+
+def replace_cache_generation(name):
+    """
+    Renews the generation of name with a new token, like renew_cache_generations, but returns
+        the previous and the new generation, so that the change can be recorded.
+    Concurrent calls must be serialized by the caller.
+    :param name: the name of the generation
+    :return: a (previous generation, new generation) tuple
+    """
+    # import not at the top of the file to avoid circular imports
+    from studentmanager import cache
+
+    previous, = get_cache_generations([name])
+    generation = secrets.token_hex(8)
+    cache.set(f"generation:{name}", generation, timeout=0)
+    return previous, generation
+
+
+def canonical_query_string(args):
+    """
+    Encodes query parameters in a canonical form, sorted by name and value and with the same
+        percent-encoding, so that equivalent query strings (e.g. with the parameters in another
+        order) are encoded in the same way
+    :param args: the MultiDict of the query parameters, e.g. request.args
+    :return: the encoded query string
+    """
+    return urlencode(sorted(args.items(multi=True)), quote_via=quote)
+
+
+class LazyInstance:
+    """
+    Stand-in for a database instance, returned by the URL converters.
+    Only the identifier is known when the object is created: the instance is retrieved from the
+        database the first time any other attribute is accessed (or load is called), so that
+        responses served from the cache never query the database.
+    """
+
+    def __init__(self, model, id_name, value):
+        """
+        :param model: the Model class of the instance
+        :param id_name: the name of the primary key attribute of model
+        :param value: the value of the primary key
+        """
+        self._model = model
+        self._id_name = id_name
+        self._instance = None
+        setattr(self, id_name, value)
+
+    def load(self, *options):
+        """
+        Retrieves the instance from the database, if not already done
+        :param options: the loader options of the query, e.g. load_only
+        :return: the database instance
+        :raise NotFound: if no instance exists with the given identifier
+        """
+        if self._instance is None:
+            self._instance = self._model.query.options(*options) \
+                .filter_by(**{self._id_name: getattr(self, self._id_name)}).first()
+            if self._instance is None:
+                raise NotFound
+        return self._instance
+
+    def __getattr__(self, name):
+        # only called for the attributes that are not set on the stand-in itself
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
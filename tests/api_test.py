@@ -1,19 +1,35 @@
 # based on http://flask.pocoo.org/docs/1.0/testing/
 # we don't need a client for database testing, just the db handle
 import datetime
+import gzip
 import json
 import os
 import shutil
+import struct
 import tempfile
+import threading
+import time
 
+import click
 import pytest
+from flask import Response
 from flask.testing import FlaskClient
 from jsonschema.validators import validate
+from sqlalchemy import event
 from werkzeug.datastructures import Headers
 
-from studentmanager import create_app, db
-from studentmanager.constants import NAMESPACE
-from studentmanager.models import Assessment, Student, Course, ApiKey
+from studentmanager import create_app, db, cache
+from studentmanager.builder import negotiated_view
+from studentmanager import caching
+from studentmanager.caching import \
+    TwoTierCache, CachedResponse, AccessCounter, access_counter, invalidate_tags, stale_key, \
+    request_cache_key, CollectionChange, ACCESS_COUNTS_KEY, STUDENTS_TAG, COURSES_TAG, \
+    ASSESSMENTS_TAG, STALE_WARNING
+from studentmanager.constants import NAMESPACE, MASON
+from studentmanager import fragments
+from studentmanager.fragments import FragmentList, encode_document, stream_document
+from studentmanager.models import \
+    Assessment, Student, Course, ApiKey, generate_master_key, cache_warm_command
 
 TEST_KEY = "verysafetestkey"
 
@@ -109,6 +125,54 @@ def _check_control_post_method(ctrl, client, obj, obj_to_post):
     assert resp.status_code == 201
 
 
+def _count_queries(client, url, method="GET", **kwargs):
+    """
+    Performs a request to url (GET by default) and counts the SQL statements executed while
+        serving it.
+    Returns the response and the number of statements.
+    """
+    with client.application.app_context():
+        engine = db.engine
+    statements = []
+
+    def _record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", _record)
+    try:
+        resp = client.open(url, method=method, **kwargs)
+    finally:
+        event.remove(engine, "before_cursor_execute", _record)
+    return resp, len(statements)
+
+
+def _query_plans(client, url):
+    """
+    Performs a GET request to url and runs EXPLAIN QUERY PLAN on every SQL statement executed
+        while serving it.
+    Returns a list of (statement, plan details) tuples.
+    """
+    with client.application.app_context():
+        engine = db.engine
+    statements = []
+
+    def _record(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", _record)
+    try:
+        client.get(url)
+    finally:
+        event.remove(engine, "before_cursor_execute", _record)
+
+    plans = []
+    with engine.connect() as conn:
+        for statement, parameters in statements:
+            rows = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)
+            plans.append((statement, [row[3] for row in rows]))
+    return plans
+
+
 # https://stackoverflow.com/questions/16416001/set-http-headers-for-all-requests-in-a-flask-test
 class AuthHeaderClient(FlaskClient):
 
@@ -274,11 +338,1113 @@ class TestEntrypoint(object):
         _check_control_get_method(f"{NAMESPACE}:students-all", client, body)
         _check_control_get_method(f"{NAMESPACE}:courses-all", client, body)
         _check_control_get_method(f"{NAMESPACE}:assessments-all", client, body)
+        # the entrypoint is cached like the resources
+        resp = client.get(self.ENTRYPOINT_URL,
+                          headers=Headers({"If-None-Match": resp.headers["ETag"]}))
+        assert resp.status_code == 304
+
+
+class TestQueryPlans(object):
+    URLS = [
+        "/api/students/",
+        "/api/students/?after=WzFd",
+        "/api/students/1/",
+        "/api/courses/",
+        "/api/courses/?after=WzFd",
+        "/api/courses/1/",
+        "/api/assessments/",
+        "/api/assessments/?after=WzEsMV0",
+        "/api/courses/1/assessments/",
+        "/api/students/1/assessments/",
+        "/api/courses/1/assessments/1/",
+        "/api/students/1/assessments/1/",
+    ]
+
+    def test_endpoints_use_indexes(self, client):
+        """
+        Checks that no endpoint sorts in a temporary B-tree or scans a whole table: a scan
+            without index is only allowed when bounded by the page size
+        """
+        for url in self.URLS:
+            plans = _query_plans(client, url)
+            assert plans, url
+            for statement, plan in plans:
+                for detail in plan:
+                    assert "TEMP B-TREE" not in detail, (url, detail)
+                    if detail.startswith("SCAN") and "USING" not in detail:
+                        assert "LIMIT" in statement, (url, detail)
+
+
+class TestCachedResponses(object):
+    URLS = [
+        "/api/students/",
+        "/api/students/1/",
+        "/api/courses/",
+        "/api/courses/1/",
+        "/api/assessments/",
+        "/api/courses/1/assessments/",
+        "/api/students/1/assessments/",
+        "/api/courses/1/assessments/1/",
+        "/api/students/1/assessments/1/",
+    ]
+
+    def test_cache_hit_without_queries(self, client):
+        """Checks that responses served from the cache never query the database"""
+        for url in self.URLS:
+            first, _ = _count_queries(client, url)
+            assert first.status_code == 200
+            second, count = _count_queries(client, url)
+            assert second.status_code == 200
+            assert second.data == first.data
+            assert count == 0, url
+
+    def test_nonexistent_resources(self, client):
+        """Checks that lazily loaded students and courses still return 404 if they don't exist"""
+        for url in ["/api/students/999/", "/api/courses/999/", "/api/students/999/assessments/",
+                    "/api/courses/999/assessments/", "/api/students/999/profilePicture/",
+                    "/api/courses/1/assessments/999/", "/api/students/999/assessments/1/"]:
+            resp = client.get(url)
+            assert resp.status_code == 404, url
+
+
+class TestCacheKeys(object):
+
+    def test_equivalent_queries(self, client):
+        """Checks that equivalent query strings are served by the same entry"""
+        first, _ = _count_queries(client, "/api/assessments/?limit=2&after=WzEsMV0")
+        assert first.status_code == 200
+        for url in ["/api/assessments/?after=WzEsMV0&limit=2",
+                    "/api/assessments/?limit=%32&after=WzEsMV0"]:
+            resp, count = _count_queries(client, url)
+            assert count == 0, url
+            assert resp.get_etag() == first.get_etag()
+            assert resp.data == first.data
+
+    def test_long_queries(self, client):
+        """Checks that long variants are hashed, and still invalidated with the resource"""
+        url = "/api/students/?unused=" + "a" * 500
+        with client.application.test_request_context(url):
+            key = request_cache_key([STUDENTS_TAG])
+        assert len(key) < 100
+        assert key.startswith("/api/students/?~")
+
+        first = json.loads(client.get(url).data)
+        assert client.post("/api/students/", json=_get_student_json()).status_code == 201
+        second = json.loads(client.get(url).data)
+        assert len(second["items"]) == len(first["items"]) + 1
+
+    def test_vary(self, client):
+        """Checks that the headers a response depends on are normalized in its key"""
+        app = client.application
+        keys = []
+        for accept in ["application/json, text/html;q=0.5", "Text/HTML;q=0.5,application/json",
+                       "application/json"]:
+            with app.test_request_context("/api/students/", headers={"Accept": accept}):
+                keys.append(request_cache_key([STUDENTS_TAG], vary=["Accept"]))
+        assert keys[0] == keys[1]
+        assert keys[0] != keys[2]
+        assert "|accept=" in keys[0]
+
+        # negotiated headers are keyed on the representation they select
+        keys = {}
+        for accept in [None, "*/*", "application/vnd.mason+json, */*", "application/json",
+                       "application/json, text/html;q=0.5"]:
+            headers = {} if accept is None else {"Accept": accept}
+            with app.test_request_context("/api/students/", headers=headers):
+                key = request_cache_key([STUDENTS_TAG], vary={"Accept": negotiated_view})
+                keys.setdefault(key, []).append(accept)
+        assert list(keys.values()) == [
+            [None, "*/*", "application/vnd.mason+json, */*"],
+            ["application/json", "application/json, text/html;q=0.5"]]
+
+
+class TestConditionalRequests(object):
+    URLS = TestCachedResponses.URLS + ["/api/students/1/profilePicture/"]
+
+    def test_not_modified_without_queries(self, client):
+        """Checks that every GET has an ETag and that If-None-Match is answered with 304"""
+        for url in self.URLS:
+            resp = client.get(url)
+            assert resp.status_code == 200
+            etag, weak = resp.get_etag()
+            assert etag and not weak
+            assert client.get(url).get_etag() == (etag, False)
+
+            resp, count = _count_queries(client, url,
+                                         headers=Headers({"If-None-Match": f'"{etag}"'}))
+            assert resp.status_code == 304, url
+            assert resp.data == b""
+            assert resp.get_etag() == (etag, False)
+            assert count == 0
+
+            resp = client.get(url, headers=Headers({"If-None-Match": '"other"'}))
+            assert resp.status_code == 200
+            resp = client.get(url, headers=Headers({"If-None-Match": "*"}))
+            assert resp.status_code == 304
+            assert resp.get_etag() == (etag, False)
+
+    def test_star_tag_missing_resource(self, client):
+        """Checks that 'If-None-Match: *' does not hide that a resource does not exist"""
+        for url in ["/api/students/999/", "/api/courses/999/", "/api/students/999/assessments/",
+                    "/api/courses/1/assessments/999/"]:
+            resp = client.get(url, headers=Headers({"If-None-Match": "*"}))
+            assert resp.status_code == 404, url
+
+    def test_etag_changes_on_write(self, client):
+        """Checks that modifying a resource changes the ETag of the affected representations"""
+        urls = ["/api/students/", "/api/students/1/", "/api/students/1/profilePicture/"]
+        etags = {url: client.get(url).get_etag()[0] for url in urls}
+        resp = client.put("/api/students/1/", json=_get_student_json())
+        assert resp.status_code == 204
+        for url in urls:
+            resp = client.get(url, headers=Headers({"If-None-Match": f'"{etags[url]}"'}))
+            assert resp.status_code == 200, url
+            assert resp.get_etag()[0] != etags[url]
+
+    def test_pages_have_different_etags(self, client):
+        """Checks that different query strings are different representations"""
+        first = client.get("/api/students/?limit=1").get_etag()[0]
+        resp = client.get("/api/students/?limit=2",
+                          headers=Headers({"If-None-Match": f'"{first}"'}))
+        assert resp.status_code == 200
+        assert resp.get_etag()[0] != first
+
+
+class TestCacheInvalidation(object):
+
+    @staticmethod
+    def _assessment_ids(client, url):
+        body = json.loads(client.get(url).data)
+        items = body["items"] if "items" in body else body["assessments"]
+        return {(item["course_id"], item["student_id"]) for item in items}
+
+    def test_student_delete(self, client):
+        """Checks that deleting a student invalidates the assessments of its courses"""
+        urls = ["/api/assessments/", "/api/courses/1/", "/api/courses/1/assessments/",
+                "/api/courses/2/assessments/"]
+        for url in urls:
+            assert any(student_id == 1 for _, student_id in self._assessment_ids(client, url))
+        assert client.delete("/api/students/1/").status_code == 204
+        for url in urls:
+            assert all(student_id != 1 for _, student_id in self._assessment_ids(client, url))
+
+    def test_course_delete(self, client):
+        """Checks that deleting a course invalidates the assessments of its students"""
+        urls = ["/api/assessments/", "/api/students/1/", "/api/students/1/assessments/",
+                "/api/students/3/assessments/"]
+        for url in urls:
+            assert any(course_id == 1 for course_id, _ in self._assessment_ids(client, url))
+        assert client.delete("/api/courses/1/").status_code == 204
+        for url in urls:
+            assert all(course_id != 1 for course_id, _ in self._assessment_ids(client, url))
+
+    def test_assessment_moved(self, client):
+        """Checks that moving an assessment to another course invalidates both courses"""
+        assert (1, 1) in self._assessment_ids(client, "/api/courses/1/assessments/")
+        assert self._assessment_ids(client, "/api/courses/3/assessments/") == set()
+        assert client.get("/api/courses/1/assessments/1/").status_code == 200
+
+        moved = _get_existing_assessment_json()
+        moved["course_id"] = 3
+        assert client.put("/api/students/1/assessments/1/", json=moved).status_code == 204
+
+        assert (1, 1) not in self._assessment_ids(client, "/api/courses/1/assessments/")
+        assert self._assessment_ids(client, "/api/courses/3/assessments/") == {(3, 1)}
+        assert self._assessment_ids(client, "/api/courses/3/") == {(3, 1)}
+        assert client.get("/api/courses/1/assessments/1/").status_code == 404
+
+
+class TestCollectionPatching(object):
+
+    @staticmethod
+    def _rebuilt(client, url):
+        """Returns the body of url built by the view, with an empty cache"""
+        with client.application.app_context():
+            cache.clear()
+        return client.get(url).data
+
+    def test_create_update_delete(self, client):
+        """Checks that the cached pages are patched, giving the same body as the view"""
+        for url in ["/api/students/", "/api/students/?limit=5"]:
+            client.get(url)
+        assert client.post("/api/students/", json=_get_student_json()).status_code == 201
+        existing = _get_existing_student_json()
+        existing["first_name"] = "Scorpius"
+        assert client.put("/api/students/1/", json=existing).status_code == 204
+        assert client.delete("/api/students/2/").status_code == 204
+
+        patched = {}
+        for url in ["/api/students/", "/api/students/?limit=5"]:
+            resp, count = _count_queries(client, url)
+            assert count == 0
+            patched[url] = resp.data
+        ids = [item["student_id"] for item in json.loads(patched["/api/students/"])["items"]]
+        assert ids == [1, 3, 4]
+        for url, data in patched.items():
+            assert data == self._rebuilt(client, url)
+
+    def test_course_collection(self, client):
+        """Checks that the courses collection is patched as well"""
+        client.get("/api/courses/")
+        assert client.post("/api/courses/", json=_get_course_json()).status_code == 201
+        resp, count = _count_queries(client, "/api/courses/")
+        assert count == 0
+        assert resp.data == self._rebuilt(client, "/api/courses/")
+
+    def test_rebuilt_pages(self, client):
+        """Checks that pages whose boundaries would change are rebuilt by the view"""
+        client.get("/api/students/?limit=3")
+        client.get("/api/students/?limit=1")
+        assert client.post("/api/students/", json=_get_student_json()).status_code == 201
+        # the new student goes to a new page, a next control is needed
+        resp, count = _count_queries(client, "/api/students/?limit=3")
+        assert count > 0
+        assert "next" in json.loads(resp.data)["@controls"]
+
+        # a student moves from the next page
+        assert client.delete("/api/students/1/").status_code == 204
+        resp, count = _count_queries(client, "/api/students/?limit=1")
+        assert count > 0
+        assert json.loads(resp.data)["items"][0]["student_id"] == 2
+
+        # changes not recorded in the changelog
+        client.get("/api/students/")
+        with client.application.app_context():
+            invalidate_tags(STUDENTS_TAG)
+        assert _count_queries(client, "/api/students/")[1] > 0
+
+    def test_apply(self):
+        """Checks the changes applied to a single page"""
+        page = {"items": [{"id": 1}, {"id": 2}], "@controls": {"prev": {}}}
+        assert CollectionChange("update", "id", 2, {"id": 2, "x": 1}).apply(page)
+        assert page["items"][1] == {"id": 2, "x": 1}
+        assert CollectionChange("delete", "id", 5, None).apply(page)
+        assert not CollectionChange("delete", "id", 1, None).apply(page)
+        assert CollectionChange("delete", "id", 2, None).apply(page)
+        assert page["items"] == [{"id": 1}]
+        # already in the page, i.e. built after the change
+        assert CollectionChange("create", "id", 1, {"id": 1}).apply(page)
+        assert page["items"] == [{"id": 1}]
+        assert not CollectionChange("create", "id", 3, {"id": 3}).apply({"@controls": {}})
+
+
+class TestFragments(object):
+
+    @staticmethod
+    def _fragment_stats(client):
+        with client.application.app_context():
+            stats = cache.cache.stats()
+        return stats["fragment_hits"], stats["fragment_misses"]
+
+    def test_changed_entities(self, client):
+        """Checks that only the fragments of the modified entities are serialized again"""
+        first = json.loads(client.get("/api/students/1/assessments/").data)
+        assert self._fragment_stats(client) == (0, len(first["items"]))
+        client.get("/api/students/1/")
+
+        modified = _get_existing_assessment_json()
+        modified["grade"] = 1
+        assert client.put("/api/students/1/assessments/1/", json=modified).status_code == 204
+        hits, misses = self._fragment_stats(client)
+        second = json.loads(client.get("/api/students/1/assessments/").data)
+        assert self._fragment_stats(client) == (hits + len(first["items"]) - 1, misses + 1)
+        assert [item["grade"] for item in second["items"]] == \
+            [1] + [item["grade"] for item in first["items"][1:]]
+
+        # the embedded assessments of the student are fragments as well
+        body = json.loads(client.get("/api/students/1/").data)
+        assert self._fragment_stats(client)[1] == misses + 2
+        assert body["assessments"][0]["grade"] == 1
+        assert list(body)[:6] == ["student_id", "first_name", "last_name", "date_of_birth",
+                                  "ssn", "assessments"]
+
+    def test_encode_document(self):
+        """Checks that joined fragments give the same document as json.dumps"""
+        document = {"a": "\x00", "items": [{"x": 1}, {"y": [2]}], "empty": [], "@controls": {}}
+        fragments = dict(document, items=FragmentList(json.dumps(i) for i in document["items"]),
+                         empty=FragmentList())
+        assert encode_document(fragments) == json.dumps(document)
+
+    def test_stream_document(self, monkeypatch):
+        """Checks that streamed documents are returned in chunks, starting with the envelope"""
+        monkeypatch.setattr(fragments, "STREAM_BATCH_SIZE", 2)
+        document = {"items": [{"x": 1}, {"y": [2]}, {"z": "\x00"}], "@controls": {"a": {}}}
+        consumed = []
+
+        def _items():
+            for item in document["items"]:
+                consumed.append(item)
+                yield json.dumps(item)
+
+        parts = stream_document(dict(document, items=None), "items", _items())
+        assert next(parts) == '{"items": ['
+        assert not consumed
+        rest = list(parts)
+        assert len(rest) == 2
+        assert '{"items": [' + "".join(rest) == json.dumps(document)
+        assert "".join(stream_document({"items": None}, "items", [])) == '{"items": []}'
+
+
+class TestCompactRepresentation(object):
+
+    COMPACT = Headers({"Accept": "application/json"})
+
+    def test_negotiation(self, client):
+        """Checks that Mason stays the default, and that every variant is cached apart"""
+        mason = client.get("/api/students/")
+        assert mason.mimetype == MASON
+        assert "Accept" in mason.vary
+        compact = client.get("/api/students/", headers=self.COMPACT)
+        assert compact.mimetype == "application/json"
+        assert compact.get_etag() != mason.get_etag()
+        assert len(compact.data) < len(mason.data) / 2
+
+        for url, headers in [("/api/students/?view=compact", Headers()),
+                             ("/api/students/?view=compact",
+                              Headers({"Accept": "application/vnd.mason+json"}))]:
+            assert client.get(url, headers=headers).data == compact.data
+        for headers in [Headers({"Accept": "*/*"}),
+                        Headers({"Accept": "application/json, application/vnd.mason+json"}),
+                        Headers({"Accept": "application/json;q=0.5, */*"})]:
+            assert client.get("/api/students/", headers=headers).data == mason.data
+        assert client.get("/api/students/?view=mason", headers=self.COMPACT).data == mason.data
+
+        headers = Headers({"Accept": "application/json",
+                           "If-None-Match": f'"{compact.get_etag()[0]}"'})
+        assert client.get("/api/students/", headers=headers).status_code == 304
+
+    def test_collections(self, client):
+        """Checks the compact collections against their Mason representations"""
+        for url, item_link in [
+                ("/api/students/", "/api/students/{student_id}/"),
+                ("/api/courses/?sort=-ects", "/api/courses/{course_id}/"),
+                ("/api/assessments/", "/api/courses/{course_id}/assessments/{student_id}/"),
+                ("/api/assessments/?limit=all",
+                 "/api/courses/{course_id}/assessments/{student_id}/"),
+                ("/api/courses/1/assessments/",
+                 "/api/courses/{course_id}/assessments/{student_id}/"),
+                ("/api/students/1/assessments/?grade_min=1",
+                 "/api/students/{student_id}/assessments/{course_id}/")]:
+            mason = json.loads(client.get(url).data)
+            resp = client.get(url, headers=self.COMPACT)
+            assert b": " not in resp.data and b", " not in resp.data
+            compact = json.loads(resp.data)
+            assert list(compact) == ["items", "links"]
+            for item in mason["items"]:
+                del item["@controls"]
+            assert compact["items"] == mason["items"]
+            assert compact["links"]["item"] == item_link
+            assert compact["links"]["self"] == mason["@controls"]["self"]["href"]
+            assert all(isinstance(href, str) for href in compact["links"].values())
+
+        body = json.loads(client.get("/api/students/?limit=2&fields=last_name",
+                                     headers=self.COMPACT).data)
+        assert body["items"] == [{"student_id": 1, "last_name": "Malfoy"},
+                                 {"student_id": 2, "last_name": "Potter"}]
+        body = json.loads(client.get(body["links"]["next"], headers=self.COMPACT).data)
+        assert body["items"] == [{"student_id": 3, "last_name": "Granger"}]
+        body = json.loads(client.get("/api/students/?view=compact&limit=2").data)
+        assert client.get(body["links"]["next"]).mimetype == "application/json"
+
+    def test_not_patched(self, client):
+        """Checks that the changes of the collections, Mason items, never reach compact pages"""
+        client.get("/api/students/", headers=self.COMPACT)
+        client.get("/api/students/")
+        assert client.post("/api/students/", json=_get_student_json()).status_code == 201
+        body = json.loads(client.get("/api/students/", headers=self.COMPACT).data)
+        assert len(body["items"]) == 4
+        assert all("@controls" not in item for item in body["items"])
+        body = json.loads(client.get("/api/students/").data)
+        assert all("@controls" in item for item in body["items"])
+
+
+class TestCompactEntries(object):
+
+    def test_gzip(self, client):
+        """Checks that large responses are served compressed to the clients accepting gzip"""
+        plain = client.get("/api/students/1/")
+        assert plain.headers.get("Content-Encoding") is None
+        assert "Accept-Encoding" in plain.vary
+
+        resp = client.get("/api/students/1/", headers=Headers({"Accept-Encoding": "gzip"}))
+        assert resp.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(resp.data) == plain.data
+        assert resp.mimetype == plain.mimetype
+        etag = resp.get_etag()[0]
+        assert etag != plain.get_etag()[0]
+
+        resp = client.get("/api/students/1/", headers=Headers({"If-None-Match": f'"{etag}"',
+                                                               "Accept-Encoding": "gzip"}))
+        assert resp.status_code == 304
+        assert resp.get_etag()[0] == etag
+
+        resp = client.get("/api/students/1/", headers=Headers({"Accept-Encoding": "gzip;q=0"}))
+        assert resp.headers.get("Content-Encoding") is None
+
+    def test_responses_independent(self):
+        """Checks that the responses built from an entry do not share any mutable state"""
+        entry = CachedResponse.from_body(b"{}", MASON, "etag")
+        first, second = entry.to_response(), entry.to_response(vary=["Accept"])
+        first.headers["X-Test"] = "1"
+        first.call_on_close(lambda: None)
+        assert "X-Test" not in second.headers
+        assert not second._on_close
+        assert second.status_code == 200 and second.get_data() == b"{}"
+        assert second.headers["Content-Length"] == "2" and second.mimetype == MASON
+        assert second.headers["Vary"] == "Accept-Encoding, Accept"
+
+    def test_small_bodies_not_compressed(self):
+        """Checks that small responses are not compressed"""
+        entry = CachedResponse.from_response(Response(b"{}", mimetype=MASON), "etag")
+        assert entry.body == b"{}"
+        assert entry.gzipped is None
+        assert entry.to_response(accept_gzip=True).headers.get("Content-Encoding") is None
+
+    def test_cache_entries(self, client):
+        """Checks that the cache contains the compact form of the responses"""
+        resp = client.get("/api/students/")
+        with client.application.app_context():
+            keys = [key for key in cache.cache._memory if not key.startswith("fragment:")]
+            entries = [cache.get(key) for key in keys]
+        assert len(entries) == 1
+        assert isinstance(entries[0], CachedResponse)
+        assert entries[0].body == resp.data
+        assert gzip.decompress(entries[0].gzipped) == resp.data
+
+        # the filesystem tier keeps both bodies, so that no hit has to decompress them
+        with client.application.app_context():
+            stored = super(TwoTierCache, cache.cache).get(keys[0])
+        assert stored == entries[0]
+        assert entries[0].etag == resp.get_etag()[0]
+
+
+class TestTwoTierCache(object):
+
+    @staticmethod
+    def _stats(app):
+        with app.app_context():
+            return cache.cache.stats()
+
+    @staticmethod
+    def _worker(client):
+        """Creates another app sharing the database and the filesystem cache of client"""
+        config = client.application.config
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": config["SQLALCHEMY_DATABASE_URI"],
+            "TESTING": True,
+            "CACHE_DIR": config["CACHE_DIR"]
+        })
+        app.test_client_class = AuthHeaderClient
+        return app.test_client()
+
+    def test_tiers(self, client):
+        """Checks that hits are served from memory, and from the filesystem for other workers"""
+        app = client.application
+        before = self._stats(app)
+        first = client.get("/api/students/")
+        second = client.get("/api/students/")
+        assert first.data == second.data
+        stats = self._stats(app)
+        assert stats["file_misses"] == before["file_misses"] + 1
+        assert stats["memory_hits"] == before["memory_hits"] + 1
+        assert stats["memory_entries"] >= 1
+
+        worker = self._worker(client)
+        assert worker.get("/api/students/").data == first.data
+        assert worker.get("/api/students/").data == first.data
+        stats = self._stats(worker.application)
+        assert stats["file_hits"] == 1
+        assert stats["memory_hits"] == 1
+
+    def test_coherence(self, client):
+        """Checks that a write on a worker is seen by the memory tier of the other workers"""
+        worker = self._worker(client)
+        client.get("/api/students/1/")
+        assert json.loads(worker.get("/api/students/1/").data)["first_name"] == "Draco"
+
+        assert client.put("/api/students/1/", json=_get_student_json()).status_code == 204
+        expected = _get_student_json()["first_name"]
+        assert json.loads(worker.get("/api/students/1/").data)["first_name"] == expected
+        assert json.loads(client.get("/api/students/1/").data)["first_name"] == expected
+
+    def test_memory_budget(self):
+        """Checks that the memory tier is bounded by size, evicting the least recently used"""
+        cache_dir = tempfile.mkdtemp()
+        try:
+            two_tier = TwoTierCache(cache_dir, memory_bytes=300)
+            for key in ["a#1", "b#1", "c#1"]:
+                two_tier.set(key, b"x" * 80)
+            two_tier.get("a#1")
+            two_tier.set("d#1", b"x" * 80)
+            stats = two_tier.stats()
+            assert stats["memory_bytes"] <= 300
+            assert stats["memory_entries"] == 3
+            # b is the least recently used entry, so it is only left on the filesystem
+            assert two_tier.get("b#1") == b"x" * 80
+            assert two_tier.stats()["file_hits"] == 1
+            assert two_tier.get("a#1") == b"x" * 80
+            assert two_tier.stats()["memory_hits"] == 2
+
+            # generations are never kept in memory
+            two_tier.set("generation:students", "abc", timeout=0)
+            assert "generation:students" not in two_tier._memory
+            assert two_tier.get("generation:students") == "abc"
+
+            # entries larger than the budget are only stored on the filesystem
+            two_tier.set("e#1", b"x" * 1000)
+            assert "e#1" not in two_tier._memory
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_single_flight(self, client):
+        """
+        Checks that concurrent misses of the same resource build the response only once, both
+            before its generation exists and after it has been renewed by a write
+        """
+        with client.application.app_context():
+            engine = db.engine
+        builds = []
+
+        def _slow_query(conn, cursor, statement, parameters, context, executemany):
+            if "FROM course" in statement:
+                builds.append(statement)
+                time.sleep(0.2)
+
+        barrier = threading.Barrier(4)
+        responses = []
+
+        def _request():
+            barrier.wait()
+            responses.append(client.get("/api/courses/"))
+
+        for _ in range(2):
+            waits = self._stats(client.application)["single_flight_waits"]
+            builds.clear()
+            responses.clear()
+            event.listen(engine, "before_cursor_execute", _slow_query)
+            try:
+                threads = [threading.Thread(target=_request) for _ in range(4)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            finally:
+                event.remove(engine, "before_cursor_execute", _slow_query)
+            assert len(builds) == 1
+            assert [resp.status_code for resp in responses] == [200] * 4
+            assert len({resp.data for resp in responses}) == 1
+            assert len({resp.headers["ETag"] for resp in responses}) == 1
+            assert self._stats(client.application)["single_flight_waits"] == waits + 3
+
+            with client.application.app_context():
+                invalidate_tags(COURSES_TAG)
+
+    def test_single_flight_processes(self):
+        """Checks that the lock is shared through the cache directory, and has a timeout"""
+        cache_dir = tempfile.mkdtemp()
+        try:
+            # instances on the same directory hold separate file locks, like processes
+            first, second, third = [TwoTierCache(cache_dir) for _ in range(3)]
+            with first.single_flight("a#1") as waited:
+                assert not waited
+                start = time.monotonic()
+                with second.single_flight("a#1", timeout=0.2) as waited:
+                    assert waited
+                    assert time.monotonic() - start >= 0.2
+                # other keys are not blocked
+                with second.single_flight("b#1", timeout=0.2) as waited:
+                    assert not waited
+                # lock files are ignored by the filesystem cache
+                first.set("c#1", "value")
+                first.clear()
+                assert os.listdir(cache_dir)
+                assert first.get("c#1") is None
+            with second.single_flight("a#1") as waited:
+                assert not waited
+            # and deleted once released
+            assert not [name for name in os.listdir(cache_dir) if name.startswith("lock-")]
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_single_flight_deleted_lock_file(self):
+        """Checks that a worker waiting for a lock file deleted by its holder locks the new one"""
+        cache_dir = tempfile.mkdtemp()
+        try:
+            first, second, third = [TwoTierCache(cache_dir) for _ in range(3)]
+            holding, release = threading.Event(), threading.Event()
+
+            def _wait_and_hold():
+                with second.single_flight("a#1") as waited:
+                    assert waited
+                    holding.set()
+                    release.wait()
+
+            with first.single_flight("a#1"):
+                thread = threading.Thread(target=_wait_and_hold)
+                thread.start()
+                time.sleep(0.05)
+            assert holding.wait(1)
+            with third.single_flight("a#1", timeout=0.1) as waited:
+                assert waited
+            release.set()
+            thread.join()
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_add(self):
+        """Checks that add stores a value only if the key is missing, in any worker"""
+        cache_dir = tempfile.mkdtemp()
+        try:
+            first, second = TwoTierCache(cache_dir), TwoTierCache(cache_dir)
+            assert first.add("generation:a", "1", timeout=0)
+            assert not second.add("generation:a", "2", timeout=0)
+            assert second.get("generation:a") == "1"
+            assert not [name for name in os.listdir(cache_dir) if name.endswith(".__wz_cache")]
+        finally:
+            shutil.rmtree(cache_dir)
+
+class TestCacheLimits(object):
+
+    @staticmethod
+    def _entry(size=100):
+        return CachedResponse(b"x" * size, MASON, "etag", None)
+
+    def test_eviction_lru(self):
+        """Checks that the least recently used entries are evicted from a full family"""
+        cache_dir = tempfile.mkdtemp()
+        try:
+            two_tier = TwoTierCache(cache_dir, memory_bytes=0, limits={
+                "/api/a/": {"max_entries": 10, "policy": "lru"},
+                "/api/b/": {"max_bytes": 10000}
+            })
+            two_tier.set("generation:students", "abc", timeout=0)
+            for index in range(10):
+                two_tier.set(f"/api/a/?{index}#1", self._entry())
+                os.utime(two_tier._get_filename(f"/api/a/?{index}#1"), (index, index))
+            # entry 0 used recently
+            os.utime(two_tier._get_filename("/api/a/?0#1"))
+            two_tier.set("/api/a/?10#1", self._entry())
+
+            stats = {family["prefix"]: family for family in two_tier.family_stats()}
+            assert stats["/api/a/"]["entries"] == 9
+            assert stats["/api/a/"]["evictions"] == 2
+            assert two_tier.get("/api/a/?0#1") is not None
+            assert two_tier.get("/api/a/?10#1") is not None
+            assert two_tier.get("/api/a/?1#1") is None
+            assert two_tier.get("/api/a/?2#1") is None
+            assert two_tier.get("generation:students") == "abc"
+            assert stats["/api/b/"]["entries"] == 0
+
+            for index in range(3):
+                two_tier.set(f"/api/b/?{index}#1", self._entry(4000))
+            stats = {family["prefix"]: family for family in two_tier.family_stats()}
+            assert stats["/api/b/"]["bytes"] <= 9000
+            assert stats["/api/b/"]["evictions"] == 1
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_concurrent_stores(self):
+        """Checks that the occupancy of a family is never underestimated by concurrent stores"""
+        cache_dir = tempfile.mkdtemp()
+        try:
+            two_tier = TwoTierCache(cache_dir, memory_bytes=0, limits={
+                "/api/a/": {"max_entries": 50}
+            })
+            family = two_tier.families[0]
+
+            def _store(thread):
+                for index in range(100):
+                    two_tier.set(f"/api/a/?{thread}-{index}#1", self._entry())
+
+            threads = [threading.Thread(target=_store, args=(thread,)) for thread in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert not family.sweeping
+            assert family.entries >= len(two_tier._scan(family))
+
+            two_tier.set("/api/a/?last#1", self._entry())
+            assert len(two_tier._scan(family)) <= 50
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_eviction_lfu(self):
+        """Checks that the least frequently used entries are evicted from a full family"""
+        cache_dir = tempfile.mkdtemp()
+        try:
+            two_tier = TwoTierCache(cache_dir, memory_bytes=0, limits={
+                "/api/a/": {"max_entries": 4, "policy": "lfu"}
+            })
+            for index in range(4):
+                two_tier.set(f"/api/a/?{index}#1", self._entry())
+                for _ in range(4 - index if index else 1):
+                    assert two_tier.get(f"/api/a/?{index}#1") is not None
+            two_tier.set("/api/a/?4#1", self._entry())
+            # storing an entry counts as a use: entry 3 was used twice, entry 0 too but is older,
+            # and entry 4 is the one being stored
+            assert two_tier.get("/api/a/?0#1") is None
+            assert two_tier.get("/api/a/?3#1") is None
+            assert two_tier.get("/api/a/?1#1") is not None
+            assert two_tier.get("/api/a/?4#1") is not None
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_ttl(self):
+        """Checks that every family has its own timeout"""
+        cache_dir = tempfile.mkdtemp()
+        try:
+            two_tier = TwoTierCache(cache_dir, limits={"/api/a/": {"ttl": 1000}},
+                                    default_timeout=300)
+            two_tier.set("/api/a/?#1", self._entry())
+            two_tier.set("/api/b/?#1", self._entry())
+            two_tier.set("stale:/api/a/?", ("/api/a/?#1", 0, None))
+            expires = {}
+            for key in ["/api/a/?#1", "/api/b/?#1", "stale:/api/a/?"]:
+                with open(two_tier._get_filename(key), "rb") as file:
+                    expires[key] = struct.unpack("I", file.read(4))[0] - time.time()
+            assert 990 < expires["/api/a/?#1"] <= 1000
+            assert 990 < expires["stale:/api/a/?"] <= 1000
+            assert 290 < expires["/api/b/?#1"] <= 300
+            # the memory tier has the same timeouts
+            assert 990 < two_tier._memory["/api/a/?#1"][0] - time.time() <= 1000
+            assert 290 < two_tier._memory["/api/b/?#1"][0] - time.time() <= 300
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_ttl_memory(self):
+        """Checks that expired entries are not served from the memory tier"""
+        cache_dir = tempfile.mkdtemp()
+        try:
+            two_tier = TwoTierCache(cache_dir, limits={"/api/a/": {"ttl": 1}})
+            two_tier.set("/api/a/?#1", self._entry())
+            assert "/api/a/?#1" in two_tier._memory
+            time.sleep(1.1)
+            assert two_tier.get("/api/a/?#1") is None
+            assert "/api/a/?#1" not in two_tier._memory
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_stats_endpoint(self, client):
+        """Checks the statistics of the families, only available to the administrators"""
+        client.get("/api/students/")
+        client.get("/api/students/")
+        client.get("/api/courses/")
+        resp = client.get("/api/admin/cache/")
+        assert resp.status_code == 200
+        assert resp.headers["Cache-Control"] == "no-store"
+        body = json.loads(resp.data)
+        _check_namespace(client, body)
+        families = {family["prefix"]: family for family in body["families"]}
+        assert set(families) == {"/api/students/", "/api/courses/", "/api/assessments/"}
+        assert families["/api/students/"]["hits"] == 1
+        assert families["/api/students/"]["misses"] == 1
+        assert families["/api/students/"]["hit_ratio"] == 0.5
+        # the response and the pointer to its latest version
+        assert families["/api/students/"]["entries"] == 2
+        assert families["/api/students/"]["bytes"] > 0
+        assert families["/api/assessments/"]["hit_ratio"] is None
+        assert body["worker"]["memory_hits"] >= 1
+
+        app = client.application
+        without_key = FlaskClient(app, app.response_class)
+        assert without_key.get("/api/admin/cache/").status_code == 403
+
+
+class TestCacheWarm(object):
+
+    @staticmethod
+    def _reset_access_counts(app):
+        # the counter is shared by all the apps of the process
+        with app.app_context():
+            access_counter.flush()
+            cache.delete(ACCESS_COUNTS_KEY)
+
+    def test_access_counts(self, client):
+        """Checks that the items are ranked by number of requests"""
+        self._reset_access_counts(client.application)
+        for _ in range(3):
+            client.get("/api/students/1/")
+        client.get("/api/students/")
+        client.get("/api/courses/2/")
+        client.get("/api/courses/1/assessments/2/")
+        client.get("/api/courses/1/assessments/2/")
+        with client.application.app_context():
+            access_counter.flush()
+            assert AccessCounter.hot_paths(2) == ["/api/students/1/", "/api/courses/1/assessments/2/"]
+            assert set(AccessCounter.hot_paths(10)) == \
+                {"/api/students/1/", "/api/courses/2/", "/api/courses/1/assessments/2/"}
+
+    def test_cache_warm_command(self, client):
+        """Checks that cache-warm fills the cache with the collections and the hot items"""
+        app = client.application
+        self._reset_access_counts(app)
+        client.get("/api/students/2/")
+        client.get("/api/courses/3/")
+        with app.app_context():
+            access_counter.flush()
+            invalidate_tags(STUDENTS_TAG, COURSES_TAG, ASSESSMENTS_TAG, "student:2", "course:3")
+
+        result = app.test_cli_runner().invoke(cache_warm_command, ["--items", "10",
+                                                                   "--workers", "2"])
+        assert result.exit_code == 0
+        assert "[1/5]" in result.output and "[5/5]" in result.output
+        assert "warmed 5 resources, 0 failed" in result.output
+        lines = result.output.splitlines()
+        # collections first
+        assert all("/api/students/2/" not in line for line in lines[:3])
+
+        for url in ["/api/students/", "/api/courses/", "/api/assessments/",
+                    "/api/students/2/", "/api/courses/3/"]:
+            resp, count = _count_queries(client, url)
+            assert resp.status_code == 200
+            assert count == 0, url
+        # the collections are warmed for the clients sending an Accept header as well
+        resp, count = _count_queries(client, "/api/students/", headers=Headers({"Accept": "*/*"}))
+        assert count == 0
+
+        # the requests of the warm-up are not counted
+        with app.app_context():
+            access_counter.flush()
+            assert dict(cache.get(ACCESS_COUNTS_KEY)) == {"/api/students/2/": 2,
+                                                          "/api/courses/3/": 2}
+
+
+    def test_cache_warm_base_url(self, client):
+        """Checks that cache-warm builds the documents at the given root URL"""
+        app = client.application
+        self._reset_access_counts(app)
+        headers = Headers({"Accept": "application/vnd.mason+json"})
+        result = app.test_cli_runner().invoke(
+            cache_warm_command, ["--items", "0", "--base-url", "http://example.com/prefix/"]
+        )
+        assert result.exit_code == 0
+        resp, count = _count_queries(client, "/api/students/",
+                                     base_url="http://example.com/prefix/", headers=headers)
+        assert count == 0
+        body = json.loads(resp.data)
+        assert body["@controls"]["self"]["href"].startswith("/prefix/api/students/")
+
+    def test_warm_on_startup(self, client, monkeypatch):
+        """Checks that the warm-up on startup runs when serving, and not for the CLI commands"""
+        calls = []
+        monkeypatch.setattr("studentmanager.caching.warm_cache",
+                            lambda app, items, echo: calls.append(items))
+        config = client.application.config
+        config = {
+            "SQLALCHEMY_DATABASE_URI": config["SQLALCHEMY_DATABASE_URI"],
+            "TESTING": True,
+            "CACHE_DIR": config["CACHE_DIR"],
+            "CACHE_WARM_ON_STARTUP": True,
+            "CACHE_WARM_ITEMS": 7
+        }
+        # the application is created by the flask command before running the CLI commands
+        for name, expected in [("init-db", []), ("run", [7])]:
+            calls.clear()
+            with click.Context(click.Command(name)):
+                create_app(config)
+            time.sleep(0.1)
+            assert calls == expected, name
+
+        calls.clear()
+        create_app(config)
+        time.sleep(0.1)
+        assert calls == [7]
+
+
+class TestStaleWhileRevalidate(object):
+
+    @staticmethod
+    def _wait_revalidations():
+        for thread in list(caching._revalidations.values()):
+            thread.join()
+
+    @staticmethod
+    def _ids(resp):
+        return [item["student_id"] for item in json.loads(resp.data)["items"]]
+
+    def test_stale_collection(self, client):
+        """Checks that a modified collection is served stale while it is rebuilt"""
+        client.application.config["CACHE_MAX_STALENESS"] = {"api.studentcollection": 60}
+        first = client.get("/api/students/")
+        assert "Warning" not in first.headers
+        assert client.post("/api/students/", json=_get_student_json()).status_code == 201
+
+        stale = client.get("/api/students/")
+        assert stale.status_code == 200
+        assert stale.headers["Warning"] == STALE_WARNING
+        assert int(stale.headers["Age"]) >= 0
+        assert stale.data == first.data
+        self._wait_revalidations()
+
+        fresh = client.get("/api/students/")
+        assert "Warning" not in fresh.headers
+        assert len(self._ids(fresh)) == len(self._ids(first)) + 1
+
+        # routes not configured are never stale
+        client.get("/api/courses/")
+        assert client.post("/api/courses/", json=_get_course_json()).status_code == 201
+        assert "Warning" not in client.get("/api/courses/").headers
+
+    def test_revalidate_vary(self, client):
+        """Checks that the entry is rebuilt with the headers the response depends on"""
+        client.application.config["CACHE_MAX_STALENESS"] = {"api.studentcollection": 60}
+        headers = {"Accept": "application/vnd.mason+json, */*"}
+        first = client.get("/api/students/", headers=Headers(headers))
+        assert client.post("/api/students/", json=_get_student_json()).status_code == 201
+
+        stale = client.get("/api/students/", headers=Headers(headers))
+        assert stale.headers["Warning"] == STALE_WARNING
+        self._wait_revalidations()
+
+        fresh, count = _count_queries(client, "/api/students/", headers=Headers(headers))
+        assert "Warning" not in fresh.headers
+        assert count == 0
+        assert len(self._ids(fresh)) == len(self._ids(first)) + 1
+
+    def test_revalidate_script_root(self, client):
+        """Checks that the entry is rebuilt at the root URL of the request"""
+        client.application.config["CACHE_MAX_STALENESS"] = {"api.studentcollection": 60}
+        headers = Headers({"Accept": "application/vnd.mason+json"})
+        base_url = "http://example.com/prefix/"
+        client.get("/api/students/", base_url=base_url, headers=headers)
+        # not patched in place, so that the documents are built again
+        with client.application.app_context():
+            invalidate_tags(STUDENTS_TAG)
+
+        stale = client.get("/api/students/", base_url=base_url, headers=headers)
+        assert stale.headers["Warning"] == STALE_WARNING
+        self._wait_revalidations()
+
+        fresh, count = _count_queries(client, "/api/students/", base_url=base_url,
+                                      headers=headers)
+        assert count == 0
+        assert "Warning" not in fresh.headers
+        body = json.loads(fresh.data)
+        for item in body["items"]:
+            assert item["@controls"]["self"]["href"].startswith("/prefix/api/students/")
+
+    def test_no_cache(self, client):
+        """Checks that clients can refuse stale responses"""
+        client.application.config["CACHE_MAX_STALENESS"] = {"api.studentcollection": 60}
+        first = client.get("/api/students/")
+        assert client.post("/api/students/", json=_get_student_json()).status_code == 201
+        resp = client.get("/api/students/", headers=Headers({"Cache-Control": "no-cache"}))
+        assert "Warning" not in resp.headers
+        assert len(self._ids(resp)) == len(self._ids(first)) + 1
+
+    def test_max_staleness(self, client):
+        """Checks that entries stale for too long are rebuilt before responding"""
+        app = client.application
+        app.config["CACHE_MAX_STALENESS"] = {"api.studentcollection": 60}
+        first = client.get("/api/students/")
+        assert client.post("/api/students/", json=_get_student_json()).status_code == 201
+        with app.test_request_context("/api/students/"):
+            key = stale_key(caching.request_cache_key([STUDENTS_TAG],
+                                                      vary={"Accept": negotiated_view}))
+            stale_entry, built_at, _ = cache.get(key)
+            cache.set(key, (stale_entry, built_at, time.time() - 61))
+        resp = client.get("/api/students/")
+        assert "Warning" not in resp.headers
+        assert len(self._ids(resp)) == len(self._ids(first)) + 1
+
+
+class TestApiKeys(object):
+
+    @staticmethod
+    def _post(client, url, body, key):
+        """
+        Posts body to url with the given API key. A plain FlaskClient is used, since
+            AuthHeaderClient always adds the test key to the request
+        """
+        plain_client = FlaskClient(client.application, client.application.response_class)
+        return plain_client.post(url, json=body, headers=Headers({'Studentmanager-Api-Key': key}))
+
+    def test_rejected_without_queries(self, client):
+        """Checks that requests with an invalid key are rejected without querying the database"""
+        # the first request loads the keys, since they have been changed by _populate_db
+        self._post(client, "/api/courses/", _get_course_json(), "Invalid")
+        resp, count = _count_queries(client, "/api/courses/", method="POST",
+                                     json=_get_course_json(),
+                                     headers=Headers({'Studentmanager-Api-Key': "Invalid"}))
+        assert resp.status_code == 403
+        assert count == 0
+        resp, count = _count_queries(client, "/api/assessments/", method="POST",
+                                     json=_get_existing_assessment_json(),
+                                     headers=Headers({'Studentmanager-Api-Key': "Invalid"}))
+        assert resp.status_code == 403
+        assert count == 0
+
+    def test_keys_changed_on_commit(self, client):
+        """Checks that keys added or deleted in the database are seen by the next request"""
+        resp = self._post(client, "/api/assessments/", _get_existing_assessment_json(),
+                          "assessmentkey")
+        assert resp.status_code == 403
+
+        with client.application.app_context():
+            db.session.add(ApiKey(key=ApiKey.key_hash("assessmentkey"), admin=False))
+            db.session.commit()
+        resp = self._post(client, "/api/assessments/", _get_existing_assessment_json(),
+                          "assessmentkey")
+        assert resp.status_code == 409
+        resp = self._post(client, "/api/courses/", _get_course_json(), "assessmentkey")
+        assert resp.status_code == 403
+
+        with client.application.app_context():
+            db.session.delete(db.session.get(ApiKey, ApiKey.key_hash("assessmentkey")))
+            db.session.commit()
+        resp = self._post(client, "/api/assessments/", _get_existing_assessment_json(),
+                          "assessmentkey")
+        assert resp.status_code == 403
+
+        # bulk statements as well
+        with client.application.app_context():
+            db.session.add(ApiKey(key=ApiKey.key_hash("assessmentkey"), admin=False))
+            db.session.commit()
+        resp = self._post(client, "/api/assessments/", _get_existing_assessment_json(),
+                          "assessmentkey")
+        assert resp.status_code == 409
+        with client.application.app_context():
+            ApiKey.query.filter_by(key=ApiKey.key_hash("assessmentkey")).delete()
+            db.session.commit()
+        resp = self._post(client, "/api/assessments/", _get_existing_assessment_json(),
+                          "assessmentkey")
+        assert resp.status_code == 403
+
+    def test_masterkey_command(self, client):
+        """Checks that the keys generated by the masterkey command are accepted immediately"""
+        # the first request loads the keys, so that the command has to invalidate them
+        self._post(client, "/api/courses/", _get_course_json(), "Invalid")
+        result = client.application.test_cli_runner().invoke(generate_master_key)
+        keys = dict(line.split(": ") for line in result.output.splitlines())
+        resp = self._post(client, "/api/courses/", _get_course_json(), keys["admin key"])
+        assert resp.status_code == 201
+        resp = self._post(client, "/api/assessments/", _get_existing_assessment_json(),
+                          keys["assessment key"])
+        assert resp.status_code == 409
 
 
 class TestCourseCollection(object):
     RESOURCE_URL = "/api/courses/"
 
+    def test_get_sorted(self, client):
+        """Gets the courses sorted by credits and by code"""
+        body = json.loads(client.get(self.RESOURCE_URL + "?sort=-ects&limit=1").data)
+        assert [item["course_id"] for item in body["items"]] == [3]
+        body = json.loads(client.get(body["@controls"]["next"]["href"]).data)
+        assert [item["course_id"] for item in body["items"]] == [2]
+        body = json.loads(client.get(self.RESOURCE_URL + "?sort=ects").data)
+        assert [item["course_id"] for item in body["items"]] == [1, 2, 3]
+        body = json.loads(client.get(self.RESOURCE_URL + "?sort=title").data)
+        assert [item["course_id"] for item in body["items"]] == [3, 2, 1]
+
+        course = _get_course_json()
+        course["code"] = "000001"
+        assert client.post(self.RESOURCE_URL, json=course).status_code == 201
+        body = json.loads(client.get(self.RESOURCE_URL + "?sort=code").data)
+        assert [item["code"] for item in body["items"]] == ["000001", "004723", "006031", "006032"]
+        assert client.get(self.RESOURCE_URL + "?sort=teacher").status_code == 400
+
     def test_get(self, client):
         """Successfully gets all courses"""
         resp = client.get(self.RESOURCE_URL)
@@ -345,6 +1511,17 @@ class TestCourseItem(object):
     RESOURCE_URL = "/api/courses/1/"
     INVALID_URL = "/api/courses/X/"
 
+    def test_get_fields(self, client):
+        """Gets a course and the courses with sparse fieldsets"""
+        body = json.loads(client.get(self.RESOURCE_URL + "?fields=code,ects").data)
+        assert body == {"course_id": 1, "code": "004723", "ects": 5}
+        body = json.loads(client.get("/api/courses/?fields=title&sort=-ects").data)
+        assert [item["title"] for item in body["items"]] == [
+            "Advanced Defence Against the Dark Arts", "Defence Against the Dark Arts",
+            "Transfiguration"]
+        assert "@controls" not in body["items"][0]
+        assert client.get(self.RESOURCE_URL + "?fields=title,").status_code == 400
+
     def test_get(self, client):
         """Successfully gets an existing course"""
         resp = client.get(self.RESOURCE_URL)
@@ -390,6 +1567,9 @@ class TestCourseItem(object):
 
         resp = client.put(self.INVALID_URL, json=valid)
         assert resp.status_code == 404
+        # a missing course takes precedence over an invalid body
+        resp = client.put("/api/courses/999/", json={"title": "course1"})
+        assert resp.status_code == 404
 
     def test_put_conflict_code(self, client):
         """Tries to change an existing course's code into an already existing one"""
@@ -468,6 +1648,108 @@ class TestStudentCollection(object):
             _check_control_get_method("self", client, item)
             _check_control_get_method("profile", client, item)
 
+    def test_get_paginated(self, client):
+        """Follows the next and prev controls of a paginated student collection"""
+        resp = client.get(self.RESOURCE_URL + "?limit=2")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["student_id"] for item in body["items"]] == [1, 2]
+        assert "prev" not in body["@controls"]
+        resp = client.get(body["@controls"]["next"]["href"])
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["student_id"] for item in body["items"]] == [3]
+        assert "next" not in body["@controls"]
+        resp = client.get(body["@controls"]["prev"]["href"])
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["student_id"] for item in body["items"]] == [1, 2]
+        assert "prev" not in body["@controls"]
+        assert "next" in body["@controls"]
+
+    def test_get_paginated_after_post(self, client):
+        """Checks that cached pages are invalidated when a student is added"""
+        resp = client.get(self.RESOURCE_URL + "?limit=2")
+        next_href = json.loads(resp.data)["@controls"]["next"]["href"]
+        resp = client.get(next_href)
+        assert len(json.loads(resp.data)["items"]) == 1
+        resp = client.post(self.RESOURCE_URL, json=_get_student_json())
+        assert resp.status_code == 201
+        resp = client.get(next_href)
+        assert len(json.loads(resp.data)["items"]) == 2
+
+    def test_get_invalid_pagination(self, client):
+        """Tries to get the students with invalid pagination parameters"""
+        resp = client.get(self.RESOURCE_URL + "?limit=0")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?limit=X")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?after=X")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?after=WzFd&before=WzFd")
+        assert resp.status_code == 400
+
+    def test_get_sorted(self, client):
+        """Follows the pages of the students sorted by name"""
+        resp = client.get(self.RESOURCE_URL + "?sort=last_name,first_name&limit=2")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["student_id"] for item in body["items"]] == [3, 1]
+        body = json.loads(client.get(body["@controls"]["next"]["href"]).data)
+        assert [item["student_id"] for item in body["items"]] == [2]
+        body = json.loads(client.get(body["@controls"]["prev"]["href"]).data)
+        assert [item["student_id"] for item in body["items"]] == [3, 1]
+
+        body = json.loads(client.get(self.RESOURCE_URL + "?sort=-last_name,-first_name").data)
+        assert [item["student_id"] for item in body["items"]] == [2, 1, 3]
+        body = json.loads(client.get(self.RESOURCE_URL + "?sort=-student_id").data)
+        assert [item["student_id"] for item in body["items"]] == [3, 2, 1]
+
+        # sorted pages are rebuilt, not patched
+        existing = _get_existing_student_json()
+        existing["last_name"] = "Black"
+        assert client.put(self.RESOURCE_URL + "1/", json=existing).status_code == 204
+        body = json.loads(client.get(self.RESOURCE_URL + "?sort=last_name,first_name").data)
+        assert [item["student_id"] for item in body["items"]] == [1, 3, 2]
+
+        for sort in ("first_name", "last_name", "last_name,-first_name", "ssn", "x"):
+            resp = client.get(self.RESOURCE_URL + f"?sort={sort}")
+            assert resp.status_code == 400
+
+    def test_get_fields(self, client):
+        """Gets the students with sparse fieldsets, loading only the selected columns"""
+        plans = _query_plans(client, self.RESOURCE_URL + "?fields=last_name")
+        statement = next(statement for statement, _ in plans if "FROM student" in statement)
+        assert "student.last_name" in statement
+        assert "student.ssn" not in statement
+        body = json.loads(client.get(self.RESOURCE_URL + "?fields=last_name").data)
+        assert body["items"] == [{"student_id": 1, "last_name": "Malfoy"},
+                                 {"student_id": 2, "last_name": "Potter"},
+                                 {"student_id": 3, "last_name": "Granger"}]
+        _check_control_get_method("self", client, body)
+
+        body = json.loads(client.get(
+            self.RESOURCE_URL + "?fields=first_name,@controls&sort=last_name,first_name").data)
+        assert [list(item) for item in body["items"]] == \
+            [["student_id", "first_name", "@controls"]] * 3
+        assert [item["student_id"] for item in body["items"]] == [3, 1, 2]
+        _check_control_get_method("self", client, body["items"][0])
+
+        # sparse pages are rebuilt, not patched
+        existing = _get_existing_student_json()
+        existing["last_name"] = "Black"
+        assert client.put(self.RESOURCE_URL + "1/", json=existing).status_code == 204
+        body = json.loads(client.get(self.RESOURCE_URL + "?fields=last_name").data)
+        assert body["items"][0] == {"student_id": 1, "last_name": "Black"}
+        assert json.loads(client.get(self.RESOURCE_URL).data)["items"][0]["last_name"] == "Black"
+
+        body = json.loads(client.get(self.RESOURCE_URL + "?fields=last_name&limit=2").data)
+        body = json.loads(client.get(body["@controls"]["next"]["href"]).data)
+        assert body["items"] == [{"student_id": 3, "last_name": "Granger"}]
+
+        assert client.get(self.RESOURCE_URL + "?fields=password").status_code == 400
+        assert client.get(self.RESOURCE_URL + "?fields=assessments").status_code == 400
+
     def test_post_valid_request(self, client):
         """Succesfully adds a new student"""
         valid = _get_student_json()
@@ -509,6 +1791,22 @@ class TestStudentItem(object):
     RESOURCE_URL = "/api/students/1/"
     INVALID_URL = "/api/students/X/"
 
+    def test_get_fields(self, client):
+        """Gets a student with sparse fieldsets"""
+        plans = _query_plans(client, self.RESOURCE_URL + "?fields=first_name")
+        statement = next(statement for statement, _ in plans if "FROM student" in statement)
+        assert "student.date_of_birth" not in statement
+        resp = client.get(self.RESOURCE_URL + "?fields=first_name")
+        assert json.loads(resp.data) == {"student_id": 1, "first_name": "Draco"}
+        assert len(resp.data) < len(client.get(self.RESOURCE_URL).data) / 10
+
+        body = json.loads(client.get(self.RESOURCE_URL + "?fields=ssn,assessments,@controls").data)
+        assert list(body) == ["student_id", "ssn", "assessments", "@namespaces", "@controls"]
+        assert len(body["assessments"]) == 2
+        _check_control_get_method(f"{NAMESPACE}:student-assessments", client, body)
+
+        assert client.get(self.RESOURCE_URL + "?fields=courses").status_code == 400
+
     def test_get(self, client):
         """Succesfully gets an existing student"""
         resp = client.get(self.RESOURCE_URL)
@@ -552,6 +1850,9 @@ class TestStudentItem(object):
         valid = _get_existing_student_json()
         resp = client.put(self.INVALID_URL, json=valid)
         assert resp.status_code == 404
+        # a missing student takes precedence over an invalid body
+        resp = client.put("/api/students/999/", json={"first_name": "Harry"})
+        assert resp.status_code == 404
 
     def test_put_conflict_ssn(self, client):
         """Tries to change an existing student's ssn into an already existing one"""
@@ -634,6 +1935,100 @@ class TestAssessmentCollection(object):
             _check_control_get_method("self", client, item)
             _check_control_get_method("profile", client, item)
 
+    def test_assessment_get_paginated(self, client):
+        """Follows the next controls of a paginated assessment collection"""
+        href = self.ASSESSMENT_RESOURCE_URL + "?limit=4"
+        keys = []
+        while href:
+            resp = client.get(href)
+            assert resp.status_code == 200
+            body = json.loads(resp.data)
+            assert len(body["items"]) <= 4
+            keys.extend((item["course_id"], item["student_id"]) for item in body["items"])
+            href = body["@controls"].get("next", {}).get("href")
+        assert keys == sorted(keys)
+        assert len(keys) == 6
+
+    def test_assessment_get_all(self, client):
+        """Gets the whole assessment collection, streamed and not cached"""
+        paginated = json.loads(client.get(self.ASSESSMENT_RESOURCE_URL).data)
+        resp = client.get(self.ASSESSMENT_RESOURCE_URL + "?limit=all")
+        assert resp.status_code == 200
+        assert resp.is_streamed
+        assert resp.mimetype == MASON
+        body = json.loads(resp.data)
+        assert "next" not in body["@controls"]
+        assert body["items"] == paginated["items"]
+
+        etag = resp.get_etag()[0]
+        resp = client.get(self.ASSESSMENT_RESOURCE_URL + "?limit=all",
+                          headers=Headers({"If-None-Match": f'"{etag}"'}))
+        assert resp.status_code == 304
+
+        # adds an assessment
+        _check_namespace(client, body)
+        _check_control_get_method("self", client, body)
+        _check_control_post_method(f"{NAMESPACE}:add-assessment", client, body,
+                                   _get_assessment_json(client))
+        resp = client.get(self.ASSESSMENT_RESOURCE_URL + "?limit=all",
+                          headers=Headers({"If-None-Match": f'"{etag}"'}))
+        assert resp.status_code == 200
+        assert len(json.loads(resp.data)["items"]) == 7
+
+        first = json.loads(client.get(self.ASSESSMENT_RESOURCE_URL + "?limit=2").data)
+        resp = client.get(first["@controls"]["next"]["href"].replace("limit=2", "limit=all"))
+        assert len(json.loads(resp.data)["items"]) == 5
+        resp = client.get(self.ASSESSMENT_RESOURCE_URL + "?limit=all&before=abc")
+        assert resp.status_code == 400
+        resp = client.get(self.ASSESSMENT_RESOURCE_URL + "?limit=all&after=abc")
+        assert resp.status_code == 400
+
+    def test_filters(self, client):
+        """Filters the assessment collections on grade and date"""
+        body = json.loads(client.get(self.ASSESSMENT_RESOURCE_URL).data)
+        control = body["@controls"][f"{NAMESPACE}:filter-assessments"]
+        assert control["isHrefTemplate"]
+        assert control["href"] == \
+            self.ASSESSMENT_RESOURCE_URL + "{?grade,grade_min,date_from,date_to,failed}"
+        validate({"grade": 4, "date_from": "1993-02-10", "failed": False}, control["schema"])
+
+        def _keys(url):
+            resp = client.get(url)
+            assert resp.status_code == 200
+            return [(item["course_id"], item["student_id"])
+                    for item in json.loads(resp.data)["items"]]
+
+        assert _keys(self.ASSESSMENT_RESOURCE_URL + "?grade=5") == [(1, 1), (1, 3), (2, 3)]
+        assert _keys(self.ASSESSMENT_RESOURCE_URL + "?grade_min=4&date_from=1993-02-10") == \
+            [(2, 1), (2, 2), (2, 3)]
+        assert _keys(self.ASSESSMENT_RESOURCE_URL + "?date_to=1993-02-08&grade_min=4") == \
+            [(1, 1), (1, 3)]
+        assert _keys(self.ASSESSMENT_RESOURCE_URL + "?failed=false&limit=all") == \
+            _keys(self.ASSESSMENT_RESOURCE_URL)
+        assert _keys(self.COURSE_RESOURCE_URL_PREFIX + "1/assessments/?grade_min=4") == \
+            [(1, 1), (1, 3)]
+        assert _keys(self.STUDENT_RESOURCE_URL_PREFIX + "1/assessments/?grade=4") == [(2, 1)]
+
+        # the pagination controls keep the filters
+        body = json.loads(client.get(self.ASSESSMENT_RESOURCE_URL + "?grade=5&limit=2").data)
+        assert _keys(body["@controls"]["next"]["href"]) == [(2, 3)]
+
+        # every combination is cached, and invalidated by the changes of the assessments
+        collections = (self.ASSESSMENT_RESOURCE_URL,
+                       self.COURSE_RESOURCE_URL_PREFIX + "1/assessments/",
+                       self.STUDENT_RESOURCE_URL_PREFIX + "1/assessments/")
+        for url in collections:
+            assert _keys(url + "?failed=true") == []
+        modified = _get_existing_assessment_json()
+        modified["grade"] = 0
+        assert client.put("/api/students/1/assessments/1/", json=modified).status_code == 204
+        for url in collections:
+            assert _keys(url + "?failed=true") == [(1, 1)]
+
+        for query in ("grade=6", "grade_min=x", "date_from=1993-02-30", "failed=yes"):
+            for url in collections:
+                assert client.get(f"{url}?{query}").status_code == 400
+
     def test_course_get(self, client):
         """Succesfully gets all assessments from course assessment collection"""
         resp = client.get(self.COURSE_RESOURCE_URL_PREFIX +
@@ -674,6 +2069,31 @@ class TestAssessmentCollection(object):
             _check_control_get_method("self", client, item)
             _check_control_get_method("profile", client, item)
 
+    def test_query_count(self, client):
+        """Checks that the assessment collections run a constant number of queries"""
+        resp, full_count = _count_queries(client, self.ASSESSMENT_RESOURCE_URL)
+        assert len(json.loads(resp.data)["items"]) == 6
+        resp, small_count = _count_queries(client, self.ASSESSMENT_RESOURCE_URL + "?limit=1")
+        assert len(json.loads(resp.data)["items"]) == 1
+        assert full_count == small_count
+
+        resp, full_count = _count_queries(client, self.COURSE_RESOURCE_URL_PREFIX + "1" +
+                                          self.ASSESSMENT_RESOURCE_URL_POSTFIX)
+        assert len(json.loads(resp.data)["items"]) == 3
+        resp, empty_count = _count_queries(client, self.COURSE_RESOURCE_URL_PREFIX + "3" +
+                                           self.ASSESSMENT_RESOURCE_URL_POSTFIX)
+        assert len(json.loads(resp.data)["items"]) == 0
+        assert full_count == empty_count
+
+        resp = client.post(self.STUDENT_RESOURCE_URL_PREFIX, json=_get_student_json())
+        student_url = resp.headers["Location"]
+        resp, full_count = _count_queries(client, self.STUDENT_RESOURCE_URL_PREFIX + "1" +
+                                          self.ASSESSMENT_RESOURCE_URL_POSTFIX)
+        assert len(json.loads(resp.data)["items"]) == 2
+        resp, empty_count = _count_queries(client, student_url + "assessments/")
+        assert len(json.loads(resp.data)["items"]) == 0
+        assert full_count == empty_count
+
     def test_post_valid_request(self, client):
         """Succesfully adds a new assessment"""
         valid = _get_assessment_json(client)
@@ -734,6 +2154,70 @@ class TestAssessmentCollection(object):
         assert resp.status_code == 403
 
 
+class TestAssessmentBatch(object):
+    RESOURCE_URL = "/api/assessments/batch/"
+
+    def test_post_array(self, client):
+        """Posts a batch with created, conflicting and invalid items, as a JSON array"""
+        # caches the collection, which must be cleared by the batch
+        resp = client.get("/api/courses/3/assessments/")
+        assert len(json.loads(resp.data)["items"]) == 0
+
+        batch = [
+            {"course_id": 3, "student_id": 1, "grade": 4, "date": "1993-02-06"},
+            _get_existing_assessment_json(),
+            {"course_id": 3, "student_id": 1, "grade": 3, "date": "1993-02-07"},
+            {"course_id": 3, "student_id": 2, "grade": 4},
+            {"course_id": 3, "student_id": 2, "grade": 4, "date": "XXXXXX"},
+            {"course_id": 999, "student_id": 2, "grade": 4, "date": "1993-02-06"},
+            {"course_id": 3, "student_id": 3, "grade": 9, "date": "1993-02-06"},
+            {"course_id": 3, "student_id": 2, "grade": 0, "date": "1993-02-06"},
+        ]
+        resp = client.post(self.RESOURCE_URL, json=batch)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_namespace(client, body)
+        _check_control_get_method(f"{NAMESPACE}:assessments-all", client, body)
+        assert [item["index"] for item in body["items"]] == list(range(len(batch)))
+        assert [item["status"] for item in body["items"]] == [
+            "created", "conflict", "conflict", "invalid", "invalid", "invalid", "invalid",
+            "created"]
+        assert (body["created"], body["conflict"], body["invalid"]) == (2, 2, 4)
+        _check_control_get_method("self", client, body["items"][0])
+
+        resp = client.get("/api/courses/3/assessments/")
+        items = json.loads(resp.data)["items"]
+        assert sorted((item["student_id"], item["grade"]) for item in items) == [(1, 4), (2, 0)]
+
+    def test_post_ndjson(self, client):
+        """Posts a batch as newline delimited JSON, with a line that is not valid JSON"""
+        data = '{"course_id": 3, "student_id": 1, "grade": 4, "date": "1993-02-06"}\n' \
+               'notjson\n' \
+               '\n' \
+               '{"course_id": 3, "student_id": 2, "grade": 5, "date": "1993-02-06"}\n'
+        resp = client.post(self.RESOURCE_URL, data=data,
+                           headers=Headers({"Content-Type": "application/x-ndjson"}))
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["status"] for item in body["items"]] == ["created", "invalid", "created"]
+        resp = client.get("/api/assessments/")
+        assert len(json.loads(resp.data)["items"]) == 8
+
+    def test_post_not_array(self, client):
+        """Tries to post a batch that is not a JSON array"""
+        resp = client.post(self.RESOURCE_URL, json=_get_existing_assessment_json())
+        assert resp.status_code == 400
+        resp = client.post(self.RESOURCE_URL, data="notjson",
+                           headers=Headers({"Content-Type": "text"}))
+        assert resp.status_code == 400
+
+    def test_post_invalid_assessment_key(self, client):
+        """Tries to post a batch without a valid assessment key"""
+        resp = client.post(self.RESOURCE_URL, json=[],
+                           headers=Headers({'Studentmanager-Api-Key': "Invalid"}))
+        assert resp.status_code == 403
+
+
 class TestAssessmentItem(object):
     COURSE_RESOURCE_URL_PREFIX = "/api/courses/"
     STUDENT_RESOURCE_URL_PREFIX = "/api/students/"
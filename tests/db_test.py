@@ -3,12 +3,15 @@ import os
 import tempfile
 
 import pytest
-from sqlalchemy import event, Engine
+from sqlalchemy import event, inspect, Engine
 from sqlalchemy.exc import IntegrityError
 
 from studentmanager import create_app, db
-from studentmanager.models import Student, Course, Assessment
-from studentmanager.utils import generate_ssn
+from studentmanager.models import \
+    Student, Course, Assessment, SYNTHETIC_LAST_DATE, migrate_db_command, \
+    generate_synthetic_data_command
+from studentmanager.pagination import get_sort, paginate
+from studentmanager.utils import generate_ssn, is_valid_ssn
 
 
 @event.listens_for(Engine, "connect")
@@ -325,3 +328,156 @@ def test_foreign_key_on_delete(app):
         Course.query.filter_by(course_id=course.course_id).delete()
         db.session.commit()
         assert Assessment.query.count() == 0
+
+
+def test_secondary_join_uses_index(app):
+    """Tests that the Student.courses and Course.students joins search assessments by index"""
+    with app.app_context():
+        statements = []
+
+        def _record(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+
+        date = datetime.date.fromisoformat('2023-02-01')
+        student = Student(
+            first_name='name',
+            last_name='surname',
+            date_of_birth=date,
+            ssn=generate_ssn(date)
+        )
+        db.session.add(student)
+        db.session.commit()
+
+        event.listen(db.engine, "before_cursor_execute", _record)
+        try:
+            assert student.courses == []
+        finally:
+            event.remove(db.engine, "before_cursor_execute", _record)
+
+        statement, parameters = statements[-1]
+        with db.engine.connect() as conn:
+            plan = [row[3] for row in
+                    conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)]
+        assert "SEARCH assessments USING INDEX ix_assessments_student_id (student_id=?)" in plan
+
+
+def test_grade_filter_uses_index(app):
+    """Tests that the grade filters on all the assessments search them by index, in order"""
+    with app.app_context():
+        query = Assessment.query \
+            .filter(*Assessment.filter_predicates({"failed": "true"})) \
+            .order_by(Assessment.course_id, Assessment.student_id)
+        statement = query.statement.compile(db.engine, compile_kwargs={"literal_binds": True})
+        with db.engine.connect() as conn:
+            plan = [row[3] for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}")]
+    assert plan == ["SEARCH assessments USING INDEX ix_assessments_grade (grade=?)"]
+
+
+def test_filter_predicates_invalid():
+    """Tests that invalid filter values are rejected"""
+    for args in ({"grade": "6"}, {"grade_min": "-1"}, {"grade": "x"},
+                 {"date_to": "2023-13-01"}, {"failed": "1"}):
+        with pytest.raises(ValueError):
+            Assessment.filter_predicates(args)
+    assert Assessment.filter_predicates({"other": "1"}) == []
+
+
+def test_sorts_use_index(app):
+    """Tests that the allowed orderings of the collections never need a temporary B-tree"""
+    with app.app_context():
+        for model in (Student, Course):
+            for names in model.SORTS:
+                for sort in (",".join(names), ",".join("-" + name for name in names)):
+                    with app.test_request_context(f"/?sort={sort}&limit=10"):
+                        columns, descending = get_sort(model)
+                        statements = []
+
+                        def _record(conn, cursor, statement, parameters, context, executemany):
+                            statements.append((statement, parameters))
+
+                        event.listen(db.engine, "before_cursor_execute", _record)
+                        try:
+                            paginate(model.query, columns, descending=descending)
+                        finally:
+                            event.remove(db.engine, "before_cursor_execute", _record)
+
+                    statement, parameters = statements[-1]
+                    with db.engine.connect() as conn:
+                        plan = [row[3] for row in conn.exec_driver_sql(
+                            "EXPLAIN QUERY PLAN " + statement, parameters)]
+                    assert not any("TEMP B-TREE" in step for step in plan), (sort, plan)
+
+
+def test_migrate_db_creates_missing_indexes(app):
+    """Tests that the migrate-db command adds the declared indexes to an existing database"""
+    with app.app_context():
+        for index in Assessment.__table__.indexes:
+            index.drop(db.engine)
+
+    result = app.test_cli_runner().invoke(migrate_db_command)
+    assert result.exit_code == 0
+    for index in Assessment.__table__.indexes:
+        assert f"created index {index.name}" in result.output
+
+    with app.app_context():
+        names = {index["name"] for index in inspect(db.engine).get_indexes("assessments")}
+    assert names == {index.name for index in Assessment.__table__.indexes}
+
+    result = app.test_cli_runner().invoke(migrate_db_command)
+    assert result.exit_code == 0
+    assert result.output == ""
+
+
+def test_json_validators():
+    """Tests that the precompiled validators are reused and check the date format"""
+    for model in (Student, Course, Assessment):
+        assert model.json_validator() is model.json_validator()
+    valid = {"course_id": 1, "student_id": 1, "grade": 5, "date": "1993-02-08"}
+    assert Assessment.json_validator().is_valid(valid)
+    valid["date"] = "XXXXXX"
+    assert not Assessment.json_validator().is_valid(valid)
+
+
+def _dump_tables():
+    return (
+        [s.serialize() for s in Student.query.order_by(Student.student_id)],
+        [c.serialize() for c in Course.query.order_by(Course.course_id)],
+        [(a.course_id, a.student_id, a.grade, a.date)
+         for a in Assessment.query.order_by(Assessment.course_id, Assessment.student_id)]
+    )
+
+
+def test_synthetic_data(app):
+    """Tests that the synthgen command generates valid data, deterministically for a seed"""
+    args = ["--students", "200", "--courses", "20", "--density", "0.25", "--seed", "7"]
+    result = app.test_cli_runner().invoke(generate_synthetic_data_command, args)
+    assert result.exit_code == 0
+    assert result.output.startswith("added 200 students, 20 courses and ")
+
+    with app.app_context():
+        students, courses, assessments = _dump_tables()
+        assert len(students) == 200 and len(courses) == 20
+        assert len({s["ssn"] for s in students}) == 200
+        for student in Student.query:
+            assert is_valid_ssn(student.ssn, student.date_of_birth)
+        assert len({c["code"] for c in courses}) == 20
+        # roughly 200 * 20 * 0.25 = 1000 assessments
+        assert 800 < len(assessments) < 1200
+        assert {grade for _, _, grade, _ in assessments} == set(range(6))
+        assert all(date <= SYNTHETIC_LAST_DATE for _, _, _, date in assessments)
+
+        db.drop_all()
+        db.create_all()
+
+    result = app.test_cli_runner().invoke(generate_synthetic_data_command, args)
+    assert result.exit_code == 0
+    with app.app_context():
+        assert _dump_tables() == (students, courses, assessments)
+
+    # new data is appended after the existing one
+    result = app.test_cli_runner().invoke(
+        generate_synthetic_data_command, ["--students", "10", "--courses", "0"])
+    assert result.exit_code == 0
+    assert result.output == "added 10 students, 0 courses and 0 assessments\n"
+    with app.app_context():
+        assert Student.query.count() == 210